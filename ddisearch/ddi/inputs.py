@@ -0,0 +1,122 @@
+# file ddisearch/ddi/inputs.py
+#
+# Copyright 2014 Emory University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import namedtuple
+import os
+import sys
+import tarfile
+import zipfile
+
+
+#: A file to be loaded.  For files on disk, **data** is None and the file
+#: should be read from **name**; for files read from an archive, **name**
+#: is the archive path and member name, separated by a colon, and **data**
+#: is the content of the file.  If the input could not be read, **error**
+#: is a message describing the problem.  **archive** is the path of the
+#: archive the file came from (including when the archive itself could
+#: not be read), or None for files on disk; **member** is the name of the
+#: file within the archive, or None.
+InputFile = namedtuple('InputFile', ['name', 'data', 'error', 'archive', 'member'])
+
+#: filename extensions recognized as zip archives
+ZIP_EXTENSIONS = ('.zip',)
+#: filename extensions recognized as tar archives (optionally compressed)
+TAR_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2')
+
+#: filename extension of files to load from directories and archives
+XML_EXTENSION = '.xml'
+
+
+def is_archive(path):
+    'Check if a path looks like a zip or tar archive, by filename extension.'
+    return path.lower().endswith(ZIP_EXTENSIONS + TAR_EXTENSIONS)
+
+
+def input_files(paths, stdin=None):
+    '''Generator of :class:`InputFile` for all of the files to be loaded
+    from the specified paths, so that large numbers of files can be
+    handed out without collecting them all up front.  Each path may be:
+
+    * a file, which is loaded as is
+    * a directory, which is searched recursively for xml files
+    * a zip or tar archive (see :data:`ZIP_EXTENSIONS` and
+      :data:`TAR_EXTENSIONS`); xml files are read directly from the
+      archive, without extracting them to disk
+    * ``-``, to read a list of paths from standard input, one per line
+
+    Files found in directories and archives are returned in sorted order.
+
+    :param paths: list of paths
+    :param stdin: file to read when a path is ``-``; defaults to
+        :data:`sys.stdin`
+    '''
+    for path in paths:
+        if path == '-':
+            for line in (stdin or sys.stdin):
+                line = line.strip()
+                if line:
+                    for inputfile in input_files([line]):
+                        yield inputfile
+
+        elif os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                # walk directories in order, for predictable output
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(XML_EXTENSION):
+                        yield InputFile(os.path.join(root, name), None, None,
+                                        None, None)
+
+        elif is_archive(path) and os.path.isfile(path):
+            for inputfile in archive_files(path):
+                yield inputfile
+
+        else:
+            # a file; any error opening it is reported when it is loaded
+            yield InputFile(path, None, None, None, None)
+
+
+def archive_files(path):
+    '''Generator of :class:`InputFile` for the xml files in a zip or tar
+    archive.  Tar archives are read as a stream, so members are read
+    in archive order; compressed files are decompressed in memory.
+
+    :param path: path to a zip or tar archive
+    '''
+    try:
+        if path.lower().endswith(ZIP_EXTENSIONS):
+            with zipfile.ZipFile(path) as archive:
+                for info in sorted(archive.infolist(), key=lambda i: i.filename):
+                    if info.filename.lower().endswith(XML_EXTENSION):
+                        yield InputFile('%s:%s' % (path, info.filename),
+                                        archive.read(info), None, path,
+                                        info.filename)
+        else:
+            # stream mode, since members are only needed once, in order
+            archive = tarfile.open(path, 'r|*')
+            try:
+                for member in archive:
+                    if member.isfile() and \
+                      member.name.lower().endswith(XML_EXTENSION):
+                        yield InputFile('%s:%s' % (path, member.name),
+                                        archive.extractfile(member).read(), None,
+                                        path, member.name)
+            finally:
+                archive.close()
+
+    except (IOError, zipfile.BadZipfile, tarfile.TarError) as err:
+        yield InputFile(path, None, 'Error reading archive %s: %s' % (path, err),
+                        path, None)
@@ -0,0 +1,108 @@
+# file ddisearch/ddi/journal.py
+#
+# Copyright 2014 Emory University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sqlite3
+import threading
+import time
+
+
+class LoadJournal(object):
+    '''Persistent checkpoint journal for files processed by the ``load``
+    manage command, stored in a small SQLite database file.  Records the
+    last step completed for each file along with timing information, so
+    that an interrupted load can be resumed without repeating work (in
+    particular, geocoding) that has already been done.
+
+    The journal is kept separate from the site database so that it can
+    be written to directly (and safely) from parallel load workers.
+
+    :param path: path to the journal file; created if it does not exist
+    '''
+
+    PARSED = 'parsed'
+    PREPPED = 'prepped'
+    UPLOADED = 'uploaded'
+    REMOVED = 'removed'
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # autocommit, so every checkpoint is saved as soon as it is made
+        self.conn = sqlite3.connect(path, check_same_thread=False,
+                                    isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS journal (
+            filename TEXT PRIMARY KEY,
+            state TEXT,
+            digest TEXT,
+            prepped_xml BLOB,
+            error TEXT,
+            parse_time REAL,
+            prep_time REAL,
+            upload_time REAL,
+            remove_time REAL,
+            updated REAL
+        )''')
+
+    def get(self, filename):
+        '''Get the journal entry for a file.
+
+        :param filename: full path to the file
+        :returns: dictionary of journal fields, or None if the file
+            has not been journaled
+        '''
+        with self._lock:
+            row = self.conn.execute('SELECT * FROM journal WHERE filename = ?',
+                                    (filename,)).fetchone()
+        if row is not None:
+            entry = dict(zip(row.keys(), row))
+            if entry['prepped_xml'] is not None:
+                entry['prepped_xml'] = str(entry['prepped_xml'])
+            return entry
+
+    def checkpoint(self, filename, state, **fields):
+        '''Record the most recent step completed for a file.
+
+        :param filename: full path to the file
+        :param state: last step completed; one of :attr:`PARSED`,
+            :attr:`PREPPED`, :attr:`UPLOADED`, or :attr:`REMOVED`
+        :param fields: any other journal fields to update (e.g., timing)
+        '''
+        fields.update({'state': state, 'updated': time.time()})
+        if fields.get('prepped_xml', None) is not None:
+            fields['prepped_xml'] = sqlite3.Binary(fields['prepped_xml'])
+        names = sorted(fields.keys())
+        with self._lock:
+            self.conn.execute('INSERT OR IGNORE INTO journal (filename) VALUES (?)',
+                              (filename,))
+            self.conn.execute('UPDATE journal SET %s WHERE filename = ?' % \
+                              ', '.join('%s = ?' % n for n in names),
+                              [fields[n] for n in names] + [filename])
+
+    def reset(self, filename):
+        '''Remove any journal entry for a file, e.g. before it is
+        processed again from the beginning.
+
+        :param filename: full path to the file
+        '''
+        with self._lock:
+            self.conn.execute('DELETE FROM journal WHERE filename = ?',
+                              (filename,))
+
+    def close(self):
+        'Close the journal file.'
+        self.conn.close()
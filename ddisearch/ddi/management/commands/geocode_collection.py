@@ -0,0 +1,264 @@
+# file ddisearch/ddi/management/commands/geocode_collection.py
+#
+# Copyright 2014 Emory University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from eulexistdb.db import ExistDB, ExistDBException
+from eulxml import xmlmap
+
+from ddisearch.ddi.models import GeographicCoverage
+from ddisearch.ddi.utils import db_path, post_xquery, xquery_string, \
+    forget_document_metadata
+from ddisearch.geo.stats import report as geocode_report
+from ddisearch.geo.utils import CodebookGeocoder
+
+logger = logging.getLogger(__name__)
+
+
+# xquery to find documents with geographic coverage that has not been geocoded
+_find_xquery = '''<documents>{
+for $cb in collection(%(collection)s)/codeBook[stdyDscr/stdyInfo/sumDscr/geogCover[not(@id)][. != "Global"]]
+return <document path="{document-uri(root($cb))}"/>
+}</documents>'''
+
+# xquery to get the geographic coverage information needed for geocoding
+_coverage_xquery = '''<documents>{
+for $path in (%(paths)s)
+return <document path="{$path}">{
+    doc($path)/codeBook/stdyDscr/stdyInfo/sumDscr/(geogCover|geogUnit) }</document>
+}</documents>'''
+
+# xquery to add ids to geographic coverage in place; each document is
+# updated separately so that one failure doesn't prevent the others
+# from being updated
+_patch_xquery = '''xquery version "3.0";
+<results>{ (%s) }</results>'''
+
+_patch_document = '''try {
+    let $covers := doc(%(path)s)/codeBook/stdyDscr/stdyInfo/sumDscr/geogCover
+    return (%(updates)s, <patched path="{%(path)s}"/>)
+} catch * {
+    <failed path="{%(path)s}">{$err:code}: {$err:description}</failed>
+}'''
+
+# only add an id if the geogCover is still as it was when geocoded
+_patch_coverage = '''for $geog in $covers[%(position)d][not(@id)][. = %(val)s]
+        return update insert attribute id {%(id)s} into $geog'''
+
+
+class CoverageDocument(xmlmap.XmlObject):
+    '''Geographic coverage for a single document in eXist; provides the
+    fields used by :meth:`~ddisearch.geo.utils.CodebookGeocoder.code_locations`,
+    so it can be geocoded without retrieving the entire document.'''
+    #: full path to the document in eXist
+    path = xmlmap.StringField('@path')
+    #: list of :class:`~ddisearch.ddi.models.GeographicCoverage`
+    geo_coverage = xmlmap.NodeListField('geogCover', GeographicCoverage)
+    #: geographic unit
+    geo_unit = xmlmap.StringListField('geogUnit')
+
+
+class CoverageDocuments(xmlmap.XmlObject):
+    'Documents returned by geographic coverage xqueries'
+    #: list of :class:`CoverageDocument`
+    documents = xmlmap.NodeListField('//document', CoverageDocument)
+
+
+class PatchResults(xmlmap.XmlObject):
+    'Per-document results returned by the geographic coverage update xquery'
+    #: paths for documents that were updated successfully
+    patched = xmlmap.StringListField('//patched/@path')
+    #: paths for documents that could not be updated
+    failed = xmlmap.StringListField('//failed/@path')
+    #: error messages for documents that could not be updated
+    errors = xmlmap.StringListField('//failed')
+
+
+class Command(BaseCommand):
+    help = '''Geocode documents in the configured eXist collection that have
+geographic coverage without a GeoNames id (e.g., documents loaded with
+load --defer-geocode), adding the ids to the documents in place.'''
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', '-n',
+            dest='dryrun',
+            action='store_true',
+            help='''Geocode documents and report on what would be done, but
+don't update any documents'''
+        ),
+        make_option('--batch-size', '-b',
+            dest='batch_size',
+            type='int',
+            default=25,
+            help='''Number of documents to retrieve and update in a single
+request (default: %default)'''
+        ),
+    )
+
+    v_normal = 1
+    def handle(self, *args, **options):
+        self.verbosity = int(options.get('verbosity', self.v_normal))
+        self.dryrun = options.get('dryrun', False)
+        batch_size = max(1, int(options.get('batch_size', None) or 25))
+
+        # check for required settings
+        if not hasattr(settings, 'EXISTDB_ROOT_COLLECTION') or \
+           not settings.EXISTDB_ROOT_COLLECTION:
+            raise CommandError("EXISTDB_ROOT_COLLECTION setting is missing")
+
+        self.db = ExistDB()
+        self.cbgeocoder = CodebookGeocoder()
+
+        try:
+            paths = self.find_documents()
+        except ExistDBException as e:
+            raise CommandError('Error finding documents to geocode: %s' % e.message())
+
+        if self.verbosity >= self.v_normal:
+            self.stdout.write('%d document%s to geocode' % \
+                              (len(paths), 's' if len(paths) != 1 else ''))
+
+        self.counts = {'geocoded': 0, 'updated': 0, 'errored': 0,
+                       'coded': 0, 'uncoded': 0}
+        for i in range(0, len(paths), batch_size):
+            self.geocode_batch(paths[i:i + batch_size])
+
+        if self.verbosity >= self.v_normal:
+            self.stdout.write('%(geocoded)d documents geocoded, %(updated)d updated, %(errored)d with errors' \
+                              % self.counts)
+            self.stdout.write('%(coded)d locations coded, %(uncoded)d not found' \
+                              % self.counts)
+            if self.cbgeocoder.stats.codebooks:
+                for line in geocode_report(self.cbgeocoder.statistics(),
+                                           verbose=self.verbosity > self.v_normal):
+                    self.stdout.write(line)
+
+    def find_documents(self):
+        '''Find documents in the configured collection with geographic
+        coverage that has not been geocoded.
+
+        :returns: list of full document paths in eXist
+        '''
+        collection = db_path(settings.EXISTDB_ROOT_COLLECTION)
+        response = post_xquery(self.db,
+            _find_xquery % {'collection': xquery_string(collection)})
+        results = xmlmap.load_xmlobject_from_string(response, CoverageDocuments)
+        return [doc.path for doc in results.documents]
+
+    def geocode_batch(self, paths):
+        '''Retrieve geographic coverage for a batch of documents, geocode
+        them, and update the documents in eXist with the new ids.
+
+        :param paths: list of full document paths in eXist
+        '''
+        try:
+            response = post_xquery(self.db, _coverage_xquery % \
+                {'paths': ', '.join(xquery_string(p) for p in paths)})
+        except ExistDBException as e:
+            self.stdout.write('Error retrieving documents: %s' % e.message())
+            self.counts['errored'] += len(paths)
+            return
+
+        docs = xmlmap.load_xmlobject_from_string(response, CoverageDocuments)
+        updates = {}
+        for doc in docs.documents:
+            try:
+                doc_updates = self.geocode(doc)
+            except Exception as e:
+                logger.exception('Error geocoding %s' % doc.path)
+                self.stdout.write('Error geocoding %s: %s' % (doc.path, e))
+                self.counts['errored'] += 1
+                continue
+
+            self.counts['geocoded'] += 1
+            if doc_updates:
+                updates[doc.path] = doc_updates
+
+        if self.dryrun or not updates:
+            return
+
+        try:
+            status = self.update_documents(updates)
+        except ExistDBException as e:
+            self.stdout.write('Error updating documents: %s' % e.message())
+            self.counts['errored'] += len(updates)
+            return
+
+        for path, err in status.iteritems():
+            if err is None:
+                self.counts['updated'] += 1
+            else:
+                self.stdout.write('Error updating %s: %s' % (path, err))
+                self.counts['errored'] += 1
+        forget_document_metadata([path for path, err in status.iteritems()
+                                  if err is None])
+
+    def geocode(self, doc):
+        '''Geocode the geographic coverage for a single document.
+
+        :param doc: :class:`CoverageDocument`
+        :returns: list of tuples of position, name, and new id for
+            each geographic coverage term that was coded
+        '''
+        missing = [(i, geog.val) for i, geog in enumerate(doc.geo_coverage, 1)
+                   if not geog.id and geog.val != 'Global']
+        self.cbgeocoder.code_locations(doc)
+
+        updates = []
+        for position, val in missing:
+            geog = doc.geo_coverage[position - 1]
+            if geog.id:
+                updates.append((position, val, geog.id))
+                self.counts['coded'] += 1
+            else:
+                self.counts['uncoded'] += 1
+
+        if self.verbosity > self.v_normal:
+            self.stdout.write('%s: coded %d of %d locations' % \
+                              (doc.path, len(updates), len(missing)))
+        return updates
+
+    def update_documents(self, updates):
+        '''Add geonames ids to geographic coverage for a set of documents
+        in eXist, in a single request.
+
+        :param updates: dictionary of full document path and list of
+            updates, as returned by :meth:`geocode`
+        :returns: dictionary keyed on document path; value is None if the
+            document was updated successfully, or an error message if not
+        '''
+        patches = []
+        for path, doc_updates in updates.iteritems():
+            patches.append(_patch_document % {
+                'path': xquery_string(path),
+                'updates': ',\n        '.join(_patch_coverage % {
+                    'position': position, 'val': xquery_string(val),
+                    'id': xquery_string(geonames_id)
+                    } for position, val, geonames_id in doc_updates)
+            })
+        response = post_xquery(self.db, _patch_xquery % ',\n'.join(patches))
+
+        results = xmlmap.load_xmlobject_from_string(response, PatchResults)
+        status = dict((path, None) for path in results.patched)
+        status.update(dict(zip(results.failed, results.errors)))
+        for path in updates:
+            if path not in status:
+                status[path] = 'No result returned for %s' % path
+        return status
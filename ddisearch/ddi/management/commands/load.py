@@ -14,32 +14,106 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+from io import BytesIO
+import json
 import logging
 import os
 from optparse import make_option
-import re
+import shutil
 import sys
+import threading
 import time
 
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 
-from progressbar import ProgressBar, Bar, Percentage, ETA, SimpleProgress
+from progressbar import ProgressBar, Bar, Percentage, ETA, SimpleProgress, \
+     Counter, Timer, UnknownLength
 
 from eulexistdb.db import ExistDB, ExistDBException
-from eulxml.xmlmap import load_xmlobject_from_file
-
-from ddisearch.ddi.models import CodeBook, Topic
-from ddisearch.ddi.topics import topic_mappings, conditional_topics
+from eulxml.xmlmap import load_xmlobject_from_string
+
+from ddisearch.ddi.inputs import input_files, is_archive
+from ddisearch.ddi.journal import LoadJournal
+from ddisearch.ddi.models import CodeBook, LoadedDocument
+from ddisearch.ddi.pipeline import Pipeline
+from ddisearch.ddi.prep import CodebookPrep
+from ddisearch.ddi.stats import LoadStats
+from ddisearch.ddi.utils import store_documents, retry, metadata_cache, \
+    forget_cached_page
+from ddisearch.ddi.validate import validate_document
+from ddisearch.geo.stats import report as geocode_report
 from ddisearch.geo.utils import CodebookGeocoder
 
 logger = logging.getLogger(__name__)
 
 
-class Command(BaseCommand):
-    args = '<filename filename filename ...>'
+class LoadResult(object):
+    '''Outcome of processing a single file; passed through the stages of
+    the load pipeline that parse, prep and upload it, and then to the main
+    thread for reporting and cleanup.'''
+
+    def __init__(self, filename, dbpath):
+        #: local filename; for files read from an archive, the archive
+        #: path and member name
+        self.filename = filename
+        #: full path where the document is loaded in the eXist collection
+        self.dbpath = dbpath
+        #: True if the document was loaded to eXist
+        self.success = False
+        #: list of error messages to be reported, if any
+        self.errors = []
+        #: SHA-1 digest of the file contents
+        self.digest = None
+        #: agency and id of the codebook, once it has been prepped
+        self.agency = None
+        self.codebook_id = None
+        #: SHA-1 checksum and last modification time of the document as
+        #: stored in eXist, once it has been loaded
+        self.hash = None
+        self.last_modified = None
+        #: when loading incrementally, one of **new**, **changed**, or
+        #: **unchanged** (unchanged documents are not prepped or loaded)
+        self.status = None
+        #: True if processing was resumed from the load journal
+        self.resumed = False
+        #: parsed :class:`~ddisearch.ddi.models.CodeBook`, if the document
+        #: is ready to be prepped
+        self.cb = None
+        #: prepped xml, if the document is ready to be uploaded
+        self.xml = None
+        #: original file content, kept until the document is prepped
+        #: in case it does not need to be re-serialized
+        self.data = None
+        #: True if prepping modified the document
+        self.modified = None
+        #: size in bytes of the document as uploaded to eXist
+        self.size = None
+        #: size in bytes of the file as read
+        self.bytes_read = None
+        #: time in seconds spent on each step of processing this file,
+        #: keyed on step name (see :attr:`Command.steps`)
+        self.timings = {}
+        #: True if the file was read from an archive (and should not be removed)
+        self.archived = False
+        #: number of attempts made to load the document to eXist
+        self.attempts = 0
+
+
+class UploadError(Exception):
+    'Failure loading documents to eXist that may succeed if retried'
+    pass
+
+
+class Command(BaseCommand, CodebookPrep):
+    args = '<filename|directory|archive|- ...>'
     help = '''Loads XML files into the configured eXist collection.
-The local copy will be *removed* after it is successfully loaded.'''
+Directories are searched recursively for XML files; XML files in zip and tar
+archives are loaded directly from the archive.  Use - to read a list of
+files from standard input, one per line.
+The local copy will be *removed* after it is successfully loaded
+(files in archives are not removed).'''
 
     option_list = BaseCommand.option_list + (
         make_option('--dry-run', '-n',
@@ -47,11 +121,118 @@ The local copy will be *removed* after it is successfully loaded.'''
             action='store_true',
             help='''Report on what would be done, but don't delete any files'''
         ),
+        make_option('--jobs', '-j',
+            dest='jobs',
+            type='int',
+            default=1,
+            help='''Number of files to parse, prep and load in parallel
+(default: %default)'''
+        ),
+        make_option('--batch-size', '-b',
+            dest='batch_size',
+            type='int',
+            default=1,
+            help='''Number of documents to upload to eXist in a single
+request (default: %default)'''
+        ),
+        make_option('--retries',
+            dest='retries',
+            type='int',
+            default=3,
+            help='''Number of times to retry loading to eXist after a failure
+that may be temporary, e.g. a timeout (default: %default)'''
+        ),
+        make_option('--retry-delay',
+            dest='retry_delay',
+            type='float',
+            default=1.0,
+            help='''Seconds to wait before the first retry; doubled for each
+subsequent retry, with random jitter (default: %default)'''
+        ),
+        make_option('--dead-letter',
+            dest='dead_letter',
+            metavar='DIR',
+            help='''Move files that could not be loaded to the specified
+directory, along with a .error file describing the problem'''
+        ),
+        make_option('--skip-validation',
+            dest='validate',
+            action='store_false',
+            default=True,
+            help='''Don't check files for missing or invalid required fields
+before prepping them (see the validate command)'''
+        ),
+        make_option('--pretty',
+            dest='pretty',
+            action='store_true',
+            help='''Pretty-print documents modified by the load before uploading
+(larger and slower; by default, documents are serialized compactly)'''
+        ),
+        make_option('--defer-geocode',
+            dest='defer_geocode',
+            action='store_true',
+            help='''Load documents without geocoding geographic coverage;
+run geocode_collection afterwards to add GeoNames ids'''
+        ),
+        make_option('--stats',
+            dest='stats',
+            metavar='FILE',
+            help='''Write a JSON summary of timing for each step, bytes
+transferred, and the slowest files to the specified file (use - for
+standard output)'''
+        ),
+        make_option('--slowest',
+            dest='slowest',
+            type='int',
+            default=10,
+            help='''Number of slowest files to include in the --stats summary
+(default: %default)'''
+        ),
+        make_option('--incremental', '-i',
+            dest='incremental',
+            action='store_true',
+            help='''Skip files that are identical to the version last loaded'''
+        ),
+        make_option('--journal',
+            dest='journal',
+            help='''Record progress for each file in the specified journal
+file (default: LOAD_JOURNAL setting, if configured)'''
+        ),
+        make_option('--resume', '-r',
+            dest='resume',
+            action='store_true',
+            help='''Resume an interrupted load, skipping any steps already
+completed for each file according to the load journal'''
+        ),
     )
 
+    #: steps in processing each file, as reported by ``--stats``
+    steps = ['validate', 'parse', 'topics', 'dates', 'geocode', 'serialize',
+             'upload', 'remove']
+
+    #: check files before prepping them; unset by ``--skip-validation``
+    validate = True
+
+    #: skip geocoding when prepping documents; set by ``--defer-geocode``
+    defer_geocode = False
+
     v_normal = 1
     def handle(self, *files, **options):
-        verbosity = int(options.get('verbosity', self.v_normal))
+        self.verbosity = int(options.get('verbosity', self.v_normal))
+        self.dryrun = options.get('dryrun', False)
+        jobs = max(1, int(options.get('jobs', None) or 1))
+        batch_size = max(1, int(options.get('batch_size', None) or 1))
+        self.pretty = options.get('pretty', False)
+        self.validate = options.get('validate', True)
+        self.retries = max(0, int(options.get('retries', None) or 0))
+        self.retry_delay = float(options.get('retry_delay', None) or 1.0)
+        self.dead_letter = options.get('dead_letter', None)
+        self.defer_geocode = options.get('defer_geocode', False)
+        stats_file = options.get('stats', None)
+        self.incremental = options.get('incremental', False)
+        self.resume = options.get('resume', False)
+        journal_path = options.get('journal', None) or \
+            getattr(settings, 'LOAD_JOURNAL', None)
 
         # check for required settings
         if not hasattr(settings, 'EXISTDB_ROOT_COLLECTION') or \
@@ -59,127 +240,556 @@ The local copy will be *removed* after it is successfully loaded.'''
             raise CommandError("EXISTDB_ROOT_COLLECTION setting is missing")
             return
 
-        self.db = ExistDB()
-        self.cbgeocoder = CodebookGeocoder()
-
-        # initalize progress bar
-        pbar = None
-        total = len(files)
-        # init progress bar if processing enough files, running on a terminal
-        if total >= 10 and os.isatty(sys.stderr.fileno()):
-            widgets = [Percentage(), ' (', SimpleProgress(), ')',
-                       Bar(), ETA()]
-            pbar = ProgressBar(widgets=widgets, maxval=total).start()
-
-        errored = 0
-        loaded = 0
-        for f in files:
-            success = False
+        if self.resume and not journal_path:
+            raise CommandError("Resuming requires a load journal; specify --journal " +
+                               "or configure LOAD_JOURNAL")
+        # a dry run does not record progress, so there is nothing to resume
+        if self.resume and self.dryrun:
+            raise CommandError("Resuming is not supported with --dry-run")
 
-            if pbar:
-                pbar.update(errored + loaded)
+        # record progress in the load journal, except on a dry run
+        self.journal = None
+        if journal_path and not self.dryrun:
+            self.journal = LoadJournal(journal_path)
 
-            try:
-                # full path location where file will be loaded in exist db collection
-                dbpath = settings.EXISTDB_ROOT_COLLECTION + "/" + os.path.basename(f)
-                # TODO: any error checking? validation?
+        # eXist connections are per-thread; see :attr:`db`
+        self._local = threading.local()
+        self.cbgeocoder = CodebookGeocoder()
 
-                start = time.time()
-                cb = load_xmlobject_from_file(f, CodeBook)
-                logger.debug('%s loaded as xml in %f sec' % (f, time.time() - start))
+        # when loading incrementally, get digests for all previously loaded
+        # documents up front rather than querying for each file
+        self.manifest = {}
+        if self.incremental:
+            self.manifest = dict(LoadedDocument.objects \
+                .values_list('document_name', 'digest'))
 
-                start = time.time()
-                self.prep(cb)
-                logger.debug('%s prepped in %f sec' % (f, time.time() - start))
-                # load to eXist from string since DDI documents aren't that large,
-                # rather than reloading the file
-                if not options.get('dryrun', False):
-                    start = time.time()
-                    success = self.db.load(cb.serialize(pretty=True), dbpath, overwrite=True)
-                    logger.debug('%s loaded to eXist in %f sec' % (f, time.time() - start))
-
-            except IOError as e:
-                self.stdout.write("Error opening %s: %s" % (f, e))
-                errored += 1
-
-            except ExistDBException as e:
-                self.stdout.write("Error: failed to load %s to eXist" % f)
-                self.stdout.write(e.message())
-                errored += 1
-
-            if not options.get('dryrun', False) and success:
-                loaded += 1
-                if verbosity > self.v_normal:
-                    self.stdout.write("Loaded %s as %s" % (f, dbpath))
-
-                try:
-                    os.remove(f)
-                except OSError as e:
-                    self.stdout.write('Error removing %s: %s' % (f, e))
-
-        if pbar:
-           pbar.finish()
+        # initalize progress bar
+        self.pbar = None
+        # total is only known without reading directories, archives, or stdin
+        if any(f == '-' or os.path.isdir(f) or is_archive(f) for f in files):
+            total = UnknownLength
+        else:
+            total = len(files)
+        # init progress bar if processing enough files, running on a terminal
+        if (total is UnknownLength or total >= 10) and os.isatty(sys.stderr.fileno()):
+            if total is UnknownLength:
+                widgets = [Counter(), ' documents ', Timer()]
+            else:
+                widgets = [Percentage(), ' (', SimpleProgress(), ')',
+                           Bar(), ETA()]
+            self.pbar = ProgressBar(widgets=widgets, maxval=total).start()
+
+        # files are processed in a pipeline, so that parsing, prepping
+        # (mostly waiting on GeoNames) and uploading (mostly waiting on
+        # eXist) all happen at the same time on different documents;
+        # threads rather than processes, since most of the time for each
+        # file is spent waiting
+        self.pipeline = Pipeline(queue_size=2 * jobs)
+        self.pipeline.add_stage('parse', self.parse_files, workers=jobs,
+                                error=self.stage_error)
+        self.pipeline.add_stage('prep', self.prep_documents, workers=jobs,
+                                accept=lambda r: r.cb is not None,
+                                error=self.stage_error)
+        self.pipeline.add_stage('upload', self.upload, workers=jobs,
+                                batch_size=batch_size,
+                                accept=lambda r: r.xml is not None,
+                                error=self.stage_error)
+
+        self.counts = {'processed': 0, 'loaded': 0, 'errored': 0, 'resumed': 0,
+                       'new': 0, 'changed': 0, 'unchanged': 0, 'bytes': 0,
+                       'retried': 0, 'dead_letter': 0}
+        self.stats = LoadStats(self.steps, slowest=options.get('slowest', 10))
+        # eXist paths of the files in this load, and the files they are
+        # loaded from; see :meth:`load_result`
+        self.targets = {}
+        try:
+            # report results and remove files from the main thread only,
+            # so that output and counts are not interleaved
+            # files are found as they are needed, rather than all up front
+            inputs = (self.load_result(f) for f in input_files(files))
+            for result in self.pipeline.results(inputs):
+                self.report(result)
+        finally:
+            if self.journal is not None:
+                self.journal.close()
+
+        if self.pbar:
+           self.pbar.finish()
 
         # output a summary of what was done if more than one file was processed
-        if verbosity >= self.v_normal:
+        loaded = self.counts['loaded']
+        errored = self.counts['errored']
+        resumed = self.counts['resumed']
+        if self.verbosity >= self.v_normal:
             if loaded > 1:
-                self.stdout.write("%d document%s loaded" % \
-                                  (loaded, 's' if loaded != 1 else ''))
+                self.stdout.write("%d document%s loaded (%d bytes)" % \
+                                  (loaded, 's' if loaded != 1 else '',
+                                   self.counts['bytes']))
             if errored > 1:
                 self.stdout.write("%d document%s with errors" % \
                                   (errored, 's' if errored != 1 else ''))
+            if self.counts['retried']:
+                self.stdout.write("%(retried)d document%(s)s loaded after retrying" % \
+                    {'retried': self.counts['retried'],
+                     's': 's' if self.counts['retried'] != 1 else ''})
+            if self.dead_letter and self.counts['dead_letter']:
+                self.stdout.write("%d file%s moved to %s" % \
+                    (self.counts['dead_letter'],
+                     's' if self.counts['dead_letter'] != 1 else '',
+                     self.dead_letter))
+            if self.resume:
+                self.stdout.write("%d document%s resumed from the load journal" % \
+                                  (resumed, 's' if resumed != 1 else ''))
+            if self.incremental:
+                self.stdout.write("%(new)d new, %(changed)d changed, %(unchanged)d unchanged" \
+                                  % self.counts)
+            if self.cbgeocoder.stats.codebooks:
+                for line in geocode_report(self.cbgeocoder.statistics(),
+                                           verbose=self.verbosity > self.v_normal):
+                    self.stdout.write(line)
+            if self.counts['processed'] > 1:
+                self.report_stages()
+
+        if stats_file:
+            self.write_stats(stats_file)
+
+    def write_stats(self, filename):
+        '''Write a JSON summary of the load to a file (or to standard
+        output, if filename is ``-``): document counts, elapsed time,
+        timing for each step and each pipeline stage, geocoding statistics
+        (see :meth:`~ddisearch.geo.utils.CodebookGeocoder.statistics`),
+        bytes read and uploaded, and the slowest files.'''
+        elapsed = self.pipeline.elapsed
+        summary = self.stats.summary()
+        summary.update({
+            'documents': dict((k, v) for k, v in self.counts.iteritems()
+                              if k != 'bytes'),
+            'elapsed': elapsed,
+            'geocode': self.cbgeocoder.statistics(),
+            'stages': dict((stage.name, {
+                'workers': stage.workers,
+                'count': stage.count,
+                'busy': stage.busy,
+                'utilization': stage.utilization(elapsed)
+            }) for stage in self.pipeline.stages),
+        })
+        output = json.dumps(summary, indent=2, sort_keys=True)
+        if filename == '-':
+            self.stdout.write(output)
+        else:
+            with open(filename, 'w') as statsfile:
+                statsfile.write(output)
+
+    def report_stages(self):
+        '''Output counts and timing for each stage of the load pipeline;
+        the stage with the highest utilization is limiting throughput.'''
+        elapsed = self.pipeline.elapsed
+        self.stdout.write("Processed %d document%s in %.2f sec" % \
+            (self.counts['processed'], 's' if self.counts['processed'] != 1 else '',
+             elapsed))
+        for stage in self.pipeline.stages:
+            rate = stage.count / stage.busy if stage.busy else 0
+            self.stdout.write("  %-6s %5d document%s  %8.2f sec busy  %7.1f/sec per worker  %3d%% utilized" % \
+                (stage.name, stage.count, 's' if stage.count != 1 else ' ',
+                 stage.busy, rate, round(100 * stage.utilization(elapsed))))
+
+    def report(self, result):
+        '''Report on a processed file, update counts, and remove the local
+        copy if it was loaded.  Should only be called from the main thread.
+
+        :param result: :class:`LoadResult`
+        '''
+        for msg in result.errors:
+            self.stdout.write(msg)
+        if result.errors:
+            self.counts['errored'] += 1
+        elif result.status is not None:
+            self.counts[result.status] += 1
+
+        if result.resumed:
+            self.counts['resumed'] += 1
+
+        if result.status == 'unchanged' and self.verbosity > self.v_normal:
+            self.stdout.write("Skipping %s (unchanged)" % result.filename)
+
+        if not self.dryrun and result.success:
+            self.counts['loaded'] += 1
+            if result.attempts > 1:
+                self.counts['retried'] += 1
+            if result.size is not None:
+                self.counts['bytes'] += result.size
+            if self.verbosity > self.v_normal:
+                self.stdout.write("Loaded %s as %s%s" % \
+                    (result.filename, result.dbpath, self.payload_info(result)))
+
+            # record the digest of the loaded file for future
+            # incremental loads, and the document metadata reported by
+            # eXist for conditional requests; if the document was not
+            # prepped in this run (i.e., resumed) or eXist did not report
+            # the metadata, it is looked up in eXist when needed
+            metadata = {'digest': result.digest, 'hash': '', 'last_modified': None}
+            if result.codebook_id is not None:
+                metadata.update({'agency': result.agency,
+                                 'codebook_id': result.codebook_id,
+                                 'hash': result.hash or '',
+                                 'last_modified': result.last_modified})
+                metadata_cache().delete((result.agency, result.codebook_id))
+            # remove the rendered page for the previous version, if cached
+            previous = LoadedDocument.objects \
+                .filter(document_name=os.path.basename(result.dbpath)).first()
+            if previous is not None and previous.hash != metadata['hash']:
+                forget_cached_page(previous.agency, previous.codebook_id,
+                                   previous.hash)
+            LoadedDocument.objects.update_or_create(
+                document_name=os.path.basename(result.dbpath),
+                defaults=metadata)
+
+        elif self.dryrun and result.size is not None and \
+          self.verbosity > self.v_normal:
+            self.stdout.write("Would load %s as %s%s" % \
+                (result.filename, result.dbpath, self.payload_info(result)))
+
+        # unchanged files are already loaded, so clean them up too
+        if not self.dryrun and not result.archived and \
+          (result.success or result.status == 'unchanged'):
+            try:
+                start = time.time()
+                os.remove(result.filename)
+                result.timings['remove'] = time.time() - start
+                if result.digest is not None:
+                    self.checkpoint(os.path.abspath(result.filename),
+                                    LoadJournal.REMOVED,
+                                    remove_time=result.timings['remove'])
+            except OSError as e:
+                self.stdout.write('Error removing %s: %s' % (result.filename, e))
+
+        # set aside files that could not be loaded, so they can be
+        # fixed and reloaded without searching through the output
+        if self.dead_letter and result.errors and not self.dryrun and \
+          not result.archived and os.path.isfile(result.filename):
+            self.move_to_dead_letter(result)
+
+        self.stats.add(result.filename, result.timings,
+                       bytes_read=result.bytes_read,
+                       bytes_uploaded=result.size if result.success else None)
+
+        self.counts['processed'] += 1
+        if self.pbar:
+            self.pbar.update(self.counts['processed'])
+
+    def move_to_dead_letter(self, result):
+        '''Move a file that could not be loaded to the dead-letter directory,
+        along with a ``.error`` file listing the errors.
+
+        :param result: :class:`LoadResult`
+        '''
+        dest = os.path.join(self.dead_letter, os.path.basename(result.filename))
+        try:
+            if not os.path.isdir(self.dead_letter):
+                os.makedirs(self.dead_letter)
+            shutil.move(result.filename, dest)
+            with open('%s.error' % dest, 'w') as errfile:
+                errfile.write('File: %s\n' % os.path.abspath(result.filename))
+                errfile.write('Date: %s\n' % time.strftime('%Y-%m-%d %H:%M:%S'))
+                if result.digest is not None:
+                    errfile.write('Digest: %s\n' % result.digest)
+                if result.attempts:
+                    errfile.write('Attempts: %d\n' % result.attempts)
+                errfile.write('\n')
+                for msg in result.errors:
+                    errfile.write('%s\n' % msg.encode('utf-8'))
+        except (IOError, OSError) as e:
+            self.stdout.write('Error moving %s to %s: %s' % \
+                              (result.filename, self.dead_letter, e))
+            return
 
-    topic_id = re.compile('^(?P<org>[A-Z]+)[ .](?P<id>[IVX]+(\.[A-Z](\.[0-9]+(\.[a-z]+)?)?)?)')
-
-
-    def prep(self, cb):
+        self.counts['dead_letter'] += 1
+        if self.verbosity > self.v_normal:
+            self.stdout.write('Moved %s to %s' % (result.filename, dest))
+
+    def payload_info(self, result):
+        # size and modification status of a prepped document, for output
+        if result.size is None:
+            return ''
+        if result.modified is None:
+            status = 'resumed'
+        else:
+            status = 'modified' if result.modified else 'unmodified'
+        return ' (%d bytes, %s)' % (result.size, status)
+
+    @property
+    def db(self):
+        ''':class:`~eulexistdb.db.ExistDB` instance for the current thread,
+        since the underlying http session should not be shared by
+        parallel workers'''
+        if not hasattr(self._local, 'db'):
+            self._local.db = ExistDB()
+        return self._local.db
+
+    def load_result(self, inputfile):
+        '''Initialize a :class:`LoadResult` for a file to be loaded.
+
+        :param inputfile: :class:`~ddisearch.ddi.inputs.InputFile`
+        '''
+        # full path location where file will be loaded in exist db collection;
+        # files from archives are named for the archive member, not the archive
+        dbpath = settings.EXISTDB_ROOT_COLLECTION + "/" + \
+            os.path.basename(inputfile.member or inputfile.name)
+        result = LoadResult(inputfile.name, dbpath)
+        # files from archives (or errors reading them) are never removed
+        # or moved, since the archive may contain other files
+        result.archived = inputfile.archive is not None
+        if inputfile.data is not None:
+            result.data = inputfile.data
+        if inputfile.error is not None:
+            result.errors.append(inputfile.error)
+        # files are loaded into a single collection by filename, so files
+        # with the same name (e.g., in different directories or archives)
+        # would overwrite each other; only the first one is loaded
+        elif dbpath in self.targets:
+            result.errors.append('Error: %s not loaded; %s is already loaded as %s' \
+                                 % (inputfile.name, self.targets[dbpath], dbpath))
+        else:
+            self.targets[dbpath] = inputfile.name
+        return result
+
+    def stage_error(self, results, err):
+        '''Record an unexpected error in one of the pipeline stages on each
+        of the affected results, so it is reported and the files are not
+        processed any further.'''
+        for result in results:
+            result.errors.append("Error processing %s: %s" % (result.filename, err))
+            result.cb = result.xml = None
+
+    def parse_files(self, results):
+        'Pipeline stage: parse each file; see :meth:`parse_file`.'
+        for result in results:
+            self.parse_file(result)
+
+    def parse_file(self, result):
+        '''Read and parse a single file so it is ready to be prepped; the
+        parsed document is set as :attr:`LoadResult.cb`, unless it is
+        skipped or there is an error.  Safe to run in parallel worker
+        threads.
+
+        If a load journal is in use, progress is checkpointed as each
+        step completes; when resuming, steps already completed for an
+        unmodified file are not repeated.
+
+        :param result: :class:`LoadResult`
+        '''
+        f = result.filename
+        filename = os.path.abspath(f)
+        entry = state = None
+        if result.errors:
+            return
+        try:
+            if self.resume:
+                entry = self.journal.get(filename)
+                # a file that was loaded and removed is complete
+                if entry is not None and entry['state'] == LoadJournal.REMOVED \
+                  and not os.path.exists(f):
+                    result.resumed = True
+                    return
+
+            if result.archived:
+                # already read from the archive
+                data, result.data = result.data, None
+            else:
+                with open(f, 'rb') as xmlfile:
+                    data = xmlfile.read()
+            result.digest = hashlib.sha1(data).hexdigest()
+            result.bytes_read = len(data)
+
+            if self.incremental:
+                previous = self.manifest.get(os.path.basename(result.dbpath), None)
+                if previous is None:
+                    result.status = 'new'
+                elif previous != result.digest:
+                    result.status = 'changed'
+                else:
+                    # identical to the version already loaded; nothing to do
+                    result.status = 'unchanged'
+                    return
+
+            # only pick up where a previous run left off if the file
+            # hasn't changed since then
+            if entry is not None and entry['digest'] == result.digest \
+              and entry['state'] in [LoadJournal.PREPPED, LoadJournal.UPLOADED]:
+                state = entry['state']
+                result.resumed = True
+                logger.debug('%s resuming after %s' % (f, state))
+            elif self.journal is not None:
+                # clear out any record of a previous run
+                self.journal.reset(filename)
+
+            if state is None and self.validate:
+                # check for problems before any time is spent prepping
+                start = time.time()
+                errors = validate_document(BytesIO(data))
+                result.timings['validate'] = time.time() - start
+                if errors:
+                    result.errors.extend('Invalid %s: %s' % (f, err)
+                                         for err in errors)
+                    return
+
+            if state is None:
+                start = time.time()
+                result.cb = load_xmlobject_from_string(data, CodeBook)
+                result.data = data
+                elapsed = result.timings['parse'] = time.time() - start
+                logger.debug('%s loaded as xml in %f sec' % (f, elapsed))
+                state = self.checkpoint(filename, LoadJournal.PARSED,
+                                        digest=result.digest, parse_time=elapsed)
+
+            elif state == LoadJournal.UPLOADED:
+                # already in eXist; only needs to be removed
+                result.success = True
+
+            else:
+                result.size = len(entry['prepped_xml'])
+                if not self.dryrun:
+                    result.xml = entry['prepped_xml']
+
+        except IOError as e:
+            result.errors.append("Error opening %s: %s" % (f, e))
+
+        if result.errors and state is not None:
+            self.checkpoint(filename, state, error='\n'.join(result.errors))
+
+    def prep_documents(self, results):
+        'Pipeline stage: prep each parsed document; see :meth:`prep_document`.'
+        for result in results:
+            self.prep_document(result)
+
+    def prep_document(self, result):
+        '''Prep a parsed document (see :meth:`prep`) so it is ready to be
+        loaded to eXist; unless this is a dry run, the prepped document
+        is set as :attr:`LoadResult.xml`.  Safe to run in parallel worker
+        threads.
+
+        If prepping made no changes, the original file content is used
+        as is; otherwise, the document is serialized (pretty-printed only
+        if requested with ``--pretty``).
+
+        :param result: :class:`LoadResult` with a parsed document
+        '''
+        start = time.time()
+        result.modified = self.prep(result.cb, result.timings)
+        if result.modified:
+            serialize_start = time.time()
+            xml = result.cb.serialize(pretty=self.pretty)
+            result.timings['serialize'] = time.time() - serialize_start
+        else:
+            xml = result.data
+        elapsed = time.time() - start
+        result.size = len(xml)
+        # document metadata, recorded once the document is loaded
+        if result.cb.id is not None:
+            result.agency = result.cb.id.agency or ''
+            result.codebook_id = result.cb.id.val or ''
+        logger.debug('%s prepped in %f sec (%s, %d bytes)' % \
+            (result.filename, elapsed,
+             'modified' if result.modified else 'unmodified', result.size))
+        self.checkpoint(os.path.abspath(result.filename), LoadJournal.PREPPED,
+                        prepped_xml=xml, prep_time=elapsed)
+        # parsed document and original content are no longer needed
+        result.cb = result.data = None
+        if not self.dryrun:
+            # load to eXist from string since DDI documents aren't that large,
+            # rather than reloading the file
+            result.xml = xml
+
+    def upload(self, results):
+        '''Load prepped documents to eXist, as a batch in a single request.
+        Success or failure is set on each :class:`LoadResult`.
+
+        Failures that may be temporary (e.g., eXist is busy or times out)
+        are retried with exponential backoff, up to the number of times
+        specified by ``--retries``.
+
+        :param results: list of :class:`LoadResult` with prepped xml
+        '''
+        start = time.time()
+        try:
+            status, attempts = retry(lambda: self.store(results),
+                                     retries=self.retries, delay=self.retry_delay,
+                                     exceptions=(UploadError,))
+        except UploadError as e:
+            status = dict((result.dbpath, unicode(e)) for result in results)
+            attempts = self.retries + 1
+
+        # when loading a batch, the time is split evenly across documents
+        elapsed = (time.time() - start) / len(results)
+        for result in results:
+            logger.debug('%s loaded to eXist in %f sec' % (result.filename, elapsed))
+            result.timings['upload'] = elapsed
+            result.attempts = attempts
+            result.success = status[result.dbpath] is None
+            if not result.success:
+                result.errors.append("Error: failed to load %s to eXist" % result.filename)
+                result.errors.append(status[result.dbpath])
+
+            filename = os.path.abspath(result.filename)
+            if result.success:
+                # prepped xml is no longer needed once it is in eXist
+                self.checkpoint(filename, LoadJournal.UPLOADED,
+                                prepped_xml=None, error=None,
+                                upload_time=elapsed)
+            else:
+                self.checkpoint(filename, LoadJournal.PREPPED,
+                                error='\n'.join(result.errors))
+            result.xml = None
+
+    def store(self, results):
+        '''Store prepped documents in eXist, in a single request.  The
+        checksum and modification time reported by eXist are set on each
+        :class:`LoadResult` that was stored, so no further request is needed.
+
+        :param results: list of :class:`LoadResult` with prepped xml
+        :returns: dictionary keyed on eXist path; value is None if the
+            document was stored successfully, or an error message if not
+        :raises: :class:`UploadError` if the request failed in a way
+            that could succeed if retried
+        '''
+        metadata = {}
+        try:
+            status = store_documents(self.db,
+                [(result.dbpath, result.xml) for result in results],
+                metadata=metadata)
+        except ExistDBException as e:
+            # request failed as a whole (e.g., timeout); may succeed if retried
+            raise UploadError(e.message())
+        for result in results:
+            result.hash, result.last_modified = metadata.get(result.dbpath,
+                                                             (None, None))
+        return status
+
+    def checkpoint(self, filename, state, **fields):
+        '''Record a completed step for a file in the load journal,
+        if there is one.  Returns the state, for convenience.
+
+        :param filename: full path to the file
+        :param state: step completed, e.g. :attr:`LoadJournal.PARSED`
+        :param fields: any other journal fields to update (e.g., timing)
+        '''
+        if self.journal is not None:
+            self.journal.checkpoint(filename, state, **fields)
+        return state
+
+    def prep(self, cb, timings=None):
         # do any prep work or cleanup that needs to be done
-        # before loading to exist
-        self.local_topics(cb)
-        self.clean_dates(cb)
-        self.cbgeocoder.code_locations(cb)
-
-    def icpsr_topic_id(self, topic):
-        # generate icpsr topic id in the format needed for lookup in our
-        # topic dictionary; returns None if not an ICPSR topic
-        m = self.topic_id.match(topic)
-        if m:
-            match_info = m.groupdict()
-            if match_info['org'] == 'ICPSR':
-                return '%(org)s.%(id)s' % match_info
-
-    def local_topics(self, cb):
-        # convert ICPSR topics to local topics
-        for t in cb.topics:
-            topic_id = self.icpsr_topic_id(t.val)
-            if topic_id is not None:
-                new_topic = topic_mappings.get(topic_id, None)
-                if new_topic:
-                    cb.topics.append(Topic(val=new_topic,
-                        vocab='local'))
-
-                # conditional topics if the geographic coverage is global
-                if topic_id in conditional_topics['global'] and \
-                  'Global' in [unicode(gc) for gc in cb.geo_coverage]:
-                    cb.topics.append(Topic(val=conditional_topics['global'][topic_id],
-                                           vocab='local'))
-
-    def clean_dates(self, cb):
-        # clean up dates so we can search consistently on 4-digit years
-        # or more; dates should be YYYY, YYYY-MM, or YYYY-MM-DD
-        prev_date = None
-        for d in cb.time_periods:
-            # special case: two-digit date as second date in a cycle
-            # interpret as month on the year that starts the cycle
-            if d.event == 'end' and d.cycle == prev_date.cycle and \
-                    len(d.date) == 2:
-               d.date = '%04d-%02d' % (int(prev_date.date), int(d.date))
-
-            elif len(d.date) < 4:
-                d.date = '%04d' % int(d.date)
-
-            # store current date as previous date for next loop, in case
-            # we need to clean up an end date in a cycle
-            prev_date = d
-
-
+        # before loading to exist; returns True if the document was modified.
+        # If a timings dictionary is passed in, time for each step is added
+        if timings is None:
+            timings = {}
+        steps = [('topics', self.local_topics), ('dates', self.clean_dates)]
+        # when geocoding is deferred, it is done by geocode_collection
+        if not self.defer_geocode:
+            steps.append(('geocode', self.cbgeocoder.code_locations))
+        changed = False
+        for step, method in steps:
+            start = time.time()
+            changed = method(cb) or changed
+            timings[step] = time.time() - start
+        return bool(changed)
@@ -0,0 +1,261 @@
+# file ddisearch/ddi/management/commands/prewarm_geocode.py
+#
+# Copyright 2014 Emory University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+from io import BytesIO
+import logging
+from optparse import make_option
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from eulexistdb.db import ExistDB, ExistDBException
+from eulxml import xmlmap
+from lxml import etree
+
+from ddisearch.ddi.inputs import input_files
+from ddisearch.ddi.utils import db_path, post_xquery, xquery_string
+from ddisearch.geo.stats import report as geocode_report
+from ddisearch.geo.utils import CodebookGeocoder
+
+logger = logging.getLogger(__name__)
+
+
+#: path to geographic coverage terms in a DDI document
+GEOGRAPHIC_COVERAGE = ('codeBook', 'stdyDscr', 'stdyInfo', 'sumDscr', 'geogCover')
+
+# xquery to find the distinct lists of geographic coverage terms in the
+# collection, and how many documents use each one; how a term is looked
+# up depends on the other terms in the same document, so the terms for
+# each document are kept together
+_coverage_xquery = '''xquery version "3.0";
+<coverage>{
+for $cb in collection(%(collection)s)/codeBook[stdyDscr/stdyInfo/sumDscr/geogCover]
+let $names := string-join($cb/stdyDscr/stdyInfo/sumDscr/geogCover/string(text()[1]),
+                          codepoints-to-string(9))
+group by $names
+return <names count="{count($cb)}">{$names}</names>
+}</coverage>'''
+
+
+class CoverageList(xmlmap.XmlObject):
+    'Distinct list of geographic coverage terms in the collection'
+    #: geographic coverage terms, tab-separated
+    names = xmlmap.StringField('text()')
+    #: number of documents with these terms
+    count = xmlmap.IntegerField('@count')
+
+
+class CoverageLists(xmlmap.XmlObject):
+    'Geographic coverage term lists returned by the coverage xquery'
+    #: list of :class:`CoverageList`
+    lists = xmlmap.NodeListField('//names', CoverageList)
+
+
+def coverage_names(source):
+    '''Get the geographic coverage terms from a DDI document, without
+    building the whole document in memory.
+
+    :param source: filename or file-like object
+    :returns: list of geographic coverage values, in document order
+    '''
+    names = []
+    path = []
+    for event, elem in etree.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            path.append(elem.tag)
+            continue
+
+        if tuple(path) == GEOGRAPHIC_COVERAGE:
+            names.append(elem.text or '')
+        path.pop()
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+    return names
+
+
+class Command(BaseCommand):
+    help = '''Geocode the distinct geographic coverage terms from a set of
+DDI files (or, if no files are specified, from the documents in the
+configured eXist collection) into the geocode cache, so that loading
+or geocoding the documents afterwards uses cached results.  Each distinct
+name is looked up once, however many documents it is used in.  Accepts
+the same files, directories, archives and file lists as the load command.'''
+    args = '<filename filename filename ...>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--jobs', '-j',
+            dest='jobs',
+            type='int',
+            help='''Number of names to geocode in parallel (default: the
+GEOCODE_WORKERS setting, or 4)'''
+        ),
+    )
+
+    #: cached results for the terms being looked up; see
+    #: :meth:`~ddisearch.geo.utils.CodebookGeocoder.cached_results`
+    cache = None
+
+    v_normal = 1
+    def handle(self, *files, **options):
+        self.verbosity = int(options.get('verbosity', self.v_normal))
+        jobs = options.get('jobs', None)
+
+        self.cbgeocoder = CodebookGeocoder(workers=jobs)
+
+        if files:
+            coverage = self.file_coverage(files)
+        else:
+            # check for required settings
+            if not hasattr(settings, 'EXISTDB_ROOT_COLLECTION') or \
+               not settings.EXISTDB_ROOT_COLLECTION:
+                raise CommandError("EXISTDB_ROOT_COLLECTION setting is missing")
+            try:
+                coverage = self.collection_coverage()
+            except ExistDBException as e:
+                raise CommandError('Error retrieving geographic coverage: %s' % e.message())
+
+        # work out the terms to look up for each distinct list of names,
+        # and how many documents each term is used in
+        terms = OrderedDict()
+        for names, count in coverage.iteritems():
+            for i, term in self.cbgeocoder.plan_lookups(list(names)):
+                terms[term] = terms.get(term, 0) + count
+
+        if self.verbosity >= self.v_normal:
+            self.stdout.write('%d distinct place name%s to geocode' % \
+                              (len(terms), 's' if len(terms) != 1 else ''))
+
+        start = time.time()
+        counts = {'resolved': 0, 'unresolved': 0, 'errored': 0}
+        unresolved = []
+        # get cached results up front, rather than querying for each name
+        self.cache = self.cbgeocoder.cached_results(terms.keys())
+        results = self.cbgeocoder.map(self.lookup, terms.keys())
+        # results are cached and aliases learned once every name has been
+        # looked up, so that the results don't depend on the order of
+        # parallel lookups
+        self.cbgeocoder.save_results([(term, result) for term, result, err
+                                      in results if err is None])
+        for term, result, err in results:
+            dbloc = None
+            if err is None:
+                dbloc, err = self.locate(term, result)
+            if err is not None:
+                counts['errored'] += 1
+                self.stdout.write('Error geocoding %s: %s' % (term[0], err))
+            elif dbloc is None:
+                counts['unresolved'] += 1
+                unresolved.append(term)
+            else:
+                counts['resolved'] += 1
+                if self.verbosity > self.v_normal:
+                    self.stdout.write('%s: geonames:%d' % (term[0], dbloc.geonames_id))
+
+        if self.verbosity >= self.v_normal:
+            # most used names first, since they are most worth fixing
+            unresolved.sort(key=lambda t: -terms[t])
+            for term in unresolved:
+                geogname, check_country, geo_options = term
+                options = ', '.join('%s=%s' % opt for opt in geo_options)
+                self.stdout.write('Not found: %s%s (%d document%s)' % \
+                    (geogname, ' [%s]' % options if options else '',
+                     terms[term], 's' if terms[term] != 1 else ''))
+
+            counts['elapsed'] = time.time() - start
+            self.stdout.write('%(resolved)d resolved, %(unresolved)d not found, %(errored)d errors in %(elapsed).2f sec' \
+                              % counts)
+            if terms:
+                for line in geocode_report(self.cbgeocoder.statistics(),
+                                           verbose=self.verbosity > self.v_normal):
+                    self.stdout.write(line)
+
+    def lookup(self, term):
+        '''Geocode a single term into the geocode cache, reporting errors
+        instead of raising them, so that one failure doesn't stop the
+        rest of the terms from being looked up.
+
+        :returns: tuple of term, the result of
+            :meth:`~ddisearch.geo.utils.CodebookGeocoder.resolve_term`
+            or None, and error or None
+        '''
+        try:
+            return term, self.cbgeocoder.resolve_term(term, self.cache), None
+        except Exception as e:
+            logger.exception('Error geocoding %s' % term[0])
+            return term, None, e
+
+    def locate(self, term, result):
+        '''Get or add the location for a term resolved by :meth:`lookup`,
+        reporting errors instead of raising them.
+
+        :returns: tuple of :class:`~ddisearch.geo.models.Location` or
+            None, and error or None
+        '''
+        geonames_id, loc = result
+        if geonames_id is None:
+            return None, None
+        try:
+            return self.cbgeocoder.get_locations({geonames_id: loc}).get(geonames_id), None
+        except Exception as e:
+            logger.exception('Error geocoding %s' % term[0])
+            return None, e
+
+    def file_coverage(self, files):
+        '''Collect the geographic coverage from a set of DDI files.
+
+        :param files: list of files, directories, or archives
+        :returns: dictionary of tuples of geographic coverage values
+            and the number of documents with exactly those values
+        '''
+        coverage = OrderedDict()
+        documents = 0
+        for inputfile in input_files(files):
+            if inputfile.error:
+                self.stdout.write(inputfile.error)
+                continue
+            source = inputfile.name
+            if inputfile.data is not None:
+                source = BytesIO(inputfile.data)
+            try:
+                names = tuple(coverage_names(source))
+            except (IOError, etree.XMLSyntaxError) as e:
+                self.stdout.write('Error reading %s: %s' % (inputfile.name, e))
+                continue
+
+            documents += 1
+            if names:
+                coverage[names] = coverage.get(names, 0) + 1
+
+        if self.verbosity >= self.v_normal:
+            self.stdout.write('%d document%s read' % \
+                              (documents, 's' if documents != 1 else ''))
+        return coverage
+
+    def collection_coverage(self):
+        '''Collect the distinct lists of geographic coverage values from
+        the documents in the configured eXist collection.
+
+        :returns: dictionary as returned by :meth:`file_coverage`
+        '''
+        collection = db_path(settings.EXISTDB_ROOT_COLLECTION)
+        response = post_xquery(ExistDB(),
+            _coverage_xquery % {'collection': xquery_string(collection)})
+        results = xmlmap.load_xmlobject_from_string(response, CoverageLists)
+        return OrderedDict((tuple((cl.names or '').split('\t')), cl.count)
+                           for cl in results.lists)
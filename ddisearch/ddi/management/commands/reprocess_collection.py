@@ -0,0 +1,272 @@
+# file ddisearch/ddi/management/commands/reprocess_collection.py
+#
+# Copyright 2014 Emory University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import difflib
+import logging
+from optparse import make_option
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from eulexistdb.db import ExistDB, ExistDBException
+from eulxml import xmlmap
+
+from ddisearch.ddi.models import CodeBook
+from ddisearch.ddi.pipeline import Pipeline
+from ddisearch.ddi.prep import CodebookPrep
+from ddisearch.ddi.utils import db_path, post_xquery, store_documents, \
+    xquery_string, forget_document_metadata
+
+logger = logging.getLogger(__name__)
+
+
+# xquery to list all documents in the collection
+_list_xquery = '''<documents>{
+for $cb in collection(%(collection)s)/codeBook
+return <document path="{document-uri(root($cb))}"/>
+}</documents>'''
+
+# xquery to retrieve a batch of documents
+_fetch_xquery = '''<documents>{
+for $path in (%(paths)s)
+return <document path="{$path}">{ doc($path)/codeBook }</document>
+}</documents>'''
+
+
+class StoredDocument(xmlmap.XmlObject):
+    'A document retrieved from eXist, along with its path'
+    #: full path to the document in eXist
+    path = xmlmap.StringField('@path')
+    #: document content, as :class:`~ddisearch.ddi.models.CodeBook`
+    codebook = xmlmap.NodeField('codeBook', CodeBook)
+
+
+class StoredDocuments(xmlmap.XmlObject):
+    'Documents returned by collection xqueries'
+    #: list of :class:`StoredDocument`
+    documents = xmlmap.NodeListField('//document', StoredDocument)
+
+
+class ReprocessResult(object):
+    '''Outcome of reprocessing a single document; passed through the
+    stages that fetch, update and store it, and then to the main thread
+    for reporting.'''
+
+    def __init__(self, path):
+        #: full path to the document in eXist
+        self.path = path
+        #: :class:`~ddisearch.ddi.models.CodeBook`, once retrieved
+        self.cb = None
+        #: True if the document was changed by reprocessing
+        self.changed = False
+        #: differences in topics and dates, as a list of unified diff lines
+        self.diff = []
+        #: True if the changed document was stored in eXist
+        self.success = False
+        #: list of error messages to be reported, if any
+        self.errors = []
+
+
+class Command(BaseCommand, CodebookPrep):
+    help = '''Re-apply local topics and date cleanup to all documents
+already in the configured eXist collection, e.g. after changes to the
+topic mappings, without reloading the original files.'''
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', '-n',
+            dest='dryrun',
+            action='store_true',
+            help='''Show the changes that would be made to topics and dates
+for each document, but don't update any documents'''
+        ),
+        make_option('--jobs', '-j',
+            dest='jobs',
+            type='int',
+            default=4,
+            help='''Number of batches to retrieve and store in parallel
+(default: %default)'''
+        ),
+        make_option('--batch-size', '-b',
+            dest='batch_size',
+            type='int',
+            default=25,
+            help='''Number of documents to retrieve or store in a single
+request (default: %default)'''
+        ),
+    )
+
+    v_normal = 1
+    def handle(self, *args, **options):
+        self.verbosity = int(options.get('verbosity', self.v_normal))
+        self.dryrun = options.get('dryrun', False)
+        jobs = max(1, int(options.get('jobs', None) or 4))
+        batch_size = max(1, int(options.get('batch_size', None) or 25))
+
+        # check for required settings
+        if not hasattr(settings, 'EXISTDB_ROOT_COLLECTION') or \
+           not settings.EXISTDB_ROOT_COLLECTION:
+            raise CommandError("EXISTDB_ROOT_COLLECTION setting is missing")
+
+        # eXist connections are per-thread; see :attr:`db`
+        self._local = threading.local()
+
+        try:
+            paths = self.list_documents()
+        except ExistDBException as e:
+            raise CommandError('Error listing documents: %s' % e.message())
+
+        # retrieving and storing documents is mostly waiting on eXist,
+        # so batches are retrieved and stored in parallel
+        pipeline = Pipeline(queue_size=2 * jobs * batch_size)
+        pipeline.add_stage('fetch', self.fetch, workers=jobs,
+                           batch_size=batch_size, error=self.stage_error)
+        pipeline.add_stage('update', self.update_documents,
+                           accept=lambda r: r.cb is not None,
+                           error=self.stage_error)
+        pipeline.add_stage('store', self.store, workers=jobs,
+                           batch_size=batch_size,
+                           accept=lambda r: r.changed and not self.dryrun,
+                           error=self.stage_error)
+
+        self.counts = {'processed': 0, 'changed': 0, 'updated': 0, 'errored': 0}
+        for result in pipeline.results(ReprocessResult(p) for p in paths):
+            self.report(result)
+
+        if self.verbosity >= self.v_normal:
+            summary = '%(processed)d documents processed, %(changed)d changed'
+            if not self.dryrun:
+                summary += ', %(updated)d updated'
+            summary += ', %(errored)d with errors'
+            self.stdout.write(summary % self.counts)
+
+    @property
+    def db(self):
+        ''':class:`~eulexistdb.db.ExistDB` instance for the current thread,
+        since the underlying http session should not be shared by
+        parallel workers'''
+        if not hasattr(self._local, 'db'):
+            self._local.db = ExistDB()
+        return self._local.db
+
+    def report(self, result):
+        '''Report on a reprocessed document and update counts.  Should only
+        be called from the main thread.
+
+        :param result: :class:`ReprocessResult`
+        '''
+        self.counts['processed'] += 1
+        for msg in result.errors:
+            self.stdout.write(msg)
+        if result.errors:
+            self.counts['errored'] += 1
+        if result.changed:
+            self.counts['changed'] += 1
+            if self.dryrun and self.verbosity >= self.v_normal:
+                self.stdout.write('\n'.join(result.diff))
+        if result.success:
+            self.counts['updated'] += 1
+            forget_document_metadata([result.path])
+            if self.verbosity > self.v_normal:
+                self.stdout.write('Updated %s' % result.path)
+
+    def stage_error(self, results, err):
+        # record an unexpected error on each affected document
+        for result in results:
+            result.errors.append('Error processing %s: %s' % (result.path, err))
+            result.cb = None
+            result.changed = False
+
+    def list_documents(self):
+        '''List all documents in the configured collection.
+
+        :returns: list of full document paths in eXist
+        '''
+        collection = db_path(settings.EXISTDB_ROOT_COLLECTION)
+        response = post_xquery(self.db,
+            _list_xquery % {'collection': xquery_string(collection)})
+        results = xmlmap.load_xmlobject_from_string(response, StoredDocuments)
+        return [doc.path for doc in results.documents]
+
+    def fetch(self, results):
+        '''Pipeline stage: retrieve a batch of documents from eXist.
+
+        :param results: list of :class:`ReprocessResult`
+        '''
+        try:
+            response = post_xquery(self.db, _fetch_xquery % \
+                {'paths': ', '.join(xquery_string(r.path) for r in results)})
+        except ExistDBException as e:
+            for result in results:
+                result.errors.append('Error retrieving %s: %s' % (result.path, e.message()))
+            return
+
+        docs = xmlmap.load_xmlobject_from_string(response, StoredDocuments)
+        codebooks = dict((doc.path, doc.codebook) for doc in docs.documents)
+        for result in results:
+            result.cb = codebooks.get(result.path, None)
+            if result.cb is None:
+                result.errors.append('Error retrieving %s: not found' % result.path)
+
+    def update_documents(self, results):
+        'Pipeline stage: reprocess each document; see :meth:`update_document`.'
+        for result in results:
+            self.update_document(result)
+
+    def update_document(self, result):
+        '''Regenerate local topics and clean up dates for a single document,
+        and determine whether anything changed.
+
+        :param result: :class:`ReprocessResult` with a retrieved document
+        '''
+        before = self.summary_lines(result.cb)
+        self.remove_local_topics(result.cb)
+        self.local_topics(result.cb)
+        self.clean_dates(result.cb)
+        after = self.summary_lines(result.cb)
+
+        # compare content rather than serialized xml, since removing
+        # and adding topics may change whitespace
+        result.changed = before != after
+        if result.changed and self.dryrun:
+            result.diff = list(difflib.unified_diff(before, after,
+                fromfile=result.path, tofile=result.path, lineterm=''))
+        if not result.changed:
+            # document is no longer needed
+            result.cb = None
+
+    def summary_lines(self, cb):
+        # topics and dates for a document, one per line, for comparison
+        return ['topcClas %s: %s' % (t.vocab or '', t.val) for t in cb.topics] + \
+               ['timePrd %s: %s' % (d.event or '', d.date) for d in cb.time_periods]
+
+    def store(self, results):
+        '''Pipeline stage: store a batch of changed documents in eXist.
+
+        :param results: list of :class:`ReprocessResult` with changed documents
+        '''
+        try:
+            status = store_documents(self.db,
+                [(result.path, result.cb.serialize()) for result in results])
+        except ExistDBException as e:
+            status = dict((result.path, e.message()) for result in results)
+
+        for result in results:
+            result.success = status[result.path] is None
+            if not result.success:
+                result.errors.append('Error storing %s: %s' % \
+                                     (result.path, status[result.path]))
+            result.cb = None
@@ -0,0 +1,78 @@
+# file ddisearch/ddi/management/commands/validate.py
+#
+# Copyright 2014 Emory University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import multiprocessing
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ddisearch.ddi.inputs import input_files
+from ddisearch.ddi.validate import validate_input
+
+
+class Command(BaseCommand):
+    help = '''Check DDI XML files for problems that would prevent them from
+being loaded (not well-formed, missing title or ID number, unparseable
+dates) without loading them.  Accepts the same files, directories,
+archives and file lists as the load command.'''
+    args = '<filename filename filename ...>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--jobs', '-j',
+            dest='jobs',
+            type='int',
+            help='''Number of files to check in parallel (default: number
+of CPUs)'''
+        ),
+    )
+
+    v_normal = 1
+    def handle(self, *files, **options):
+        self.verbosity = int(options.get('verbosity', self.v_normal))
+        jobs = options.get('jobs', None) or multiprocessing.cpu_count()
+
+        if not files:
+            raise CommandError('No files specified')
+
+        counts = {'checked': 0, 'valid': 0, 'invalid': 0}
+        start = time.time()
+        # parsing is cpu bound, so files are checked in separate processes;
+        # results are returned in order, as soon as each file is done
+        pool = multiprocessing.Pool(max(1, jobs))
+        try:
+            for name, errors in pool.imap(validate_input, input_files(files),
+                                          chunksize=10):
+                counts['checked'] += 1
+                if errors:
+                    counts['invalid'] += 1
+                    for err in errors:
+                        self.stdout.write('%s: %s' % (name, err))
+                else:
+                    counts['valid'] += 1
+                    if self.verbosity > self.v_normal:
+                        self.stdout.write('%s: valid' % name)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        if self.verbosity >= self.v_normal:
+            counts['elapsed'] = time.time() - start
+            self.stdout.write('%(checked)d files checked in %(elapsed).2f sec: %(valid)d valid, %(invalid)d invalid' \
+                              % counts)
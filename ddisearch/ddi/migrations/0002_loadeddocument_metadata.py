@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ddi', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='loadeddocument',
+            name='agency',
+            field=models.CharField(max_length=255, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='loadeddocument',
+            name='codebook_id',
+            field=models.CharField(max_length=255, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='loadeddocument',
+            name='hash',
+            field=models.CharField(max_length=40, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='loadeddocument',
+            name='last_modified',
+            field=models.DateTimeField(null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AlterField(
+            model_name='loadeddocument',
+            name='digest',
+            field=models.CharField(max_length=40, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AlterIndexTogether(
+            name='loadeddocument',
+            index_together=set([('agency', 'codebook_id')]),
+        ),
+    ]
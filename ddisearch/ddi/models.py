@@ -18,13 +18,14 @@ import re
 import logging
 from collections import OrderedDict
 from django.conf import settings
-from django.db.models import Q
+from django.db import models
 from eulxml import xmlmap
 
 from eulexistdb.models import XmlModel
 from eulexistdb.manager import Manager
 
-from ddisearch.geo.models import Location, StateCode, GeonamesCountry
+from ddisearch.geo.models import Location
+from ddisearch.geo.reference import reference_data
 
 
 logger = logging.getLogger(__name__)
@@ -515,8 +516,9 @@ class CodeBook(XmlModel):
     def us_state_ids(self):
         states = self.locations.order_by('state_code') \
                                .values_list('state_code', flat=True).distinct()
-        return list(StateCode.objects.filter(code__in=states).order_by('fips') \
-                                .values_list('fips', flat=True).distinct())
+        state_by_code = reference_data().state_by_code
+        return sorted(set(state_by_code[code].fips for code in states
+                          if code in state_by_code))
 
     @property
     def country_ids(self):
@@ -531,9 +533,12 @@ class CodeBook(XmlModel):
                                    .order_by('continent_code') \
                                    .values_list('continent_code', flat=True).distinct()
         # find explicitly referenced countries OR countries by continent
-        return list(GeonamesCountry.objects.filter(Q(code__in=countries) | Q(continent__in=continents)) \
-                                   .order_by('numeric_code') \
-                                   .values_list('numeric_code', flat=True).distinct())
+        refdata = reference_data()
+        ids = set(refdata.country_by_code[code].numeric_code for code in countries
+                  if code in refdata.country_by_code)
+        for code in continents:
+            ids.update(c.numeric_code for c in refdata.countries_by_continent.get(code, []))
+        return sorted(ids)
 
 
 # collection prefix normally added by queryset; has to be added explicitly
@@ -566,4 +571,33 @@ class DistinctTopics(XmlModel):
     text_xpath = '%(xq_var)s'
 
 
+### local database models
+
+class LoadedDocument(models.Model):
+    '''Local manifest of DDI documents loaded to eXist by the ``load``
+    manage command, used to skip files that have not changed since they
+    were last loaded, and to check whether a document has changed
+    (ETag and Last-Modified) without querying eXist; see
+    :func:`ddisearch.ddi.utils.document_metadata`.'''
+    #: document name in the eXist collection (i.e., the base filename)
+    document_name = models.CharField(max_length=255, unique=True)
+    #: SHA-1 digest of the original file contents as last loaded
+    digest = models.CharField(max_length=40, blank=True)
+    #: date and time the document was last loaded
+    loaded = models.DateTimeField(auto_now=True)
+    #: agency of the codebook id
+    agency = models.CharField(max_length=255, blank=True)
+    #: codebook id
+    codebook_id = models.CharField(max_length=255, blank=True)
+    #: SHA-1 checksum of the document as stored in eXist (calculated by
+    #: eXist), used as ETag; blank if unknown (e.g., cleared when the
+    #: document is changed in eXist other than by the load script)
+    hash = models.CharField(max_length=40, blank=True)
+    #: date and time the document was last modified in eXist
+    last_modified = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        index_together = [('agency', 'codebook_id')]
 
+    def __unicode__(self):
+        return self.document_name
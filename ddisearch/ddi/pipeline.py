@@ -0,0 +1,209 @@
+# file ddisearch/ddi/pipeline.py
+#
+# Copyright 2014 Emory University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import Queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+#: marker put on a queue when there are no more items to process
+DONE = None
+
+
+class Stage(object):
+    '''One stage of a processing pipeline: a set of worker threads that
+    take items from an input queue, process them, and put them on an
+    output queue for the next stage.  Items the stage does not
+    :meth:`accept` are passed along untouched.
+
+    Items are handed to ``process`` in lists of up to ``batch_size``;
+    a partial batch is processed when the input runs out.  Exceptions
+    are logged and passed to ``error`` along with the batch, so that
+    one bad item does not stall the pipeline.
+
+    Counts and timing are kept for each stage, so that the stage
+    limiting throughput can be identified.
+
+    :param name: stage name, for reporting
+    :param process: function to process a list of items
+    :param inqueue: :class:`Queue.Queue` to take items from
+    :param outqueue: :class:`Queue.Queue` to put processed items on
+    :param workers: number of worker threads
+    :param batch_size: maximum number of items to process at once
+    :param accept: optional function to determine whether an item should
+        be processed by this stage
+    :param error: optional function called with the batch and the
+        exception when processing fails
+    '''
+
+    def __init__(self, name, process, inqueue, outqueue, workers=1,
+                 batch_size=1, accept=None, error=None):
+        self.name = name
+        self.process = process
+        self.inqueue = inqueue
+        self.outqueue = outqueue
+        self.workers = workers
+        self.batch_size = batch_size
+        self.accept = accept or (lambda item: True)
+        self.error = error
+        #: number of consumers of :attr:`outqueue`; each is sent
+        #: :data:`DONE` once all workers for this stage have finished
+        self.consumers = 1
+        #: number of items processed
+        self.count = 0
+        #: total time spent processing items, in seconds, across all workers
+        self.busy = 0.0
+        self._active = workers
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        'Start the worker threads for this stage.'
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.run,
+                                      name='%s-%d' % (self.name, i + 1))
+            # don't keep the process alive if the main thread is interrupted
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def join(self):
+        'Wait for the worker threads for this stage to finish.'
+        for thread in self._threads:
+            thread.join()
+
+    def run(self):
+        # worker thread: process items until the previous stage is done
+        batch = []
+        while True:
+            item = self.inqueue.get()
+            if item is DONE:
+                break
+            if not self.accept(item):
+                self.outqueue.put(item)
+                continue
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                self.run_batch(batch)
+                batch = []
+
+        if batch:
+            self.run_batch(batch)
+
+        with self._lock:
+            self._active -= 1
+            finished = self._active == 0
+        # once the last worker is done, so is the stage
+        if finished:
+            for i in range(self.consumers):
+                self.outqueue.put(DONE)
+
+    def run_batch(self, batch):
+        start = time.time()
+        try:
+            self.process(batch)
+        except Exception as err:
+            logger.exception('Error in %s stage' % self.name)
+            if self.error is not None:
+                self.error(batch, err)
+        elapsed = time.time() - start
+        with self._lock:
+            self.count += len(batch)
+            self.busy += elapsed
+        for item in batch:
+            self.outqueue.put(item)
+
+    def utilization(self, elapsed):
+        '''Fraction of the available worker time that was spent processing
+        items; the stage closest to 1.0 is the bottleneck.
+
+        :param elapsed: total run time of the pipeline, in seconds
+        '''
+        if not elapsed:
+            return 0.0
+        return self.busy / (elapsed * self.workers)
+
+
+class Pipeline(object):
+    '''A series of :class:`Stage` objects connected by bounded queues, so
+    that each stage works on different items at the same time while
+    limiting the number of items held in memory between stages.
+
+    Items are fed to the first stage from a separate thread and can be
+    consumed from the final stage in the calling thread with
+    :meth:`results`.
+
+    :param queue_size: maximum number of items waiting between any two
+        stages
+    '''
+
+    def __init__(self, queue_size=10):
+        self.queue_size = queue_size
+        self.stages = []
+        self.input = Queue.Queue(maxsize=queue_size)
+        self.output = self.input
+
+    def add_stage(self, name, process, workers=1, batch_size=1, **kwargs):
+        '''Add a stage at the end of the pipeline; takes the same
+        arguments as :class:`Stage`, except for the queues.  Returns
+        the new stage.'''
+        # allow enough room between stages for a full batch per worker
+        queue = Queue.Queue(maxsize=max(self.queue_size, workers * batch_size))
+        stage = Stage(name, process, self.output, queue, workers=workers,
+                      batch_size=batch_size, **kwargs)
+        if self.stages:
+            self.stages[-1].consumers = workers
+        self.stages.append(stage)
+        self.output = queue
+        return stage
+
+    def results(self, items):
+        '''Run the pipeline: generator that feeds items to the first stage
+        and yields processed items from the last stage as they become
+        available.  Output order is not preserved.
+
+        :param items: iterable of items to process; not read ahead of
+            the first stage by more than the queue size
+        '''
+        first = self.stages[0] if self.stages else None
+        self.start = time.time()
+        feeder = threading.Thread(target=self._feed, name='feed',
+                                  args=(items, first.workers if first else 1))
+        feeder.daemon = True
+        for stage in self.stages:
+            stage.start()
+        feeder.start()
+
+        while True:
+            item = self.output.get()
+            if item is DONE:
+                break
+            yield item
+
+        for stage in self.stages:
+            stage.join()
+        self.elapsed = time.time() - self.start
+
+    def _feed(self, items, consumers):
+        try:
+            for item in items:
+                self.input.put(item)
+        finally:
+            for i in range(consumers):
+                self.input.put(DONE)
@@ -0,0 +1,90 @@
+# file ddisearch/ddi/prep.py
+#
+# Copyright 2014 Emory University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+
+from ddisearch.ddi.models import Topic
+from ddisearch.ddi.topics import topic_mappings, conditional_topics
+
+
+class CodebookPrep(object):
+    '''Mixin with the cleanup that is done on DDI
+    :class:`~ddisearch.ddi.models.CodeBook` documents before they are
+    loaded to eXist: adding local topics based on ICPSR topics, and
+    normalizing dates.  Methods that update a document return True if
+    it was modified.'''
+
+    topic_id = re.compile('^(?P<org>[A-Z]+)[ .](?P<id>[IVX]+(\.[A-Z](\.[0-9]+(\.[a-z]+)?)?)?)')
+
+    def icpsr_topic_id(self, topic):
+        # generate icpsr topic id in the format needed for lookup in our
+        # topic dictionary; returns None if not an ICPSR topic
+        m = self.topic_id.match(topic)
+        if m:
+            match_info = m.groupdict()
+            if match_info['org'] == 'ICPSR':
+                return '%(org)s.%(id)s' % match_info
+
+    def local_topics(self, cb):
+        # convert ICPSR topics to local topics; returns True if any were added
+        topic_count = len(cb.topics)
+        for t in cb.topics:
+            topic_id = self.icpsr_topic_id(t.val)
+            if topic_id is not None:
+                new_topic = topic_mappings.get(topic_id, None)
+                if new_topic:
+                    cb.topics.append(Topic(val=new_topic,
+                        vocab='local'))
+
+                # conditional topics if the geographic coverage is global
+                if topic_id in conditional_topics['global'] and \
+                  'Global' in [unicode(gc) for gc in cb.geo_coverage]:
+                    cb.topics.append(Topic(val=conditional_topics['global'][topic_id],
+                                           vocab='local'))
+        return len(cb.topics) != topic_count
+
+    def clean_dates(self, cb):
+        # clean up dates so we can search consistently on 4-digit years
+        # or more; dates should be YYYY, YYYY-MM, or YYYY-MM-DD
+        # returns True if any dates were changed
+        prev_date = None
+        changed = False
+        for d in cb.time_periods:
+            # special case: two-digit date as second date in a cycle
+            # interpret as month on the year that starts the cycle
+            if d.event == 'end' and d.cycle == prev_date.cycle and \
+                    len(d.date) == 2:
+               d.date = '%04d-%02d' % (int(prev_date.date), int(d.date))
+               changed = True
+
+            elif len(d.date) < 4:
+                d.date = '%04d' % int(d.date)
+                changed = True
+
+            # store current date as previous date for next loop, in case
+            # we need to clean up an end date in a cycle
+            prev_date = d
+
+        return changed
+
+
+    def remove_local_topics(self, cb):
+        # remove any local topics, e.g. so they can be regenerated
+        # with current topic mappings; returns True if any were removed
+        local = [i for i, t in enumerate(cb.topics) if t.vocab == 'local']
+        for i in reversed(local):
+            del cb.topics[i]
+        return len(local) > 0
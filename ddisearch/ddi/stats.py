@@ -0,0 +1,100 @@
+# file ddisearch/ddi/stats.py
+#
+# Copyright 2014 Emory University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import heapq
+import math
+
+
+def percentile(values, pct):
+    '''Nearest-rank percentile of a sorted list of values.
+
+    :param values: sorted list of numbers
+    :param pct: percentile, from 0 to 100
+    :returns: the value, or None if the list is empty
+    '''
+    if not values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+class LoadStats(object):
+    '''Collects timing and size information for the files processed by the
+    ``load`` manage command, for a machine-readable summary that can be
+    compared across runs.
+
+    :param steps: names of the steps to report on, in order
+    :param slowest: number of the slowest files to include in the summary
+    '''
+
+    def __init__(self, steps, slowest=10):
+        self.steps = steps
+        self.slowest = slowest
+        self.timings = dict((step, []) for step in steps)
+        self.bytes_read = 0
+        self.bytes_uploaded = 0
+        # min-heap of (total time, counter, file info), so the fastest
+        # of the slowest files can be dropped as slower files are added
+        self._slowest = []
+        self._count = 0
+
+    def add(self, filename, timings, bytes_read=None, bytes_uploaded=None):
+        '''Add the information for a single processed file.
+
+        :param filename: name of the file
+        :param timings: dictionary of step name and time in seconds, for
+            the steps completed for this file
+        :param bytes_read: size of the file as read, if it was read
+        :param bytes_uploaded: size of the document uploaded to eXist,
+            if it was uploaded
+        '''
+        for step, elapsed in timings.iteritems():
+            if step in self.timings:
+                self.timings[step].append(elapsed)
+        self.bytes_read += bytes_read or 0
+        self.bytes_uploaded += bytes_uploaded or 0
+
+        self._count += 1
+        if self.slowest and timings:
+            info = {'filename': filename, 'total': sum(timings.values()),
+                    'steps': timings}
+            item = (info['total'], self._count, info)
+            if len(self._slowest) < self.slowest:
+                heapq.heappush(self._slowest, item)
+            else:
+                heapq.heappushpop(self._slowest, item)
+
+    def summary(self):
+        '''Summary of the collected information, as a dictionary suitable
+        for serializing as JSON: count, total, median (p50), 95th percentile
+        and maximum time in seconds for each step; total bytes read and
+        uploaded; and the slowest files, slowest first.'''
+        steps = {}
+        for step in self.steps:
+            values = sorted(self.timings[step])
+            steps[step] = {
+                'count': len(values),
+                'total': sum(values),
+                'p50': percentile(values, 50),
+                'p95': percentile(values, 95),
+                'max': values[-1] if values else None,
+            }
+        return {
+            'steps': steps,
+            'bytes': {'read': self.bytes_read, 'uploaded': self.bytes_uploaded},
+            'slowest': [info for total, count, info
+                        in sorted(self._slowest, reverse=True)],
+        }
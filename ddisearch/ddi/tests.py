@@ -18,24 +18,41 @@
 import os
 from copy import copy
 import datetime
+import hashlib
 import shutil
 from StringIO import StringIO
+import tarfile
 import tempfile
-from mock import patch
+import zipfile
+from mock import patch, Mock
+from dateutil import tz
 
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.core.management.base import CommandError
+from django.http import HttpResponse
 from django.test import TestCase
 from django.test.utils import override_settings
 
-from eulxml.xmlmap import load_xmlobject_from_file
+from eulxml.xmlmap import load_xmlobject_from_file, load_xmlobject_from_string
 from eulexistdb import testutil as eulexistdb_testutil
-from eulexistdb.db import ExistDB
+from eulexistdb.db import ExistDB, ExistDBException
+from eulexistdb.exceptions import DoesNotExist
 
 from ddisearch.ddi import models as ddixml
 from ddisearch.ddi.forms import KeywordSearch
-from ddisearch.ddi.management.commands import load
+from ddisearch.ddi.inputs import input_files
+from ddisearch.ddi.journal import LoadJournal
+from ddisearch.ddi.pipeline import Pipeline
+from ddisearch.ddi.stats import LoadStats, percentile
+from ddisearch.ddi.utils import backoff_delay, retry, ddi_etag, ddi_lastmodified, \
+    forget_document_metadata, metadata_cache, LRUCache, page_cache, page_cache_key, \
+    store_documents
+from ddisearch.ddi.validate import validate_date, validate_document
+from ddisearch.geo.models import Location
+from ddisearch.geo.utils import CodebookGeocoder
+from ddisearch.ddi.management.commands import load, validate, geocode_collection, \
+    prewarm_geocode, reprocess_collection
 
 FIXTURE_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
 
@@ -458,6 +475,10 @@ class LoadCommandTest(TestCase):
         for f in self._exist_content:
             self.db.removeDocument(f)
 
+    def _stored(self, db, documents, metadata=None):
+        # simulate all documents stored successfully by store_documents
+        return dict((path, None) for path, xml in documents)
+
     def test_errors(self, mockcbgeocode):
         # config error
         with override_settings(EXISTDB_ROOT_COLLECTION=''):
@@ -467,6 +488,12 @@ class LoadCommandTest(TestCase):
         self.cmd.handle('/tmp/notarealfile.xml')
         self.assert_('Error opening' in self.cmd.stdout.getvalue())
 
+    def test_resume_dry_run(self, mockcbgeocode):
+        # a dry run doesn't record progress, so there is nothing to resume
+        journal_file = tempfile.NamedTemporaryFile(suffix='.db')
+        self.assertRaises(CommandError, self.cmd.handle, self.testfile,
+                          resume=True, journal=journal_file.name, dryrun=True)
+
     def test_load(self, mockcbgeocode):
         tmp = tempfile.NamedTemporaryFile(suffix='.xml', delete=False)
         # delete false to avoid error, since the script will remove
@@ -489,6 +516,212 @@ class LoadCommandTest(TestCase):
         self.assertFalse(os.path.exists(tmp.name),
             'local copy of file should be deleted after loaded to eXist')
 
+    def test_load_parallel(self, mockcbgeocode):
+        tmpfiles = []
+        for i in range(3):
+            tmp = tempfile.NamedTemporaryFile(suffix='.xml', delete=False)
+            shutil.copyfile(self.testfile, tmp.name)
+            tmpfiles.append(tmp.name)
+
+        self.cmd.handle(*tmpfiles, jobs=2)
+
+        for tmpname in tmpfiles:
+            exist_path = '%s/%s' % (settings.EXISTDB_ROOT_COLLECTION,
+                                    os.path.basename(tmpname))
+            self._exist_content.append(exist_path)  # queue for removal in cleanup
+            self.assert_(self.db.hasDocument(exist_path),
+                'each file should be loaded to eXist when running in parallel')
+            self.assertFalse(os.path.exists(tmpname),
+                'local copy of file should be deleted after loaded to eXist')
+        self.assert_('3 documents loaded' in self.cmd.stdout.getvalue())
+        # per-stage counts reported
+        for stage in ['parse', 'prep', 'upload']:
+            self.assert_('%s      3 documents' % stage in self.cmd.stdout.getvalue())
+
+    def test_load_batch(self, mockcbgeocode):
+        tmpfiles = []
+        for i in range(3):
+            tmp = tempfile.NamedTemporaryFile(suffix='.xml', delete=False)
+            shutil.copyfile(self.testfile, tmp.name)
+            tmpfiles.append(tmp.name)
+
+        # batch of two and a partial batch of one
+        self.cmd.handle(*tmpfiles, batch_size=2)
+
+        for tmpname in tmpfiles:
+            exist_path = '%s/%s' % (settings.EXISTDB_ROOT_COLLECTION,
+                                    os.path.basename(tmpname))
+            self._exist_content.append(exist_path)  # queue for removal in cleanup
+            self.assert_(self.db.hasDocument(exist_path),
+                'each file should be loaded to eXist when uploading in batches')
+            self.assertFalse(os.path.exists(tmpname),
+                'local copy of file should be deleted after loaded to eXist')
+        self.assert_('3 documents loaded' in self.cmd.stdout.getvalue())
+
+    def test_load_incremental(self, mockcbgeocode):
+        tmp = tempfile.NamedTemporaryFile(suffix='.xml', delete=False)
+        shutil.copyfile(self.testfile, tmp.name)
+        with open(self.testfile) as xmlfile:
+            digest = hashlib.sha1(xmlfile.read()).hexdigest()
+        ddixml.LoadedDocument.objects.create(
+            document_name=os.path.basename(tmp.name), digest=digest)
+
+        # unchanged file should be skipped without prepping or loading
+        with patch.object(self.cmd, 'prep') as mockprep:
+            self.cmd.handle(tmp.name, incremental=True)
+            self.assertEqual(0, mockprep.call_count,
+                'unchanged document should not be prepped')
+        self.assert_('0 new, 0 changed, 1 unchanged' in self.cmd.stdout.getvalue())
+        self.assertFalse(os.path.exists(tmp.name),
+            'local copy of unchanged file should be removed')
+
+        # changed file should be loaded and digest updated
+        shutil.copyfile(self.testfile, tmp.name)
+        with open(tmp.name, 'a') as xmlfile:
+            xmlfile.write('\n')
+        self.cmd.stdout = StringIO()
+        self.cmd.handle(tmp.name, incremental=True)
+        exist_path = '%s/%s' % (settings.EXISTDB_ROOT_COLLECTION,
+                                os.path.basename(tmp.name))
+        self._exist_content.append(exist_path)  # queue for removal in cleanup
+        self.assert_('0 new, 1 changed, 0 unchanged' in self.cmd.stdout.getvalue())
+        loaded = ddixml.LoadedDocument.objects.get(document_name=os.path.basename(tmp.name))
+        self.assertNotEqual(digest, loaded.digest,
+            'manifest should be updated with digest of newly loaded file')
+        # document metadata should be recorded for conditional requests
+        self.assertEqual(('ICPSR', '2988'), (loaded.agency, loaded.codebook_id))
+        self.assertEqual(40, len(loaded.hash))
+        self.assert_(loaded.last_modified)
+
+    def test_load_resume(self, mockcbgeocode):
+        tmp = tempfile.NamedTemporaryFile(suffix='.xml', delete=False)
+        shutil.copyfile(self.testfile, tmp.name)
+        journal_file = tempfile.NamedTemporaryFile(suffix='.db')
+
+        # resume requires a journal
+        self.assertRaises(CommandError, self.cmd.handle, tmp.name, resume=True)
+
+        # simulate eXist error after the document has been prepped
+        with patch('ddisearch.ddi.management.commands.load.store_documents') as mockstore:
+            mockstore.side_effect = ExistDBException('timed out')
+            self.cmd.handle(tmp.name, journal=journal_file.name)
+
+        entry = LoadJournal(journal_file.name).get(tmp.name)
+        self.assertEqual(LoadJournal.PREPPED, entry['state'])
+        self.assert_('timed out' in entry['error'])
+        self.assert_(os.path.exists(tmp.name),
+            'local copy of file should not be removed when load fails')
+
+        # resume should load the prepped document without prepping again
+        with patch.object(self.cmd, 'prep') as mockprep:
+            self.cmd.handle(tmp.name, journal=journal_file.name, resume=True)
+            self.assertEqual(0, mockprep.call_count,
+                'document should not be prepped again when resuming')
+
+        exist_path = '%s/%s' % (settings.EXISTDB_ROOT_COLLECTION,
+                                os.path.basename(tmp.name))
+        self._exist_content.append(exist_path)  # queue for removal in cleanup
+        self.assert_(self.db.hasDocument(exist_path))
+        self.assertFalse(os.path.exists(tmp.name))
+        entry = LoadJournal(journal_file.name).get(tmp.name)
+        self.assertEqual(LoadJournal.REMOVED, entry['state'])
+        self.assertEqual(None, entry['prepped_xml'],
+            'prepped xml should not be kept in the journal once loaded')
+
+    def test_load_archive(self, mockcbgeocode):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            archive = os.path.join(tmpdir, 'ddi.zip')
+            with zipfile.ZipFile(archive, 'w') as zf:
+                zf.write(self.testfile, 'data/02988-a.xml')
+                zf.write(self.testfile, 'data/02988-b.xml')
+
+            self.cmd.handle(archive)
+
+            for name in ['02988-a.xml', '02988-b.xml']:
+                exist_path = '%s/%s' % (settings.EXISTDB_ROOT_COLLECTION, name)
+                self._exist_content.append(exist_path)  # queue for removal in cleanup
+                self.assert_(self.db.hasDocument(exist_path),
+                    'xml files in an archive should be loaded to eXist')
+            self.assert_('2 documents loaded' in self.cmd.stdout.getvalue())
+            self.assert_(os.path.exists(archive),
+                'archive should not be removed after loading')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @patch('ddisearch.ddi.management.commands.load.store_documents')
+    def test_load_duplicate_names(self, mockstore, mockcbgeocode):
+        mockstore.side_effect = self._stored
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for subdir in ['a', 'b']:
+                os.mkdir(os.path.join(tmpdir, subdir))
+                shutil.copyfile(self.testfile, os.path.join(tmpdir, subdir, '02988.xml'))
+
+            self.cmd.handle(tmpdir)
+            # only the first file is loaded; the second is reported
+            self.assertEqual(1, mockstore.call_count)
+            self.assertEqual(1, len(mockstore.call_args[0][1]))
+            output = self.cmd.stdout.getvalue()
+            self.assert_('Error: %s not loaded; %s is already loaded as' % \
+                (os.path.join(tmpdir, 'b', '02988.xml'),
+                 os.path.join(tmpdir, 'a', '02988.xml')) in output)
+            self.assertFalse(os.path.exists(os.path.join(tmpdir, 'a', '02988.xml')))
+            self.assert_(os.path.exists(os.path.join(tmpdir, 'b', '02988.xml')),
+                'file with a duplicate name should not be removed')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @patch('ddisearch.ddi.management.commands.load.store_documents')
+    def test_load_archive_root(self, mockstore, mockcbgeocode):
+        mockstore.side_effect = self._stored
+        tmpdir = tempfile.mkdtemp()
+        try:
+            archive = os.path.join(tmpdir, 'ddi.zip')
+            with zipfile.ZipFile(archive, 'w') as zf:
+                zf.write(self.testfile, '02988.xml')
+            self.cmd.handle(archive)
+            # named for the archive member, not the archive
+            exist_path = '%s/02988.xml' % settings.EXISTDB_ROOT_COLLECTION
+            self.assertEqual([exist_path],
+                             [path for path, xml in mockstore.call_args[0][1]])
+            self.assert_(ddixml.LoadedDocument.objects.filter(document_name='02988.xml').exists())
+
+            # recognized as unchanged when loading incrementally
+            self.cmd.stdout = StringIO()
+            self.cmd.handle(archive, incremental=True)
+            self.assert_('0 new, 0 changed, 1 unchanged' in self.cmd.stdout.getvalue())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @patch('ddisearch.ddi.management.commands.load.store_documents')
+    def test_load_metadata(self, mockstore, mockcbgeocode):
+        modified = datetime.datetime(2014, 3, 1, 12, 30, tzinfo=tz.tzutc())
+        tmp = tempfile.NamedTemporaryFile(suffix='.xml', delete=False)
+        shutil.copyfile(self.testfile, tmp.name)
+
+        def store(db, documents, metadata=None):
+            metadata.update(dict((path, ('fedcba9876543210fedcba9876543210fedcba98', modified))
+                                 for path, xml in documents))
+            return self._stored(db, documents)
+        mockstore.side_effect = store
+
+        self.cmd.handle(tmp.name)
+        # single request to store the document and get its metadata
+        self.assertEqual(1, mockstore.call_count)
+        # checksum and modification time reported by eXist are recorded
+        loaded = ddixml.LoadedDocument.objects.get(document_name=os.path.basename(tmp.name))
+        self.assertEqual(('ICPSR', '2988'), (loaded.agency, loaded.codebook_id))
+        self.assertEqual('fedcba9876543210fedcba9876543210fedcba98', loaded.hash)
+        self.assertEqual(modified, loaded.last_modified)
+
+        # if eXist doesn't report them, they are left to be looked up later
+        mockstore.side_effect = self._stored
+        shutil.copyfile(self.testfile, tmp.name)
+        self.cmd.handle(tmp.name)
+        loaded = ddixml.LoadedDocument.objects.get(document_name=os.path.basename(tmp.name))
+        self.assertEqual(('', None), (loaded.hash, loaded.last_modified))
+
     def test_load_remove_error(self, mockcbgeocode):
         # simulate error removing local copy of file
         tmp = tempfile.NamedTemporaryFile(suffix='.xml')
@@ -509,6 +742,94 @@ class LoadCommandTest(TestCase):
                                 os.path.basename(tmp.name))
         self._exist_content.append(exist_path)
 
+    @patch('ddisearch.ddi.utils.time.sleep')
+    @patch('ddisearch.ddi.management.commands.load.store_documents')
+    def test_upload_retry(self, mockstore, mocksleep, mockcbgeocode):
+        tmp = tempfile.NamedTemporaryFile(suffix='.xml', delete=False)
+        shutil.copyfile(self.testfile, tmp.name)
+
+        # timeout on first attempt, then success
+        def store(db, documents, metadata=None):
+            if mockstore.call_count == 1:
+                raise ExistDBException('timed out')
+            return self._stored(db, documents)
+        mockstore.side_effect = store
+        self.cmd.handle(tmp.name, retries=2, retry_delay=0.1, verbosity=2)
+        self.assertEqual(2, mockstore.call_count)
+        self.assertEqual(1, mocksleep.call_count)
+        self.assertFalse(os.path.exists(tmp.name),
+            'file should be removed when loaded after retrying')
+
+        # request fails every time; retries exhausted
+        shutil.copyfile(self.testfile, tmp.name)
+        mockstore.reset_mock()
+        mockstore.side_effect = ExistDBException('timed out')
+        self.cmd.stdout = StringIO()
+        self.cmd.handle(tmp.name, retries=2, retry_delay=0.1)
+        self.assertEqual(3, mockstore.call_count)
+        self.assert_('timed out' in self.cmd.stdout.getvalue())
+        self.assert_(os.path.exists(tmp.name),
+            'file should not be removed when load fails')
+
+        # invalid document is not retried
+        mockstore.reset_mock()
+        mockstore.side_effect = lambda db, documents, metadata=None: \
+            dict((path, 'parse error') for path, xml in documents)
+        self.cmd.stdout = StringIO()
+        self.cmd.handle(tmp.name, retries=2, retry_delay=0.1)
+        self.assertEqual(1, mockstore.call_count)
+        os.remove(tmp.name)
+
+    @patch('ddisearch.ddi.management.commands.load.store_documents')
+    def test_dead_letter(self, mockstore, mockcbgeocode):
+        mockstore.side_effect = lambda db, documents, metadata=None: \
+            dict((path, 'parse error') for path, xml in documents)
+        tmp = tempfile.NamedTemporaryFile(suffix='.xml', delete=False)
+        shutil.copyfile(self.testfile, tmp.name)
+        tmpdir = tempfile.mkdtemp()
+        deadletter = os.path.join(tmpdir, 'failed')
+        try:
+            self.cmd.handle(tmp.name, '/tmp/notarealfile.xml',
+                            dead_letter=deadletter, verbosity=2)
+            dest = os.path.join(deadletter, os.path.basename(tmp.name))
+            self.assertFalse(os.path.exists(tmp.name))
+            self.assert_(os.path.exists(dest),
+                'file that failed to load should be moved to dead-letter directory')
+            with open('%s.error' % dest) as errfile:
+                errors = errfile.read()
+            self.assert_(tmp.name in errors)
+            self.assert_('failed to load' in errors)
+            output = self.cmd.stdout.getvalue()
+            self.assert_('Moved %s to %s' % (tmp.name, dest) in output)
+            self.assert_('1 file moved to %s' % deadletter in output,
+                'only files that exist should be moved')
+
+            # archives are not moved because of errors reading them
+            archive = os.path.join(tmpdir, 'bad.zip')
+            with open(archive, 'w') as badzip:
+                badzip.write('not a zip file')
+            self.cmd.stdout = StringIO()
+            self.cmd.handle(archive, dead_letter=deadletter)
+            self.assert_('Error reading archive' in self.cmd.stdout.getvalue())
+            self.assert_(os.path.exists(archive),
+                'archive should not be moved to dead-letter directory')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_load_invalid(self, mockcbgeocode):
+        tmp = tempfile.NamedTemporaryFile(suffix='.xml')
+        with open(self.testfile) as xmlfile:
+            tmp.write(xmlfile.read().replace('agency="ICPSR"', ''))
+        tmp.flush()
+
+        with patch.object(self.cmd, 'prep') as mockprep:
+            self.cmd.handle(tmp.name)
+            self.assertEqual(0, mockprep.call_count,
+                'invalid document should not be prepped')
+        self.assert_('Invalid %s: Missing ID number agency' % tmp.name
+                     in self.cmd.stdout.getvalue())
+        self.assert_(os.path.exists(tmp.name))
+
     def test_icpsr_topic_id(self, mockcbgeocode):
         # icpsr topic picked up correctly
         self.assertEqual('ICPSR.XIV.A.2.b', self.cmd.icpsr_topic_id(self.cb.topics[0].val))
@@ -517,7 +838,8 @@ class LoadCommandTest(TestCase):
 
     def test_local_topics(self, mockcbgeocode):
         topic_count = len(self.cb.topics)
-        self.cmd.local_topics(self.cb)
+        self.assertTrue(self.cmd.local_topics(self.cb),
+            'local_topics should return True when topics are added')
         self.assertEqual(topic_count + 1, len(self.cb.topics),
             'one new local topic should be added to test record')
         self.assertEqual('Elections and Electoral Politics', self.cb.topics[-1].val)
@@ -543,8 +865,57 @@ class LoadCommandTest(TestCase):
             'only one new local topic should be added to test record without  global coverage')
         self.assertEqual('Economic and Financial', self.cb.topics[-1].val)
 
+    def test_prep_document(self, mockcbgeocode):
+        with open(self.testfile) as xmlfile:
+            data = xmlfile.read()
+        self.cmd.pretty = self.cmd.dryrun = False
+        self.cmd.journal = None
+
+        # no changes: original content is used as is
+        result = load.LoadResult(self.testfile, '/db/test.xml')
+        result.cb, result.data = self.cb, data
+        with patch.object(self.cmd, 'prep', return_value=False):
+            self.cmd.prep_document(result)
+        self.assert_(result.xml is data,
+            'original content should be uploaded when prep makes no changes')
+        self.assertEqual(len(data), result.size)
+        self.assertEqual(False, result.modified)
+        self.assertEqual(None, result.cb)
+        self.assertEqual(None, result.data)
+
+        # changes: document is re-serialized compactly, unless pretty is requested
+        for pretty in [False, True]:
+            self.cmd.pretty = pretty
+            result.cb, result.data = self.cb, data
+            with patch.object(self.cmd, 'prep', return_value=True):
+                self.cmd.prep_document(result)
+            self.assertEqual(self.cb.serialize(pretty=pretty), result.xml)
+            self.assertEqual(len(result.xml), result.size)
+            self.assertEqual(True, result.modified)
+
+        # no changes from topics or dates; geocoder determines the result
+        cb = load_xmlobject_from_file(os.path.join(FIXTURE_DIR, '02988.xml'),
+                                      ddixml.CodeBook)
+        del cb.topics
+        self.cmd.cbgeocoder = mockcbgeocode.return_value
+        mockcbgeocode.return_value.code_locations.return_value = False
+        self.assertFalse(self.cmd.prep(cb))
+        mockcbgeocode.return_value.code_locations.return_value = True
+        self.assertTrue(self.cmd.prep(cb))
+
+        # geocoding deferred: geocoder is not used
+        mockcbgeocode.return_value.code_locations.reset_mock()
+        self.cmd.defer_geocode = True
+        timings = {}
+        self.assertFalse(self.cmd.prep(cb, timings))
+        self.assertEqual(0, mockcbgeocode.return_value.code_locations.call_count,
+            'geocoder should not be called when geocoding is deferred')
+        self.assertEqual(['dates', 'topics'], sorted(timings.keys()))
+
     def test_clean_dates(self, mockcbgeocode):
         # fixture has no dates that need cleaning, so modify them
+        self.assertFalse(self.cmd.clean_dates(self.cb),
+            'clean_dates should return False when no dates are changed')
 
         # set first date as a year < 1000; should be converted to 4 digits
         self.cb.time_periods[0].date = '1'
@@ -553,10 +924,664 @@ class LoadCommandTest(TestCase):
         self.cb.time_periods[1].date = '1974'
         self.cb.time_periods[2].date = '02'
 
-        self.cmd.clean_dates(self.cb)
+        self.assertTrue(self.cmd.clean_dates(self.cb),
+            'clean_dates should return True when dates are changed')
         self.assertEqual('0001', self.cb.time_periods[0].date,
             'dates before 1000 should be converted to 4 digits')
         self.assertEqual('1974-02', self.cb.time_periods[2].date,
             'two-digit dates ending a cycle should be converted to month-year')
 
 
+class LoadJournalTest(TestCase):
+
+    def setUp(self):
+        self.tmpfile = tempfile.NamedTemporaryFile(suffix='.db')
+        self.journal = LoadJournal(self.tmpfile.name)
+
+    def tearDown(self):
+        self.journal.close()
+
+    def test_checkpoint(self):
+        self.assertEqual(None, self.journal.get('/tmp/foo.xml'))
+        self.journal.checkpoint('/tmp/foo.xml', LoadJournal.PARSED,
+                                digest='abc', parse_time=0.5)
+        self.journal.checkpoint('/tmp/foo.xml', LoadJournal.PREPPED,
+                                prepped_xml='<codeBook/>', prep_time=1.5)
+        entry = self.journal.get('/tmp/foo.xml')
+        self.assertEqual(LoadJournal.PREPPED, entry['state'])
+        self.assertEqual('abc', entry['digest'])
+        self.assertEqual(0.5, entry['parse_time'])
+        self.assertEqual(1.5, entry['prep_time'])
+        self.assertEqual('<codeBook/>', entry['prepped_xml'])
+
+        # persisted to the file
+        self.assertEqual(LoadJournal.PREPPED,
+                         LoadJournal(self.tmpfile.name).get('/tmp/foo.xml')['state'])
+
+        self.journal.reset('/tmp/foo.xml')
+        self.assertEqual(None, self.journal.get('/tmp/foo.xml'))
+
+
+class PipelineTest(TestCase):
+
+    def test_results(self):
+        pipeline = Pipeline(queue_size=2)
+        pipeline.add_stage('double', lambda items: [i.append(i[0] * 2) for i in items],
+                           workers=3)
+        pipeline.add_stage('batch', lambda items: [i.append(len(items)) for i in items],
+                           workers=2, batch_size=4, accept=lambda i: i[0] % 2 == 0)
+        results = list(pipeline.results([i] for i in range(20)))
+
+        self.assertEqual(20, len(results), 'every item should come out of the pipeline')
+        self.assertEqual(range(20), sorted(r[0] for r in results))
+        for r in results:
+            self.assertEqual(r[0] * 2, r[1])
+            if r[0] % 2:
+                self.assertEqual(2, len(r), 'items not accepted by a stage should pass through')
+            else:
+                self.assert_(1 <= r[2] <= 4, 'items should be processed in batches of up to 4')
+
+        double, batch = pipeline.stages
+        self.assertEqual(20, double.count)
+        self.assertEqual(10, batch.count)
+        self.assert_(pipeline.elapsed > 0)
+
+    def test_error(self):
+        errors = []
+        def fail(items):
+            raise Exception('failed')
+        pipeline = Pipeline()
+        pipeline.add_stage('fail', fail, workers=2,
+                           error=lambda items, err: errors.extend(items))
+        results = list(pipeline.results(range(5)))
+        self.assertEqual(range(5), sorted(results),
+            'items should still come out of the pipeline when a stage fails')
+        self.assertEqual(range(5), sorted(errors))
+
+
+class InputFilesTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        with open(os.path.join(FIXTURE_DIR, '02988.xml')) as xmlfile:
+            self.content = xmlfile.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, content=None):
+        path = os.path.join(self.tmpdir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as outfile:
+            outfile.write(content or self.content)
+        return path
+
+    def test_files(self):
+        # files are returned as is, whether they exist or not
+        inputs = list(input_files(['foo.xml', '/tmp/notarealfile.txt']))
+        self.assertEqual(['foo.xml', '/tmp/notarealfile.txt'], [i.name for i in inputs])
+        self.assertEqual([None, None], [i.data for i in inputs])
+        self.assertEqual([None, None], [i.error for i in inputs])
+        self.assertEqual([None, None], [i.archive for i in inputs])
+        self.assertEqual([None, None], [i.member for i in inputs])
+
+    def test_directory(self):
+        b = self.write('b/1.xml')
+        a2 = self.write('a/2.xml')
+        a1 = self.write('a/nested/1.XML')
+        self.write('a/README.txt')
+        inputs = list(input_files([self.tmpdir]))
+        self.assertEqual([a2, a1, b], [i.name for i in inputs],
+            'xml files should be found recursively, in order')
+
+    def test_zip(self):
+        archive = os.path.join(self.tmpdir, 'ddi.zip')
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.writestr('data/2.xml', self.content)
+            zf.writestr('data/1.xml', self.content)
+            zf.writestr('data/README', 'readme')
+        inputs = list(input_files([archive]))
+        self.assertEqual(['%s:data/1.xml' % archive, '%s:data/2.xml' % archive],
+                         [i.name for i in inputs])
+        self.assertEqual([self.content, self.content], [i.data for i in inputs])
+        self.assertEqual([archive, archive], [i.archive for i in inputs])
+        self.assertEqual(['data/1.xml', 'data/2.xml'], [i.member for i in inputs])
+
+    def test_tar(self):
+        xmlfile = self.write('1.xml')
+        archive = os.path.join(self.tmpdir, 'ddi.tar.gz')
+        tf = tarfile.open(archive, 'w:gz')
+        tf.add(xmlfile, 'data/1.xml')
+        tf.add(self.write('notes.txt', 'notes'), 'data/notes.txt')
+        tf.close()
+        inputs = list(input_files([archive]))
+        self.assertEqual(['%s:data/1.xml' % archive], [i.name for i in inputs])
+        self.assertEqual(self.content, inputs[0].data)
+
+    def test_bad_archive(self):
+        archive = self.write('bad.zip', 'not a zip file')
+        inputs = list(input_files([archive]))
+        self.assertEqual(1, len(inputs))
+        self.assert_(inputs[0].error.startswith('Error reading archive'))
+        self.assertEqual(archive, inputs[0].archive)
+
+    def test_stdin(self):
+        xmlfile = self.write('a/1.xml')
+        stdin = StringIO('%s\n\n%s\n' % (xmlfile, os.path.join(self.tmpdir, 'a')))
+        inputs = list(input_files(['-'], stdin=stdin))
+        self.assertEqual([xmlfile, xmlfile], [i.name for i in inputs],
+            'paths read from stdin should be handled like arguments')
+
+
+class LoadStatsTest(TestCase):
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(50, percentile(values, 50))
+        self.assertEqual(95, percentile(values, 95))
+        self.assertEqual(100, percentile(values, 100))
+        self.assertEqual(1, percentile(values, 0))
+        self.assertEqual(None, percentile([], 50))
+
+    def test_summary(self):
+        stats = LoadStats(['parse', 'upload'], slowest=2)
+        stats.add('a.xml', {'parse': 0.1, 'upload': 0.5}, bytes_read=100,
+                  bytes_uploaded=90)
+        stats.add('b.xml', {'parse': 0.3}, bytes_read=200)
+        stats.add('c.xml', {'parse': 0.2, 'upload': 1.0, 'other': 5}, bytes_read=50,
+                  bytes_uploaded=40)
+        stats.add('d.xml', {})
+        summary = stats.summary()
+
+        self.assertEqual({'count': 3, 'total': 0.1 + 0.3 + 0.2, 'p50': 0.2,
+                          'p95': 0.3, 'max': 0.3}, summary['steps']['parse'])
+        self.assertEqual(2, summary['steps']['upload']['count'])
+        self.assertEqual(1.0, summary['steps']['upload']['max'])
+        self.assert_('other' not in summary['steps'],
+            'only configured steps should be summarized')
+        self.assertEqual({'read': 350, 'uploaded': 130}, summary['bytes'])
+        self.assertEqual(['c.xml', 'a.xml'],
+                         [info['filename'] for info in summary['slowest']],
+            'slowest files should be listed, slowest first')
+        self.assertEqual({'parse': 0.1, 'upload': 0.5}, summary['slowest'][1]['steps'])
+
+        empty = LoadStats(['parse']).summary()
+        self.assertEqual({'count': 0, 'total': 0, 'p50': None, 'p95': None,
+                          'max': None}, empty['steps']['parse'])
+
+
+class ValidateTest(TestCase):
+    testfile = os.path.join(FIXTURE_DIR, '02988.xml')
+
+    def setUp(self):
+        with open(self.testfile) as xmlfile:
+            self.data = xmlfile.read()
+
+    def validate(self, data):
+        return validate_document(StringIO(data))
+
+    def test_validate_date(self):
+        for date in ['1973', '1974-01', '1974-01-13', '1', '02']:
+            self.assertTrue(validate_date(date), '%s should be valid' % date)
+        for date in [None, '', 'n.d.', '1974-13', '1974-01-32', '19740113']:
+            self.assertFalse(validate_date(date), '%s should be invalid' % date)
+
+    def test_validate_document(self):
+        self.assertEqual([], validate_document(self.testfile))
+
+        errors = self.validate(self.data.replace('</codeBook>', ''))
+        self.assertEqual(1, len(errors))
+        self.assert_(errors[0].startswith('Not well-formed'))
+
+        self.assertEqual(['Root element is DDI, not codeBook'],
+                         self.validate('<DDI><codeBook/></DDI>'))
+
+        self.assertEqual(['Missing ID number agency'],
+            self.validate(self.data.replace('agency="ICPSR"', '')))
+        self.assertEqual(["Invalid study ID number: 'ICPSR-2988'"],
+            self.validate(self.data.replace('"ICPSR">2988', '"ICPSR">ICPSR-2988')))
+        self.assertEqual(["Invalid time period date: 'n.d.'"],
+            self.validate(self.data.replace('date="1973"', 'date="n.d."')))
+
+        errors = self.validate('<codeBook/>')
+        self.assert_('Missing study title (titl)' in errors)
+        self.assert_('Missing study ID number (IDNo)' in errors)
+
+    def test_command(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            shutil.copy(self.testfile, tmpdir)
+            with open(os.path.join(tmpdir, 'bad.xml'), 'w') as badfile:
+                badfile.write('<codeBook>')
+            cmd = validate.Command()
+            cmd.stdout = StringIO()
+            cmd.handle(tmpdir, jobs=2)
+            output = cmd.stdout.getvalue()
+            self.assert_('%s: Not well-formed' % os.path.join(tmpdir, 'bad.xml')
+                         in output)
+            self.assert_('2 files checked' in output)
+            self.assert_('1 valid, 1 invalid' in output)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        self.assertRaises(CommandError, cmd.handle)
+
+
+class RetryTest(TestCase):
+
+    def test_backoff_delay(self):
+        for attempt, wait in [(0, 1.0), (1, 2.0), (3, 8.0), (10, 60.0)]:
+            delay = backoff_delay(attempt)
+            self.assert_(wait / 2 <= delay <= wait,
+                'delay for attempt %d should be between %s and %s' % \
+                (attempt, wait / 2, wait))
+        self.assert_(backoff_delay(10, delay=0.5, max_delay=5) <= 5)
+
+    @patch('ddisearch.ddi.utils.time.sleep')
+    def test_retry(self, mocksleep):
+        func = Mock(side_effect=[IOError('busy'), IOError('busy'), 'done'])
+        self.assertEqual(('done', 3), retry(func, retries=3, exceptions=(IOError,)))
+        self.assertEqual(2, mocksleep.call_count)
+
+        # retries exhausted; last error is raised
+        func = Mock(side_effect=IOError('busy'))
+        self.assertRaises(IOError, retry, func, retries=2, exceptions=(IOError,))
+        self.assertEqual(3, func.call_count)
+
+        # other errors are not retried
+        func = Mock(side_effect=ValueError('bad'))
+        self.assertRaises(ValueError, retry, func, retries=2, exceptions=(IOError,))
+        self.assertEqual(1, func.call_count)
+
+
+class DocumentMetadataTest(TestCase):
+
+    def setUp(self):
+        metadata_cache().clear()
+        self.modified = datetime.datetime(2014, 3, 1, 12, 30, tzinfo=tz.tzutc())
+
+    def tearDown(self):
+        metadata_cache().clear()
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        # least recently used is discarded
+        cache.set('c', 3)
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(2, len(cache))
+        cache.delete('a')
+        self.assertEqual('x', cache.get('a', 'x'))
+
+        cache = LRUCache(2, ttl=0)
+        cache.set('a', 1)
+        self.assertEqual(None, cache.get('a'))
+
+    @patch('ddisearch.ddi.utils.CodeBook')
+    def test_local_metadata(self, mockcodebook):
+        ddixml.LoadedDocument.objects.create(document_name='02988.xml',
+            digest='abc', agency='ICPSR', codebook_id='2988',
+            hash='0123456789abcdef0123456789abcdef01234567',
+            last_modified=self.modified)
+        self.assertEqual('0123456789abcdef0123456789abcdef01234567',
+                         ddi_etag(None, 'ICPSR', '2988'))
+        # cached in memory; no database query
+        with self.assertNumQueries(0):
+            self.assertEqual(self.modified, ddi_lastmodified(None, 'ICPSR', '2988'))
+        self.assertEqual(0, mockcodebook.objects.filter.call_count,
+            'eXist should not be queried when metadata is recorded locally')
+
+    @patch('ddisearch.ddi.utils.CodeBook')
+    def test_exist_metadata(self, mockcodebook):
+        res = mockcodebook.objects.filter.return_value.only.return_value
+        res.count.return_value = 1
+        res.__getitem__.return_value = Mock(hash='fedcba9876543210fedcba9876543210fedcba98',
+            last_modified=datetime.datetime(2014, 3, 1, 12, 30),
+            document_name='02988.xml')
+        with override_settings(EXISTDB_SERVER_TIMEZONE=tz.tzutc()):
+            self.assertEqual('fedcba9876543210fedcba9876543210fedcba98',
+                             ddi_etag(None, 'ICPSR', '2988'))
+            self.assertEqual(self.modified, ddi_lastmodified(None, 'ICPSR', '2988'))
+        self.assertEqual(1, mockcodebook.objects.filter.call_count,
+            'eXist should be queried once for both hash and last modified')
+
+        # recorded locally for next time
+        metadata_cache().clear()
+        loaded = ddixml.LoadedDocument.objects.get(document_name='02988.xml')
+        self.assertEqual(('ICPSR', '2988'), (loaded.agency, loaded.codebook_id))
+        self.assertEqual(loaded.hash, ddi_etag(None, 'ICPSR', '2988'))
+        self.assertEqual(1, mockcodebook.objects.filter.call_count)
+
+        # changes made in eXist clear the recorded metadata
+        forget_document_metadata(['/db/ddi_data/02988.xml'])
+        loaded = ddixml.LoadedDocument.objects.get(document_name='02988.xml')
+        self.assertEqual(('', None), (loaded.hash, loaded.last_modified))
+        ddi_etag(None, 'ICPSR', '2988')
+        self.assertEqual(2, mockcodebook.objects.filter.call_count)
+
+        # not found
+        res.count.return_value = 0
+        self.assertEqual(None, ddi_etag(None, 'ICPSR', '0000'))
+        self.assertEqual(None, ddi_lastmodified(None, 'ICPSR', '0000'))
+
+    @patch('ddisearch.ddi.utils.post_xquery')
+    def test_stored_metadata(self, mockpostxquery):
+        mockpostxquery.return_value = '''<results>
+            <stored path="/db/ddi_data/02988.xml" hash="fedcba9876543210fedcba9876543210fedcba98"
+                last_modified="2014-03-01T12:30:00.000-05:00"/>
+            <failed path="/db/ddi_data/00001.xml">err:FODC0006: parse error</failed>
+        </results>'''
+        metadata = {}
+        with override_settings(EXISTDB_SERVER_TIMEZONE=tz.tzutc()):
+            status = store_documents(Mock(), [('ddi_data/02988.xml', '<codeBook/>'),
+                                              ('ddi_data/00001.xml', '<codeBook')],
+                                     metadata=metadata)
+            self.assertEqual(None, status['ddi_data/02988.xml'])
+            self.assert_('parse error' in status['ddi_data/00001.xml'])
+            # keyed on path as requested; only for stored documents
+            self.assertEqual({'ddi_data/02988.xml':
+                ('fedcba9876543210fedcba9876543210fedcba98', self.modified)}, metadata)
+            xquery = mockpostxquery.call_args[0][1]
+            self.assert_('util:hash($doc, \'SHA-1\')' in xquery,
+                'checksum should be calculated the same way as eulexistdb hash field')
+
+
+@patch('ddisearch.ddi.views.render')
+@patch('ddisearch.ddi.views.CodeBook')
+class ResourcePageCacheTest(TestCase):
+
+    def setUp(self):
+        metadata_cache().clear()
+        page_cache().clear()
+        self.doc = ddixml.LoadedDocument.objects.create(document_name='02988.xml',
+            digest='abc', agency='ICPSR', codebook_id='2988',
+            hash='0123456789abcdef0123456789abcdef01234567',
+            last_modified=datetime.datetime(2014, 3, 1, 12, 30, tzinfo=tz.tzutc()))
+        self.url = reverse('ddi:resource', kwargs={'agency': 'ICPSR', 'id': '2988'})
+
+    def tearDown(self):
+        metadata_cache().clear()
+        page_cache().clear()
+
+    def test_resource(self, mockcodebook, mockrender):
+        mockrender.return_value = HttpResponse('<html>study 2988</html>')
+        response = self.client.get(self.url)
+        self.assertContains(response, 'study 2988')
+        self.assertEqual('"%s"' % self.doc.hash, response['ETag'])
+        self.assertEqual(1, mockcodebook.objects.get.call_count)
+
+        # rendered page is cached; eXist is not queried again
+        mockrender.return_value = HttpResponse('<html>changed</html>')
+        response = self.client.get(self.url)
+        self.assertContains(response, 'study 2988')
+        self.assertEqual('"%s"' % self.doc.hash, response['ETag'])
+        self.assertEqual(1, mockcodebook.objects.get.call_count)
+
+        # conditional request
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH='"%s"' % self.doc.hash)
+        self.assertEqual(304, response.status_code)
+
+        # document changed in eXist: cached page is removed
+        forget_document_metadata(['02988.xml'])
+        self.assertEqual(None, page_cache().get(page_cache_key('ICPSR', '2988', self.doc.hash)))
+
+    def test_not_cached(self, mockcodebook, mockrender):
+        mockrender.return_value = HttpResponse('<html>study 2988</html>')
+        # unknown document checksum
+        with patch('ddisearch.ddi.views.document_metadata') as mockmetadata:
+            mockmetadata.return_value = None
+            self.client.get(self.url)
+            self.client.get(self.url)
+        self.assertEqual(2, mockcodebook.objects.get.call_count)
+
+        # page caching disabled
+        with override_settings(DDI_PAGE_CACHE=None):
+            self.client.get(self.url)
+            self.client.get(self.url)
+        self.assertEqual(4, mockcodebook.objects.get.call_count)
+
+        # not found
+        mockcodebook.objects.get.side_effect = DoesNotExist
+        page_cache().clear()
+        self.assertEqual(404, self.client.get(self.url).status_code)
+
+
+@patch('ddisearch.ddi.management.commands.geocode_collection.CodebookGeocoder')
+@patch('ddisearch.ddi.management.commands.geocode_collection.post_xquery')
+class GeocodeCollectionTest(TestCase):
+
+    found = '''<exist:result xmlns:exist="http://exist.sourceforge.net/NS/exist">
+    <documents><document path="/db/ddi_data/a.xml"/><document path="/db/ddi_data/b.xml"/></documents>
+    </exist:result>'''
+    coverage = '''<exist:result xmlns:exist="http://exist.sourceforge.net/NS/exist">
+    <documents>
+        <document path="/db/ddi_data/a.xml"><geogCover>Israel</geogCover><geogCover>Global</geogCover></document>
+        <document path="/db/ddi_data/b.xml"><geogCover id="geonames:1">Africa</geogCover><geogCover>Atlantis</geogCover></document>
+    </documents></exist:result>'''
+    patched = '''<exist:result xmlns:exist="http://exist.sourceforge.net/NS/exist">
+    <results><patched path="/db/ddi_data/a.xml"/></results></exist:result>'''
+
+    def setUp(self):
+        self.cmd = geocode_collection.Command()
+        self.cmd.stdout = StringIO()
+
+    def code_locations(self, doc):
+        # simulate geocoding: only Israel can be found
+        for geog in doc.geo_coverage:
+            if geog.val == 'Israel':
+                geog.id = 'geonames:294640'
+
+    def test_geocode(self, mockpost, mockgeocoder):
+        mockgeocoder.return_value.code_locations.side_effect = self.code_locations
+        mockpost.side_effect = [self.found, self.coverage, self.patched]
+
+        self.cmd.handle()
+
+        self.assertEqual(3, mockpost.call_count)
+        find_query = mockpost.call_args_list[0][0][1]
+        self.assert_('collection("/db%s")' % settings.EXISTDB_ROOT_COLLECTION in find_query)
+        coverage_query = mockpost.call_args_list[1][0][1]
+        self.assert_('"/db/ddi_data/a.xml", "/db/ddi_data/b.xml"' in coverage_query)
+
+        # only the new id is added, to the document where one was found
+        patch_query = mockpost.call_args_list[2][0][1]
+        self.assert_('doc("/db/ddi_data/a.xml")' in patch_query)
+        self.assert_('$covers[1][not(@id)][. = "Israel"]' in patch_query)
+        self.assert_('update insert attribute id {"geonames:294640"}' in patch_query)
+        self.assert_('b.xml' not in patch_query,
+            'documents with no new ids should not be updated')
+
+        output = self.cmd.stdout.getvalue()
+        self.assert_('2 documents to geocode' in output)
+        self.assert_('2 documents geocoded, 1 updated, 0 with errors' in output)
+        self.assert_('1 locations coded, 1 not found' in output)
+
+    def test_dry_run(self, mockpost, mockgeocoder):
+        mockgeocoder.return_value.code_locations.side_effect = self.code_locations
+        mockpost.side_effect = [self.found, self.coverage]
+        self.cmd.handle(dryrun=True)
+        self.assertEqual(2, mockpost.call_count,
+            'documents should not be updated in dry-run mode')
+        self.assert_('2 documents geocoded, 0 updated' in self.cmd.stdout.getvalue())
+
+    def test_errors(self, mockpost, mockgeocoder):
+        mockpost.side_effect = ExistDBException('connection refused')
+        self.assertRaises(CommandError, self.cmd.handle)
+
+        # geocoding error for one document doesn't stop the others
+        mockgeocoder.return_value.code_locations.side_effect = \
+            [Exception('GeoNames unavailable'), None]
+        mockpost.side_effect = [self.found, self.coverage]
+        self.cmd.handle()
+        output = self.cmd.stdout.getvalue()
+        self.assert_('Error geocoding /db/ddi_data/a.xml: GeoNames unavailable' in output)
+        self.assert_('1 documents geocoded, 0 updated, 1 with errors' in output)
+
+
+@patch.object(CodebookGeocoder, 'resolve_term')
+@patch('ddisearch.ddi.management.commands.prewarm_geocode.post_xquery')
+class PrewarmGeocodeTest(TestCase):
+
+    coverage = '''<exist:result xmlns:exist="http://exist.sourceforge.net/NS/exist">
+    <coverage><names count="3">Israel\tGlobal</names><names count="2">Israel\tAtlantis</names>
+    <names count="1">Georgia\tAlabama\tUnited States</names></coverage></exist:result>'''
+
+    def setUp(self):
+        self.cmd = prewarm_geocode.Command()
+        self.cmd.stdout = StringIO()
+        self.tmpdir = tempfile.mkdtemp()
+        self.israel = Location.objects.create(name='Israel', geonames_id=294640,
+            latitude=31.5, longitude=34.75, feature_code='PCLI')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def resolve_term(self, term, cache=None):
+        # simulate geocoding: only Israel can be found
+        if term[0] == 'Israel':
+            return 294640, None
+        return None, None
+
+    def write(self, name, *names):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as outfile:
+            outfile.write('<codeBook><stdyDscr><stdyInfo><sumDscr>%s</sumDscr></stdyInfo></stdyDscr></codeBook>' \
+                % ''.join('<geogCover>%s</geogCover>' % n for n in names))
+        return path
+
+    def test_collection(self, mockpost, mocklookup):
+        mocklookup.side_effect = self.resolve_term
+        mockpost.return_value = self.coverage
+        self.cmd.handle(jobs=1)
+
+        query = mockpost.call_args[0][1]
+        self.assert_('collection("/db%s")' % settings.EXISTDB_ROOT_COLLECTION in query)
+        # each distinct term is looked up once
+        self.assertEqual(5, mocklookup.call_count)
+        terms = [args[0][0] for args in mocklookup.call_args_list]
+        self.assertEqual(['Israel', 'Atlantis', 'Georgia', 'Alabama', 'United States'],
+                         [t[0] for t in terms])
+        # terms are looked up in the context of the rest of the document
+        self.assertEqual(('Georgia', False, (('admin_code1', 'GA'), ('country', 'US'))),
+                         terms[2])
+
+        output = self.cmd.stdout.getvalue()
+        self.assert_('5 distinct place names to geocode' in output)
+        self.assert_('1 resolved, 4 not found, 0 errors' in output)
+        self.assert_('Not found: Atlantis (2 documents)' in output)
+        self.assert_('Not found: Georgia [admin_code1=GA, country=US] (1 document)' in output)
+        self.assert_(output.index('Atlantis') < output.index('Georgia'),
+            'most used unresolved names should be listed first')
+
+    def test_files(self, mockpost, mocklookup):
+        mocklookup.side_effect = self.resolve_term
+        self.write('a.xml', 'Israel', 'Global')
+        self.write('b.xml', 'Israel', 'Atlantis')
+        self.write('c.xml', 'Israel', 'Global')
+        self.write('d.xml')
+        with open(os.path.join(self.tmpdir, 'e.xml'), 'w') as outfile:
+            outfile.write('<codeBook>')
+
+        self.cmd.handle(self.tmpdir, jobs=1)
+        self.assertEqual(0, mockpost.call_count)
+        self.assertEqual(['Israel', 'Atlantis'],
+                         [args[0][0][0] for args in mocklookup.call_args_list])
+        output = self.cmd.stdout.getvalue()
+        self.assert_('Error reading %s' % os.path.join(self.tmpdir, 'e.xml') in output)
+        self.assert_('4 documents read' in output)
+        self.assert_('Not found: Atlantis (1 document)' in output)
+
+    def test_errors(self, mockpost, mocklookup):
+        mockpost.side_effect = ExistDBException('connection refused')
+        self.assertRaises(CommandError, self.cmd.handle, jobs=1)
+
+        # geocoding error for one name doesn't stop the others
+        mockpost.side_effect = None
+        mockpost.return_value = self.coverage
+        mocklookup.side_effect = [Exception('GeoNames unavailable')] + [(None, None)] * 4
+        self.cmd.handle(jobs=1)
+        output = self.cmd.stdout.getvalue()
+        self.assert_('Error geocoding Israel: GeoNames unavailable' in output)
+        self.assert_('0 resolved, 4 not found, 1 errors' in output)
+
+@patch('ddisearch.ddi.management.commands.reprocess_collection.store_documents')
+@patch('ddisearch.ddi.management.commands.reprocess_collection.post_xquery')
+class ReprocessCollectionTest(TestCase):
+
+    local_topic = '<topcClas vocab="local">%s</topcClas>'
+
+    def setUp(self):
+        self.cmd = reprocess_collection.Command()
+        self.cmd.stdout = StringIO()
+        with open(os.path.join(FIXTURE_DIR, '02988.xml')) as xmlfile:
+            content = xmlfile.read()
+        subject_end = content.index('</subject>')
+        def with_topic(topic):
+            return content[:subject_end] + self.local_topic % topic + content[subject_end:]
+
+        self.listing = \
+            '<exist:result xmlns:exist="http://exist.sourceforge.net/NS/exist"><documents>' + \
+            ''.join('<document path="/db/ddi_data/%s.xml"/>' % n for n in 'abc') + \
+            '</documents></exist:result>'
+        # a has no local topics; b has current local topics; c has an outdated topic
+        self.documents = {
+            '/db/ddi_data/a.xml': content,
+            '/db/ddi_data/b.xml': with_topic('Elections and Electoral Politics'),
+            '/db/ddi_data/c.xml': with_topic('Old Topic'),
+        }
+
+    def query(self, db, xquery):
+        # simulate xquery results for listing and retrieving documents
+        if 'collection(' in xquery:
+            return self.listing
+        return '<exist:result xmlns:exist="http://exist.sourceforge.net/NS/exist"><documents>' + \
+            ''.join('<document path="%s">%s</document>' % (path, content)
+                    for path, content in self.documents.iteritems()
+                    if '"%s"' % path in xquery) + \
+            '</documents></exist:result>'
+
+    def test_reprocess(self, mockpost, mockstore):
+        mockpost.side_effect = self.query
+        mockstore.side_effect = lambda db, docs: dict((path, None) for path, xml in docs)
+
+        self.cmd.handle(jobs=2, batch_size=2)
+
+        stored = {}
+        for args, kwargs in mockstore.call_args_list:
+            stored.update(dict(args[1]))
+        self.assertEqual(['/db/ddi_data/a.xml', '/db/ddi_data/c.xml'], sorted(stored.keys()),
+            'only changed documents should be stored')
+        cb = load_xmlobject_from_string(stored['/db/ddi_data/c.xml'], ddixml.CodeBook)
+        self.assertEqual(['Elections and Electoral Politics'],
+                         [t.val for t in cb.topics if t.vocab == 'local'],
+            'outdated local topics should be replaced with current ones')
+        self.assert_('3 documents processed, 2 changed, 2 updated, 0 with errors'
+                     in self.cmd.stdout.getvalue())
+
+    def test_dry_run(self, mockpost, mockstore):
+        mockpost.side_effect = self.query
+        self.cmd.handle(dryrun=True)
+
+        self.assertEqual(0, mockstore.call_count,
+            'documents should not be stored in dry-run mode')
+        output = self.cmd.stdout.getvalue()
+        self.assert_('--- /db/ddi_data/c.xml' in output)
+        self.assert_('-topcClas local: Old Topic' in output)
+        self.assert_('+topcClas local: Elections and Electoral Politics' in output)
+        self.assert_('/db/ddi_data/b.xml' not in output)
+        self.assert_('3 documents processed, 2 changed, 0 with errors' in output)
+
+    def test_errors(self, mockpost, mockstore):
+        mockpost.side_effect = ExistDBException('connection refused')
+        self.assertRaises(CommandError, self.cmd.handle)
+
+        mockpost.side_effect = self.query
+        mockstore.side_effect = ExistDBException('timeout')
+        self.cmd.handle()
+        output = self.cmd.stdout.getvalue()
+        self.assert_('Error storing /db/ddi_data/a.xml: timeout' in output)
+        self.assert_('3 documents processed, 2 changed, 0 updated, 2 with errors' in output)
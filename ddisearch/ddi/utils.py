@@ -14,37 +14,52 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from collections import OrderedDict
 from datetime import datetime
+import hashlib
+import logging
+import os
+import random
+import threading
+import time
+from xml.sax.saxutils import escape
 from django.conf import settings
-from ddisearch.ddi.models import CodeBook
+from django.core.cache import caches
+import requests
+from eulexistdb.db import ExistDBException
+from eulxml import xmlmap
+from ddisearch.ddi.models import CodeBook, LoadedDocument
+
+logger = logging.getLogger(__name__)
 
 
 def ddi_lastmodified(request, agency, id):
     """Get the last modification time for a DDI document in eXist by agency and id.
     Used to generate last-modified header for views based on a single EAD document.
+    Uses the local document metadata; see :func:`document_metadata`.
 
     :param id: eadid
     :param preview: load document from preview collection; defaults to False
     :rtype: :class:`datetime.datetime`
     """
-    # get document last modified by
-    res = CodeBook.objects.filter(id__val=id, id__agency=agency).only('last_modified')
-    if res.count():
-        return exist_datetime_with_timezone(res[0].last_modified)
+    doc = document_metadata(agency, id)
+    if doc is not None:
+        return doc.last_modified
 
 def ddi_etag(request, agency, id):
     """Generate a DDI Codebook document (specified by agency and id) by
-    requesting a SHA-1 checksum of the entire DDI xml document from eXist.
+    SHA-1 checksum of the entire DDI xml document, from the local document
+    metadata; see :func:`document_metadata`.
 
     :param request:  http request
     :param agency:  agency code
     :param id:  id number
     :rtype: string
     """
-    res = CodeBook.objects.filter(id__val=id, id__agency=agency).only('hash')
+    doc = document_metadata(agency, id)
     # don't error if not found, but just let it fall through to view
-    if res.count():
-        return res[0].hash
+    if doc is not None:
+        return doc.hash or None
 
 def collection_lastmodified(request, *args, **kwargs):
     """Get the last modification time for the entire eXist collection.
@@ -60,6 +75,164 @@ def collection_lastmodified(request, *args, **kwargs):
         return exist_datetime_with_timezone(res[0].last_modified)
 
 
+class LRUCache(object):
+    '''Simple thread-safe least-recently-used cache, with an optional
+    time limit on entries.
+
+    :param size: maximum number of entries
+    :param ttl: optional number of seconds entries are used for
+    '''
+
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        'Cached value for a key, or the default if not cached or expired.'
+        with self._lock:
+            try:
+                value, cached = self._entries.pop(key)
+            except KeyError:
+                return default
+            if self.ttl is not None and time.time() - cached > self.ttl:
+                return default
+            # most recently used last
+            self._entries[key] = (value, cached)
+            return value
+
+    def set(self, key, value):
+        'Cache a value, discarding the least recently used value if full.'
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time())
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        'Remove a key from the cache, if present.'
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        'Remove everything from the cache.'
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_metadata_cache = None
+_metadata_cache_lock = threading.Lock()
+# marker for documents not in the metadata cache; None is cached for
+# documents that were not found
+_not_cached = object()
+
+
+def metadata_cache():
+    '''Process-wide :class:`LRUCache` for :func:`document_metadata`; size
+    and time limit are configured with **DDI_METADATA_CACHE_SIZE** (default
+    1000 documents) and **DDI_METADATA_CACHE_TTL** (default 60 seconds),
+    which limits how long changes made by other processes (e.g., the load
+    script) take to be seen.'''
+    global _metadata_cache
+    with _metadata_cache_lock:
+        if _metadata_cache is None:
+            _metadata_cache = LRUCache(
+                getattr(settings, 'DDI_METADATA_CACHE_SIZE', 1000),
+                ttl=getattr(settings, 'DDI_METADATA_CACHE_TTL', 60))
+        return _metadata_cache
+
+
+def document_metadata(agency, id):
+    '''Hash and last modification time for a DDI document, by agency and
+    id, for conditional requests.  Looks in the in-process
+    :func:`metadata_cache` first, then at the metadata recorded by the load
+    script (:class:`~ddisearch.ddi.models.LoadedDocument`).  Only if the
+    document has no metadata recorded (e.g., it was loaded before metadata
+    was kept, or it was cleared by :func:`forget_document_metadata`) is
+    eXist queried, in a single query, and the result recorded for next time.
+
+    :returns: :class:`~ddisearch.ddi.models.LoadedDocument`, or None if
+        the document is not found
+    '''
+    cache = metadata_cache()
+    key = (agency, id)
+    doc = cache.get(key, _not_cached)
+    if doc is _not_cached:
+        doc = LoadedDocument.objects.filter(agency=agency, codebook_id=id) \
+            .exclude(hash='').order_by('-loaded').first()
+        if doc is None:
+            doc = exist_document_metadata(agency, id)
+        cache.set(key, doc)
+    return doc
+
+
+def exist_document_metadata(agency, id):
+    '''Get the hash and last modification time for a DDI document from
+    eXist, and record them in the local document metadata.
+
+    :returns: :class:`~ddisearch.ddi.models.LoadedDocument`, or None if
+        the document is not found
+    '''
+    res = CodeBook.objects.filter(id__val=id, id__agency=agency) \
+        .only('hash', 'last_modified', 'document_name')
+    if not res.count():
+        return None
+    cb = res[0]
+    doc, created = LoadedDocument.objects.update_or_create(
+        document_name=cb.document_name,
+        defaults={'agency': agency, 'codebook_id': id, 'hash': cb.hash,
+                  'last_modified': exist_datetime_with_timezone(cb.last_modified)})
+    return doc
+
+
+def forget_document_metadata(paths):
+    '''Clear the recorded hash and modification time for documents that
+    were changed in eXist other than by the load script (e.g., by
+    ``geocode_collection``), so that they are looked up in eXist again
+    when next needed; see :func:`document_metadata`.
+
+    :param paths: list of document paths or names in eXist
+    '''
+    names = [os.path.basename(path) for path in paths]
+    if not names:
+        return
+    docs = LoadedDocument.objects.filter(document_name__in=names)
+    cache = metadata_cache()
+    for agency, codebook_id, hash in docs.values_list('agency', 'codebook_id', 'hash'):
+        cache.delete((agency, codebook_id))
+        forget_cached_page(agency, codebook_id, hash)
+    docs.update(hash='', last_modified=None)
+
+
+def page_cache():
+    '''Django cache for rendered single-document pages, as configured by
+    **DDI_PAGE_CACHE** (the name of one of the configured **CACHES**);
+    None if page caching is disabled.'''
+    name = getattr(settings, 'DDI_PAGE_CACHE', None)
+    if name and name in getattr(settings, 'CACHES', {}):
+        return caches[name]
+
+
+def page_cache_key(agency, id, hash):
+    '''Page cache key for a rendered single-document page.  Includes the
+    document checksum, so a changed document is never served from an
+    outdated page.'''
+    return 'ddi-resource:%s' % hashlib.sha1(
+        '\n'.join([agency, id, hash]).encode('utf-8')).hexdigest()
+
+
+def forget_cached_page(agency, id, hash):
+    '''Remove a rendered single-document page from the page cache (e.g.,
+    when the document is reloaded), if it is cached.'''
+    cache = page_cache()
+    if cache is not None and hash:
+        cache.delete(page_cache_key(agency, id, hash))
+
+
 def exist_datetime_with_timezone(dt):
     """Convert an 'offset-naive' datetime object into an 'offset-aware' datetime
     using a configured timezone.
@@ -72,3 +245,176 @@ def exist_datetime_with_timezone(dt):
     # use the exist time and configured timezone to create a timezone-aware datetime
     return datetime(dt.year, dt.month, dt.day, dt.hour, dt.minute,
                     dt.second, dt.microsecond, tz)
+
+
+# xquery to store multiple documents in a single request; each document is
+# stored separately so that one failure doesn't prevent the others from
+# being loaded, and the outcome is reported per document.  Checksum and
+# modification time are calculated the same way as the eulexistdb
+# ``hash`` and ``last_modified`` fields, so that they match values
+# queried from eXist later (see :func:`exist_document_metadata`)
+_store_xquery = '''xquery version "3.0";
+declare function local:metadata($path as xs:string) {
+    let $doc := doc($path)/*
+    return <stored path="{$path}" hash="{util:hash($doc, 'SHA-1')}"
+        last_modified="{xmldb:last-modified(util:collection-name($doc),
+                                            util:document-name($doc))}"/>
+};
+declare function local:store($path as xs:string, $xml as xs:string) {
+    try {
+        let $collection := replace($path, '/[^/]+$', '')
+        let $name := replace($path, '^.*/', '')
+        let $stored := xmldb:store($collection, $name, util:parse($xml))
+        return if ($stored) then local:metadata($path)
+            else <failed path="{$path}">not stored</failed>
+    } catch * {
+        <failed path="{$path}">{$err:code}: {$err:description}</failed>
+    }
+};
+<results>{ (%s) }</results>'''
+
+_query_template = '''<query xmlns="http://exist.sourceforge.net/NS/exist">
+<text>%s</text>
+</query>'''
+
+
+class StoredDocument(xmlmap.XmlObject):
+    'Checksum and modification time for a document stored in eXist'
+    #: full database path
+    path = xmlmap.StringField('@path')
+    #: SHA-1 checksum of the root element, as calculated by eXist
+    hash = xmlmap.StringField('@hash')
+    #: last modification time, as reported by eXist
+    last_modified = xmlmap.DateTimeField('@last_modified')
+
+
+class StoreResults(xmlmap.XmlObject):
+    'Per-document results returned by :func:`store_documents` xquery'
+    #: :class:`StoredDocument` for each document stored successfully
+    documents = xmlmap.NodeListField('//stored', StoredDocument)
+    #: paths for documents that were stored successfully
+    stored = xmlmap.StringListField('//stored/@path')
+    #: paths for documents that could not be stored
+    failed = xmlmap.StringListField('//failed/@path')
+    #: error messages for documents that could not be stored
+    errors = xmlmap.StringListField('//failed')
+
+
+def xquery_string(val):
+    # escape a value for use as an xquery string literal
+    return '"%s"' % val.replace('&', '&amp;').replace('"', '&quot;')
+
+
+def db_path(path):
+    '''Full eXist database path (starting with ``/db/``) for a path
+    relative to the database root, e.g. a path based on
+    **EXISTDB_ROOT_COLLECTION**.'''
+    if not path.startswith('/db/'):
+        path = '/db/%s' % path.lstrip('/')
+    return path
+
+
+def post_xquery(db, xquery):
+    '''Run an xquery via the eXist REST API, as a POST request, so that
+    large queries (e.g., including document content) are not limited by
+    URL length.  The query should return a single result element, since
+    only the first few results are returned.
+
+    :param db: :class:`~eulexistdb.db.ExistDB` instance
+    :param xquery: xquery to run
+    :returns: response content, as a string
+    :raises: :class:`~eulexistdb.db.ExistDBException` if the request fails
+    '''
+    query = _query_template % escape(xquery)
+    try:
+        response = db.session.post(db.restapi_path('/db'),
+            data=query.encode('utf-8'),
+            headers={'Content-Type': 'application/xml; charset=UTF-8'},
+            timeout=getattr(settings, 'EXISTDB_TIMEOUT', None))
+    except requests.exceptions.RequestException as err:
+        raise ExistDBException(err)
+    if response.status_code != requests.codes.ok:
+        raise ExistDBException(response.content)
+    return response.content
+
+
+def store_documents(db, documents, metadata=None):
+    '''Load multiple documents to eXist in a single request, rather than
+    one round trip per document.  Existing documents are overwritten.
+
+    :param db: :class:`~eulexistdb.db.ExistDB` instance
+    :param documents: list of tuples of database path and document
+        contents (utf-8 encoded xml)
+    :param metadata: optional dictionary, updated with the checksum and
+        (timezone-aware) last modification time of each stored document
+        as reported by eXist, keyed on database path as requested
+    :returns: dictionary keyed on database path; value is None if the
+        document was stored successfully, or an error message if not
+    :raises: :class:`~eulexistdb.db.ExistDBException` if the request
+        as a whole fails
+    '''
+    calls = []
+    # full database path, as reported in the results -> path as requested
+    paths = {}
+    for path, xml in documents:
+        dbpath = db_path(path)
+        paths[dbpath] = path
+        calls.append('local:store(%s, %s)' % (xquery_string(dbpath),
+                                              xquery_string(xml.decode('utf-8'))))
+    xquery = _store_xquery % ',\n'.join(calls)
+    response = post_xquery(db, xquery)
+
+    results = xmlmap.load_xmlobject_from_string(response, StoreResults)
+    status = dict((paths[path], None) for path in results.stored)
+    status.update(dict((paths[path], err)
+                       for path, err in zip(results.failed, results.errors)))
+    if metadata is not None:
+        metadata.update(dict(
+            (paths[doc.path], (doc.hash, exist_datetime_with_timezone(doc.last_modified)))
+            for doc in results.documents
+            if doc.path in paths and doc.hash and doc.last_modified is not None))
+    # anything not reported on was not stored
+    for path, xml in documents:
+        if path not in status:
+            status[path] = 'No result returned for %s' % path
+    return status
+
+
+def backoff_delay(attempt, delay=1.0, max_delay=60.0):
+    '''Time to wait before retrying after a failed attempt: exponential
+    backoff, capped at a maximum, with random jitter so that parallel
+    workers don't all retry at the same time.
+
+    :param attempt: number of the attempt that failed, starting with 0
+    :param delay: base delay in seconds
+    :param max_delay: maximum delay in seconds, before jitter
+    '''
+    wait = min(max_delay, delay * (2 ** attempt))
+    return random.uniform(wait / 2.0, wait)
+
+
+def retry(func, retries=0, delay=1.0, max_delay=60.0, exceptions=(Exception,)):
+    '''Call a function, retrying with exponential backoff (see
+    :func:`backoff_delay`) if it fails with one of the specified
+    exceptions.  If it still fails after all retries, the last
+    exception is raised.
+
+    :param func: function to call, with no arguments
+    :param retries: maximum number of times to retry
+    :param delay: base delay in seconds
+    :param max_delay: maximum delay in seconds
+    :param exceptions: tuple of exception classes that should be retried
+    :returns: tuple of the function return value and the number of
+        attempts it took
+    '''
+    attempt = 0
+    while True:
+        try:
+            return func(), attempt + 1
+        except exceptions as err:
+            if attempt >= retries:
+                raise
+            wait = backoff_delay(attempt, delay, max_delay)
+            logger.warn('%s; retrying in %.1f sec', err, wait)
+            time.sleep(wait)
+            attempt += 1
@@ -0,0 +1,123 @@
+# file ddisearch/ddi/validate.py
+#
+# Copyright 2014 Emory University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime
+from io import BytesIO
+import re
+
+from lxml import etree
+
+
+#: path to the title statement fields required by the site
+TITLE_STATEMENT = ('codeBook', 'stdyDscr', 'citation', 'titlStmt')
+
+# agency and id must be usable in resource urls; see ddisearch.ddi.urls
+_agency_re = re.compile(r'^[a-zA-Z0-9]+$')
+_id_re = re.compile(r'^[0-9_]+$')
+
+# date formats by length; shorter all-digit dates are padded to 4-digit
+# years (or treated as a month, at the end of a cycle) when loaded
+_date_formats = {4: '%Y', 7: '%Y-%m', 10: '%Y-%m-%d'}
+
+
+def validate_date(date):
+    '''Check that a ``timePrd`` date can be cleaned up and indexed by
+    the load command: YYYY, YYYY-MM, YYYY-MM-DD, or a year with
+    fewer than four digits.
+
+    :returns: True if the date is valid
+    '''
+    if not date:
+        return False
+    if len(date) < 4:
+        return date.isdigit()
+    if len(date) not in _date_formats:
+        return False
+    try:
+        datetime.strptime(date, _date_formats[len(date)])
+        return True
+    except ValueError:
+        return False
+
+
+def validate_document(source):
+    '''Check a DDI document for problems that would prevent it from being
+    loaded or displayed by the site, without building the whole document
+    in memory: well-formedness, a study title, an ID number and agency
+    that can be used in urls, and parseable time period dates.
+
+    :param source: filename or file-like object
+    :returns: list of error messages; empty if the document is valid
+    '''
+    errors = []
+    path = []
+    agency = idno = title = None
+    try:
+        for event, elem in etree.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                if not path and elem.tag != 'codeBook':
+                    errors.append('Root element is %s, not codeBook' % elem.tag)
+                    return errors
+                path.append(elem.tag)
+                continue
+
+            # only the first of each is used, as in CodeBook
+            if tuple(path[:-1]) == TITLE_STATEMENT:
+                if elem.tag == 'IDNo' and idno is None:
+                    idno, agency = (elem.text or '').strip(), elem.get('agency')
+                elif elem.tag == 'titl' and title is None:
+                    title = (elem.text or '').strip()
+
+            elif elem.tag == 'timePrd' and not validate_date(elem.get('date')):
+                errors.append('Invalid time period date: %r' % elem.get('date'))
+
+            path.pop()
+            # discard content as it is processed, to keep memory use low
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+    except etree.XMLSyntaxError as err:
+        errors.append('Not well-formed: %s' % err)
+        return errors
+
+    if not title:
+        errors.append('Missing study title (titl)')
+    if not idno:
+        errors.append('Missing study ID number (IDNo)')
+    elif not _id_re.match(idno):
+        errors.append('Invalid study ID number: %r' % idno)
+    if not agency:
+        errors.append('Missing ID number agency')
+    elif not _agency_re.match(agency):
+        errors.append('Invalid ID number agency: %r' % agency)
+    return errors
+
+
+def validate_input(inputfile):
+    '''Validate a :class:`~ddisearch.ddi.inputs.InputFile`; module-level
+    so it can be used with a :mod:`multiprocessing` pool.
+
+    :returns: tuple of file name and list of error messages
+    '''
+    if inputfile.error:
+        return inputfile.name, [inputfile.error]
+    if inputfile.data is not None:
+        return inputfile.name, validate_document(BytesIO(inputfile.data))
+    try:
+        return inputfile.name, validate_document(inputfile.name)
+    except IOError as err:
+        return inputfile.name, ['Error opening %s: %s' % (inputfile.name, err)]
@@ -26,7 +26,8 @@ from eulexistdb.query import XmlQuery
 
 from ddisearch.ddi import forms
 from ddisearch.ddi.models import CodeBook, DistinctKeywords, DistinctTopics
-from ddisearch.ddi.utils import ddi_lastmodified, ddi_etag, collection_lastmodified
+from ddisearch.ddi.utils import ddi_lastmodified, ddi_etag, collection_lastmodified, \
+    document_metadata, page_cache, page_cache_key
 
 
 logger = logging.getLogger(__name__)
@@ -234,15 +235,33 @@ def resource(request, agency, id):
     id number and agency to identify a single document; returns a 404
     if no record matching the specified agency and id is found.
 
+    The rendered page is cached by document checksum (see
+    :func:`~ddisearch.ddi.utils.page_cache`), so that unchanged documents
+    are displayed without querying eXist; pages are not cached for
+    logged-in users, since they may differ.
+
     :param agency: agency identifier (from document title statement)
     :param id: id number (from title statement)
     '''
+    cache = key = None
+    if not request.user.is_authenticated():
+        cache = page_cache()
+        doc = document_metadata(agency, id)
+        if cache is not None and doc is not None and doc.hash:
+            key = page_cache_key(agency, id, doc.hash)
+            content = cache.get(key)
+            if content is not None:
+                return HttpResponse(content)
+
     try:
         res = CodeBook.objects.get(id__val=id, id__agency=agency)
     except DoesNotExist:
         raise Http404
 
-    return render(request, 'ddi/resource.html', {'resource': res})
+    response = render(request, 'ddi/resource.html', {'resource': res})
+    if key is not None:
+        cache.set(key, response.content)
+    return response
 
 
 @condition(etag_func=ddi_etag, last_modified_func=ddi_lastmodified)
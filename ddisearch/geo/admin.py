@@ -16,7 +16,7 @@
 
 from django.contrib import admin
 from ddisearch.geo.models import Location, GeonamesCountry,  \
-    GeonamesContinent, StateCode
+    GeonamesContinent, StateCode, GeocodeCache, PlaceAlias
 
 class LocationAdmin(admin.ModelAdmin):
     list_display = ('name', 'geonames_id', 'country_code', 'continent_code',
@@ -39,8 +39,18 @@ class StateCodeAdmin(admin.ModelAdmin):
     list_display = ('name', 'code', 'fips')
     search_fields = ('name', 'code', 'fips')
 
+class GeocodeCacheAdmin(admin.ModelAdmin):
+    list_display = ('name', 'options', 'geonames_id', 'updated')
+    search_fields = ('name', 'geonames_id')
+
+class PlaceAliasAdmin(admin.ModelAdmin):
+    list_display = ('key', 'options', 'geonames_id')
+    search_fields = ('key', 'geonames_id')
+
 
 admin.site.register(Location, LocationAdmin)
 admin.site.register(GeonamesCountry, GeonamesCountryAdmin)
 admin.site.register(GeonamesContinent, GeonamesContinentAdmin)
 admin.site.register(StateCode, StateCodeAdmin)
+admin.site.register(GeocodeCache, GeocodeCacheAdmin)
+admin.site.register(PlaceAlias, PlaceAliasAdmin)
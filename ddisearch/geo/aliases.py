@@ -0,0 +1,121 @@
+# file ddisearch/geo/aliases.py
+#
+# Copyright 2014 Emory University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+import threading
+
+from django.db import IntegrityError, transaction
+
+from ddisearch.geo.altnames import alternate_names
+from ddisearch.geo.models import PlaceAlias, alias_key, batches, \
+    normalize_options
+from ddisearch.geo.reference import reference_data
+
+
+class AliasIndex(object):
+    '''In-memory index of known place names, keyed on
+    :func:`~ddisearch.geo.models.alias_key`, so that variant forms of
+    names can be resolved without calling GeoNames.  Combines the
+    hand-maintained list of :data:`~ddisearch.geo.altnames.alternate_names`,
+    the names of known countries, and aliases learned from past geocoding
+    results (:class:`~ddisearch.geo.models.PlaceAlias`).  Safe to use
+    from parallel threads.
+    '''
+
+    def __init__(self):
+        #: alternate names, with the name to look up instead
+        self.alternates = dict((alias_key(name), other)
+                               for name, other in alternate_names.iteritems())
+        #: known countries (:class:`~ddisearch.geo.models.GeonamesCountry`)
+        self.countries = {}
+        for country in reference_data().countries:
+            self.countries.setdefault(alias_key(country.name), country)
+        #: geonames ids, keyed on alias key and normalized search options
+        self.learned = dict(((a.key, a.options), a.geonames_id)
+                            for a in PlaceAlias.objects.all())
+        self._lock = threading.Lock()
+
+    def alternate_name(self, name):
+        '''Name to look up instead of the specified name, if it is a
+        known alternate name (e.g., a historic place); otherwise None.'''
+        return self.alternates.get(alias_key(name))
+
+    def country(self, name):
+        'Known country matching a name, if any.'
+        return self.countries.get(alias_key(name))
+
+    def geonames_id(self, name, options):
+        '''Geonames id learned for a name and search options, if any.
+
+        :param name: place name
+        :param options: dictionary of search options
+        '''
+        return self.learned.get((alias_key(name), normalize_options(options)))
+
+    def learn(self, name, options, geonames_id):
+        '''Record the geonames id found for a name and search options, in
+        the index and in the database.'''
+        self.learn_many([(name, options, geonames_id)])
+
+    def learn_many(self, results):
+        '''Record the geonames ids found for a list of names and search
+        options, in the index and in the database, with a fixed number of
+        queries however many there are.
+
+        :param results: list of tuples of name, dictionary of search
+            options, and geonames id; later results for the same name and
+            options replace earlier ones
+        '''
+        learned = OrderedDict()
+        for name, options, geonames_id in results:
+            key = (alias_key(name), normalize_options(options))
+            if key[0]:
+                learned[key] = geonames_id
+        with self._lock:
+            learned = OrderedDict((key, geonames_id) for key, geonames_id
+                                  in learned.iteritems()
+                                  if self.learned.get(key) != geonames_id)
+            self.learned.update(learned)
+        if not learned:
+            return
+
+        existing = {}
+        for keys in batches(set(key for key, options in learned)):
+            existing.update(((a.key, a.options), a.pk) for a in
+                            PlaceAlias.objects.filter(key__in=keys))
+        changed = {}
+        for key, geonames_id in learned.iteritems():
+            if key in existing:
+                changed.setdefault(geonames_id, []).append(existing[key])
+        try:
+            with transaction.atomic():
+                PlaceAlias.objects.bulk_create([
+                    PlaceAlias(key=key, options=options, geonames_id=geonames_id)
+                    for (key, options), geonames_id in learned.iteritems()
+                    if (key, options) not in existing])
+                for geonames_id, pks in changed.iteritems():
+                    PlaceAlias.objects.filter(pk__in=pks).update(geonames_id=geonames_id)
+        except IntegrityError:
+            # some were learned by another process at the same time;
+            # save them one at a time instead
+            for (key, options), geonames_id in learned.iteritems():
+                try:
+                    with transaction.atomic():
+                        PlaceAlias.objects.update_or_create(key=key, options=options,
+                            defaults={'geonames_id': geonames_id})
+                except IntegrityError:
+                    # learned at the same time; either is fine
+                    pass
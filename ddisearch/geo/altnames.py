@@ -160,3 +160,25 @@ alternate_names = {
     # Korea in the CNTS data - refers to the unified Korea that existed prior to Japanese annexation
 }
 
+
+# common abbreviations in place names, and the words they stand for;
+# used to match variant forms of names (see ddisearch.geo.models.alias_key)
+
+abbreviations = {
+    'st': 'saint',
+    'ste': 'sainte',
+    'mt': 'mount',
+    'mtn': 'mountain',
+    'ft': 'fort',
+    'pt': 'point',
+    'is': 'island',
+    'isl': 'island',
+    'rep': 'republic',
+    'dem': 'democratic',
+    'fed': 'federated',
+    'sts': 'states',
+    'n': 'north',
+    's': 'south',
+    'e': 'east',
+    'w': 'west',
+}
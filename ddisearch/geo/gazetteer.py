@@ -0,0 +1,266 @@
+# file ddisearch/geo/gazetteer.py
+#
+# Copyright 2014 Emory University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# local GeoNames gazetteer, loaded from the GeoNames data dumps, so that
+# locations can be geocoded without calling the GeoNames web service
+
+import codecs
+import os
+import time
+import zipfile
+
+from django.db.models import Case, Count, IntegerField, Q, Value, When
+
+from ddisearch.geo.geonames import GeonamesException, GeonamesResult
+from ddisearch.geo.models import GeonamesPlace, GeonamesPlaceWord, \
+    normalize_name, place_names
+from ddisearch.geo.stats import GeonamesStats
+
+
+#: relevance of feature codes, most important first, for ordering search
+#: results with similar names (approximates GeoNames relevance ordering,
+#: which favors countries and larger administrative divisions)
+FEATURE_RANK = ['CONT', 'PCLI', 'PCLD', 'PCLS', 'PCLF', 'PCLIX', 'PCL',
+                'TERR', 'ADM1', 'PPLC', 'RGN', 'ADM2', 'PPLA', 'PPLA2',
+                'ISL', 'PPL']
+
+#: maximum number of places returned by a search, most relevant first
+MAX_CANDIDATES = 200
+
+
+def open_dump(path):
+    '''Open a GeoNames dump text file for reading, as unicode.  Zip files
+    (as distributed by GeoNames) are read directly; the text file in the
+    zip file should have the same base name.'''
+    if path.lower().endswith('.zip'):
+        archive = zipfile.ZipFile(path)
+        member = '%s.txt' % os.path.splitext(os.path.basename(path))[0]
+        return codecs.getreader('utf-8')(archive.open(member))
+    return codecs.open(path, encoding='utf-8')
+
+
+def read_admin1_codes(path):
+    '''Read first-level administrative division names from the GeoNames
+    ``admin1CodesASCII.txt`` dump.
+
+    :returns: dictionary keyed on country code and admin code, joined
+        by ``.`` (e.g., ``US.CA``), with the division name as value
+    '''
+    names = {}
+    with open_dump(path) as dump:
+        for line in dump:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) >= 2 and not line.startswith('#'):
+                names[fields[0]] = fields[1]
+    return names
+
+
+def read_places(path, admin1_names=None):
+    '''Generator of :class:`~ddisearch.geo.models.GeonamesPlace` (not yet
+    saved) for the places in a GeoNames dump in the standard geoname
+    table format (e.g., ``allCountries.txt``, ``cities15000.txt``).
+
+    :param path: path to the dump file, as text or zip
+    :param admin1_names: optional dictionary of admin division names,
+        as returned by :func:`read_admin1_codes`
+    '''
+    admin1_names = admin1_names or {}
+    with open_dump(path) as dump:
+        for line in dump:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 15:
+                continue
+            country_code, admin_code1 = fields[8], fields[10]
+            alternates = [normalize_name(n) for n in fields[3].split(',') if n]
+            yield GeonamesPlace(
+                geonames_id=int(fields[0]),
+                name=fields[1],
+                name_key=normalize_name(fields[1]),
+                ascii_key=normalize_name(fields[2]),
+                alternate_names='|'.join(alternates),
+                latitude=float(fields[4]),
+                longitude=float(fields[5]),
+                feature_class=fields[6],
+                feature_code=fields[7],
+                country_code=country_code,
+                admin_code1=admin_code1,
+                admin_name1=admin1_names.get('%s.%s' % (country_code, admin_code1), ''),
+                population=int(fields[14] or 0))
+
+
+class LocalGeonamesClient(object):
+    '''Geocoder with the same interface as
+    :class:`~ddisearch.geo.geonames.GeonamesClient`, but searching places
+    imported from a GeoNames dump into the local database
+    (:class:`~ddisearch.geo.models.GeonamesPlace`) instead of calling the
+    GeoNames web service.
+
+    Search semantics follow the GeoNames search API as closely as is
+    practical: **name_equals** matches the name or ascii name exactly
+    (ignoring case); **name** and **query** match places where every word
+    is part of the name, ascii name, or an alternate name.  Results are
+    ordered by exact name match, then by feature code (see
+    :data:`FEATURE_RANK`), then by population.
+
+    Searches are counted in :attr:`stats` as for the web service client,
+    under the corresponding endpoint names, but use no credits.
+    '''
+
+    def __init__(self):
+        #: search counts and latency; see :class:`~ddisearch.geo.stats.GeonamesStats`
+        self.stats = GeonamesStats()
+
+    def geocode(self, **kwargs):
+        '''Search for places; parameters and return values are the same as
+        for :meth:`ddisearch.geo.geonames.GeonamesClient.geocode`.'''
+        start = time.time()
+        try:
+            return self.search_places(**kwargs)
+        finally:
+            self.stats.request('searchJSON', time.time() - start, credits=0)
+
+    def search_places(self, query=None, name=None, name_equals=None,
+                      exactly_one=True, country_bias=None,
+                      country=None, feature_code=None,
+                      feature_class=None, admin_code1=None):
+        # search the database for places; see geocode
+        places = GeonamesPlace.objects.all()
+        term = name_equals or name or query
+        key = normalize_name(term) if term else None
+        words = key.split() if key else []
+
+        if name_equals:
+            places = places.filter(Q(name_key=key) | Q(ascii_key=key))
+        elif words:
+            # places with every word in the same name, using the word index
+            places = places.filter(id__in=matching_places(words))
+
+        if country:
+            places = places.filter(country_code=country)
+        if admin_code1:
+            places = places.filter(admin_code1=admin_code1)
+        if feature_code:
+            places = places.filter(feature_code__in=as_list(feature_code))
+        if feature_class:
+            places = places.filter(feature_class__in=as_list(feature_class))
+
+        # ordered in the database, so that results are limited to the
+        # most relevant places rather than the most populous
+        places = list(self.relevance_order(places, key, country_bias)[:MAX_CANDIDATES])
+
+        if not places:
+            return None
+        if exactly_one:
+            return place_result(places[0])
+        return [place_result(p) for p in places]
+
+    def relevance_order(self, places, key, country_bias=None):
+        # order a queryset of places in the database the same way as
+        # relevance: country bias, exact name match, feature code rank,
+        # and then population
+        int_field = IntegerField()
+        annotations = {'feature_rank': Case(
+            *[When(feature_code=code, then=Value(i))
+              for i, code in enumerate(FEATURE_RANK)],
+            default=Value(len(FEATURE_RANK)), output_field=int_field)}
+        order = []
+        if country_bias is not None:
+            annotations['unbiased'] = Case(When(country_code=country_bias, then=Value(0)),
+                                           default=Value(1), output_field=int_field)
+            order.append('unbiased')
+        if key is not None:
+            annotations['inexact'] = Case(When(Q(name_key=key) | Q(ascii_key=key), then=Value(0)),
+                                          default=Value(1), output_field=int_field)
+            order.append('inexact')
+        return places.annotate(**annotations) \
+                     .order_by(*(order + ['feature_rank', '-population']))
+
+    def relevance(self, place, key, country_bias=None):
+        # sort key for search results in memory, in the same order as
+        # relevance_order; lower is more relevant
+        exact = key is None or key in (place.name_key, place.ascii_key)
+        try:
+            rank = FEATURE_RANK.index(place.feature_code)
+        except ValueError:
+            rank = len(FEATURE_RANK)
+        biased = country_bias is None or place.country_code == country_bias
+        return (not biased, not exact, rank, -place.population)
+
+    def get_by_id(self, geonames_id):
+        '''Get information about a specific GeoNames ID.
+
+        :param geonames_id: geonames identifier to lookup
+        :returns: :class:`~ddisearch.geo.geonames.GeonamesResult`
+        '''
+        start = time.time()
+        place = GeonamesPlace.objects.filter(geonames_id=geonames_id).first()
+        self.stats.request('getJSON', time.time() - start, credits=0)
+        if place is None:
+            raise GeonamesException('Error retrieving GeoNames %s: not found in local gazetteer' \
+                                    % geonames_id)
+        return place_result(place)
+
+
+def as_list(value):
+    # search options may be a single value or a list
+    return value if isinstance(value, (list, tuple)) else [value]
+
+
+def matching_places(words):
+    '''Query for the ids of places with every one of the specified words
+    as a whole word in the same name (name, ascii name, or an alternate
+    name), using :class:`~ddisearch.geo.models.GeonamesPlaceWord`;
+    for use as a subquery.
+
+    :param words: list of normalized words
+    '''
+    words = set(words)
+    return GeonamesPlaceWord.objects.filter(word__in=words) \
+        .values('place', 'name') \
+        .annotate(matched=Count('word', distinct=True)) \
+        .filter(matched=len(words)) \
+        .values('place')
+
+
+def matches_words(place, words):
+    # check that every word of a search term is a whole word in one of
+    # the names of a place; same as matching_places, for places in memory
+    for place_name in place_names(place):
+        name_words = place_name.split()
+        if all(word in name_words for word in words):
+            return True
+    return False
+
+
+def place_result(place):
+    '''Convert a :class:`~ddisearch.geo.models.GeonamesPlace` to a
+    :class:`~ddisearch.geo.geonames.GeonamesResult` with the same fields
+    as results from the GeoNames web service.'''
+    return GeonamesResult({
+        'geonameId': place.geonames_id,
+        'name': place.name,
+        'toponymName': place.name,
+        'lat': unicode(place.latitude),
+        'lng': unicode(place.longitude),
+        'fcl': place.feature_class,
+        'fcode': place.feature_code,
+        'countryCode': place.country_code or None,
+        'adminCode1': place.admin_code1,
+        'adminName1': place.admin_name1,
+        'population': place.population,
+    })
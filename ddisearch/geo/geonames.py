@@ -18,23 +18,201 @@
 # simple client to interact with geonames api, since
 # the geopy client is too limited and doesn't expose all OPTIONS:
 
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import urllib
+
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from ddisearch.geo.stats import GeonamesStats
 
 
 class GeonamesException(Exception):
     pass
 
 
+class RateLimiter(object):
+    '''Token bucket rate limiter, to keep GeoNames requests within the
+    account credit limits.  Safe to share between threads; callers block
+    in :meth:`acquire` until enough credits are available.
+
+    :param limits: list of tuples of number of credits allowed and
+        period in seconds, e.g. ``[(1000, 3600), (20000, 86400)]``;
+        all limits must have credits available for a request to proceed
+    '''
+
+    def __init__(self, limits):
+        # each bucket is a list of capacity, available tokens, and
+        # refill rate in tokens per second; buckets start full
+        self.buckets = [[float(credits), float(credits), credits / float(period)]
+                        for credits, period in limits]
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self, credits=1):
+        '''Wait until the specified number of credits are available and
+        use them.
+
+        :returns: time spent waiting, in seconds
+        '''
+        waited = 0
+        while True:
+            with self.lock:
+                now = time.time()
+                for bucket in self.buckets:
+                    capacity, tokens, rate = bucket
+                    bucket[1] = min(capacity, tokens + (now - self.last) * rate)
+                self.last = now
+
+                wait = max([(credits - tokens) / rate
+                            for capacity, tokens, rate in self.buckets
+                            if tokens < credits] or [0])
+                if wait <= 0:
+                    for bucket in self.buckets:
+                        bucket[1] -= credits
+                    return waited
+
+            time.sleep(wait)
+            waited += wait
+
+
 class GeonamesClient(object):
     '''Simple GeoNames.org client for searching and geocoding terms.
 
+    Requests are made with a persistent HTTP session for each thread, so
+    connections are kept alive and reused.  Responses can optionally be
+    cached on disk, so that the same query (e.g., the same country id
+    for every record) does not use up GeoNames credits.
+
     :param username
+    :param rate_limiter: optional :class:`RateLimiter`; if specified,
+        each request waits for a credit to be available
+    :param timeout: request timeout in seconds
+    :param retries: number of times to retry requests that fail because
+        of a connection error or server error
+    :param cache_dir: optional directory for caching responses
+    :param cache_ttl: number of seconds cached responses are used for
+    :param base_url: optional base url for the web service, e.g. for a
+        local :class:`~ddisearch.geo.testserver.GeonamesTestServer`
     '''
 
     base_url = 'http://api.geonames.org'
 
-    def __init__(self, username):
+    #: GeoNames credits used by a request to each endpoint
+    credits = {'searchJSON': 1, 'getJSON': 1}
+
+    def __init__(self, username, rate_limiter=None, timeout=10, retries=3,
+                 cache_dir=None, cache_ttl=30 * 86400, base_url=None):
         self.username = username
+        if base_url:
+            self.base_url = base_url.rstrip('/')
+        self.rate_limiter = rate_limiter
+        self.timeout = timeout
+        self.retries = retries
+        self.cache_dir = cache_dir
+        self.cache_ttl = cache_ttl
+        self._local = threading.local()
+        #: request counts, credits and latency; see
+        #: :class:`~ddisearch.geo.stats.GeonamesStats`
+        self.stats = GeonamesStats()
+
+    @property
+    def session(self):
+        ''':class:`requests.Session` for the current thread, with connection
+        pooling and retries'''
+        if not hasattr(self._local, 'session'):
+            session = requests.Session()
+            retry = Retry(total=self.retries, backoff_factor=0.5,
+                          status_forcelist=[500, 502, 503, 504])
+            session.mount('http://', HTTPAdapter(max_retries=retry))
+            session.mount('https://', HTTPAdapter(max_retries=retry))
+            self._local.session = session
+        return self._local.session
+
+    def cache_key(self, endpoint, params):
+        '''Canonical query string for an API request, excluding the username.
+        Values are utf-8 encoded, since urlencode would otherwise replace
+        any non-ascii characters and make different names share a key.'''
+        def encode(val):
+            if isinstance(val, unicode):
+                return val.encode('utf-8')
+            if isinstance(val, (list, tuple)):
+                return [encode(v) for v in val]
+            return val
+        return '%s?%s' % (endpoint, urllib.urlencode(
+            sorted((k, encode(v)) for k, v in params.iteritems() if k != 'username'),
+            doseq=True))
+
+    def cache_path(self, key):
+        'Path to the cache file for an API request'
+        return os.path.join(self.cache_dir,
+                            '%s.json' % hashlib.sha1(key).hexdigest())
+
+    def get(self, endpoint, params):
+        '''Make a GeoNames API request, or return the cached response.
+
+        :param endpoint: API endpoint, e.g. ``searchJSON``
+        :param params: dictionary of query parameters
+        :returns: response content, parsed from JSON
+        :raises: :class:`GeonamesException` if the request fails
+        '''
+        path = None
+        if self.cache_dir:
+            path = self.cache_path(self.cache_key(endpoint, params))
+            try:
+                if time.time() - os.path.getmtime(path) < self.cache_ttl:
+                    with open(path) as cached:
+                        data = json.load(cached)
+                    self.stats.cache_hit(endpoint)
+                    return data
+            except (OSError, IOError, ValueError):
+                # not cached, or cached copy is unreadable
+                pass
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        start = time.time()
+        try:
+            resp = self.session.get('%s/%s' % (self.base_url, endpoint),
+                                    params=params, timeout=self.timeout)
+        except requests.exceptions.RequestException as err:
+            self.stats.request(endpoint, time.time() - start, credits=0, error=True)
+            raise GeonamesException('Error querying GeoNames %s: %s' % (endpoint, err))
+        if resp.status_code != requests.codes.ok:
+            self.stats.request(endpoint, time.time() - start, credits=0, error=True)
+            raise GeonamesException('Error querying GeoNames %s: %s' % \
+                                    (endpoint, resp.content))
+        data = resp.json()
+        # errors such as exceeding credit limits are returned as a status
+        # and don't use credits; not found is not an error
+        error = 'status' in data and data['status'].get('value') != 15
+        self.stats.request(endpoint, time.time() - start, error=error,
+                           credits=0 if error else self.credits.get(endpoint, 1))
+
+        # don't cache error messages (e.g., credits exceeded, not found)
+        if path is not None and 'status' not in data:
+            self.save_cache(path, data)
+        return data
+
+    def save_cache(self, path, data):
+        # write to a temporary file and rename, so that parallel
+        # workers never read a partially written response
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # created by another worker
+                pass
+        fd, tmpname = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, 'w') as tmpfile:
+            json.dump(data, tmpfile)
+        os.rename(tmpname, path)
 
     def geocode(self, query=None, name=None, name_equals=None,
                 exactly_one=True, country_bias=None,
@@ -61,7 +239,6 @@ class GeonamesClient(object):
         :param feature_class: restrict results by the specified admin code (generally
             should be used with country bias)
         '''
-        api_url =  '%s/searchJSON' % self.base_url
         params = {'username': self.username, 'orderBy': 'relevance'}
 
         # query term (really only expect one of these)
@@ -86,8 +263,12 @@ class GeonamesClient(object):
         if feature_class:
             params['featureClass'] = feature_class
 
-        r = requests.get(api_url, params=params)
-        result = r.json()
+        result = self.get('searchJSON', params)
+        # errors such as exceeding credit limits are returned as a status;
+        # these should not be mistaken for no results
+        if 'status' in result:
+            raise GeonamesException('Error searching GeoNames: %s' % \
+                                    result['status']['message'])
         if result['totalResultsCount']:
             if exactly_one:
                 return GeonamesResult(result['geonames'][0])
@@ -101,13 +282,12 @@ class GeonamesClient(object):
         :returns: :class:`GeonamesResult`
         '''
         params = {'username': self.username, 'geonameId': geonames_id}
-        api_url = '%s/getJSON' % self.base_url
-        resp = requests.get(api_url, params=params)
-        if resp.status_code != requests.codes.ok:
+        try:
+            data = self.get('getJSON', params)
+        except GeonamesException as err:
             raise GeonamesException('Error retrieving GeoNames %s: %s' % \
-                                    (geonames_id, resp.content))
+                                    (geonames_id, err))
         # geonames returns 200 for not found, have to check contents
-        data = resp.json()
         if 'status' in data and data['status']['value'] == 15:
             raise GeonamesException('Error retreving GeoNames %s: %s' % \
                             (geonames_id, data['status']['message']))
@@ -0,0 +1,75 @@
+# file ddisearch/geo/management/commands/clear_geocode_cache.py
+#
+# Copyright 2014 Emory University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ddisearch.geo.models import GeocodeCache, PlaceAlias, alias_key
+
+
+class Command(BaseCommand):
+    help = '''Remove cached geocoding results, so that the locations will be
+looked up with GeoNames again the next time they are geocoded.  By default,
+removes all cached results and learned aliases; specify location names to
+remove only the results and aliases for those names.'''
+    args = '<name name name ...>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--not-found',
+            dest='not_found',
+            action='store_true',
+            help='Only remove results where no location was found'
+        ),
+        make_option('--expired',
+            dest='expired',
+            action='store_true',
+            help='''Only remove not-found results that have expired (see
+GEOCODE_CACHE_NEGATIVE_TTL)'''
+        ),
+    )
+
+    v_normal = 1
+    def handle(self, *names, **options):
+        verbosity = int(options.get('verbosity', self.v_normal))
+
+        results = GeocodeCache.objects.all()
+        if names:
+            # normalize names the same way they are cached
+            results = results.filter(name__in=[GeocodeCache.key(n, {})['name']
+                                               for n in names])
+        if options.get('not_found', False) or options.get('expired', False):
+            results = results.filter(geonames_id__isnull=True)
+        if options.get('expired', False):
+            results = results.filter(updated__lt=GeocodeCache.negative_expiration())
+
+        total = results.count()
+        results.delete()
+        if verbosity >= self.v_normal:
+            self.stdout.write('%d cached geocode result%s removed' % \
+                              (total, 's' if total != 1 else ''))
+
+        # aliases are only learned from results where a location was found
+        if options.get('not_found', False) or options.get('expired', False):
+            return
+        aliases = PlaceAlias.objects.all()
+        if names:
+            aliases = aliases.filter(key__in=[alias_key(n) for n in names])
+        total = aliases.count()
+        aliases.delete()
+        if total and verbosity >= self.v_normal:
+            self.stdout.write('%d learned alias%s removed' % \
+                              (total, 'es' if total != 1 else ''))
@@ -0,0 +1,120 @@
+# file ddisearch/geo/management/commands/geonames_testserver.py
+#
+# Copyright 2014 Emory University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from optparse import make_option
+import socket
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ddisearch.geo.gazetteer import read_admin1_codes
+from ddisearch.geo.testserver import GeonamesTestServer, load_places
+
+
+class Command(BaseCommand):
+    help = '''Run a local stand-in for the GeoNames web service (searchJSON
+and getJSON), serving places from GeoNames data dump files or JSON
+fixtures, for reproducible geocoding tests, benchmarks and load tests
+without calling api.geonames.org.  Set GEONAMES_URL to the address
+shown to geocode with it.'''
+    args = '<dumpfile dumpfile ...>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--admin1',
+            dest='admin1',
+            metavar='FILE',
+            help='''GeoNames admin1CodesASCII.txt file, for first-level
+administrative division (e.g., state) names'''
+        ),
+        make_option('--host',
+            dest='host',
+            default='localhost',
+            help='Host name to listen on (default: %default)'
+        ),
+        make_option('--port', '-p',
+            dest='port',
+            type='int',
+            default=8001,
+            help='Port to listen on (default: %default)'
+        ),
+        make_option('--latency',
+            dest='latency',
+            type='float',
+            default=0,
+            help='Seconds to wait before responding to each request (default: %default)'
+        ),
+        make_option('--error-rate',
+            dest='error_rate',
+            type='float',
+            default=0,
+            help='Fraction of requests to fail, between 0 and 1 (default: %default)'
+        ),
+        make_option('--error',
+            dest='error',
+            type='choice',
+            choices=['http', 'credits'],
+            default='http',
+            help='''How failed requests fail: http for a server error, or
+credits for a GeoNames credit limit message (default: %default)'''
+        ),
+        make_option('--seed',
+            dest='seed',
+            type='int',
+            help='Random seed for choosing which requests fail'
+        ),
+    )
+
+    v_normal = 1
+    def handle(self, *files, **options):
+        verbosity = int(options.get('verbosity', self.v_normal))
+
+        if not files:
+            raise CommandError('No GeoNames dump files specified')
+
+        try:
+            admin1_names = {}
+            if options.get('admin1', None):
+                admin1_names = read_admin1_codes(options['admin1'])
+            places = load_places(files, admin1_names)
+        except (IOError, KeyError, ValueError) as err:
+            raise CommandError('Error reading GeoNames places: %s' % err)
+
+        error_rate = options.get('error_rate', None) or 0
+        if not 0 <= error_rate <= 1:
+            raise CommandError('Error rate must be between 0 and 1')
+
+        try:
+            server = GeonamesTestServer(places,
+                host=options.get('host', None) or 'localhost',
+                port=options.get('port', 8001),
+                latency=options.get('latency', None) or 0,
+                error_rate=error_rate,
+                error=options.get('error', None) or 'http',
+                seed=options.get('seed', None))
+        except socket.error as err:
+            raise CommandError('Error starting server: %s' % err)
+
+        if verbosity >= self.v_normal:
+            self.stdout.write('Serving %d places at %s' % (len(places), server.url))
+            self.stdout.write("Set GEONAMES_URL = '%s' to geocode with it; quit with CONTROL-C" \
+                              % server.url)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if verbosity >= self.v_normal:
+                self.stdout.write('%d requests served' % sum(server.requests.values()))
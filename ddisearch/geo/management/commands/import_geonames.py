@@ -0,0 +1,111 @@
+# file ddisearch/geo/management/commands/import_geonames.py
+#
+# Copyright 2014 Emory University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from ddisearch.geo.gazetteer import read_admin1_codes, read_places
+from ddisearch.geo.models import GeonamesPlace, GeonamesPlaceWord, \
+    place_words
+
+
+class Command(BaseCommand):
+    help = '''Import places from GeoNames data dump files (e.g., allCountries.txt
+or cities15000.zip from http://download.geonames.org/export/dump/) into the
+local gazetteer, for geocoding without the GeoNames web service (see the
+GEONAMES_LOCAL setting).  Places that have already been imported are
+updated.'''
+    args = '<dumpfile dumpfile ...>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--admin1',
+            dest='admin1',
+            metavar='FILE',
+            help='''GeoNames admin1CodesASCII.txt file, for first-level
+administrative division (e.g., state) names'''
+        ),
+        make_option('--replace',
+            dest='replace',
+            action='store_true',
+            help='Remove all previously imported places first'
+        ),
+        make_option('--batch-size', '-b',
+            dest='batch_size',
+            type='int',
+            default=500,
+            help='Number of places to save at once (default: %default)'
+        ),
+    )
+
+    v_normal = 1
+    def handle(self, *files, **options):
+        verbosity = int(options.get('verbosity', self.v_normal))
+        batch_size = max(1, int(options.get('batch_size', None) or 500))
+
+        if not files:
+            raise CommandError('No GeoNames dump files specified')
+
+        admin1_names = {}
+        try:
+            if options.get('admin1', None):
+                admin1_names = read_admin1_codes(options['admin1'])
+
+            if options.get('replace', False):
+                GeonamesPlace.objects.all().delete()
+
+            total = 0
+            for filename in files:
+                count = 0
+                batch = []
+                for place in read_places(filename, admin1_names):
+                    batch.append(place)
+                    if len(batch) >= batch_size:
+                        count += self.save_places(batch)
+                        batch = []
+                if batch:
+                    count += self.save_places(batch)
+                total += count
+                if verbosity > self.v_normal:
+                    self.stdout.write('%d places imported from %s' % (count, filename))
+
+        except (IOError, KeyError, ValueError) as err:
+            raise CommandError('Error reading GeoNames dump: %s' % err)
+
+        if verbosity >= self.v_normal:
+            self.stdout.write('%d places imported' % total)
+
+    def save_places(self, places):
+        '''Save a batch of places in a single transaction, along with the
+        words in their names for searching
+        (:class:`~ddisearch.geo.models.GeonamesPlaceWord`), replacing any
+        previously imported versions.
+
+        :param places: list of :class:`~ddisearch.geo.models.GeonamesPlace`
+        :returns: number of places saved
+        '''
+        geonames_ids = [p.geonames_id for p in places]
+        with transaction.atomic():
+            GeonamesPlace.objects.filter(geonames_id__in=geonames_ids).delete()
+            GeonamesPlace.objects.bulk_create(places)
+            # bulk create doesn't set database ids on every backend
+            ids = dict(GeonamesPlace.objects.filter(geonames_id__in=geonames_ids) \
+                       .values_list('geonames_id', 'id'))
+            GeonamesPlaceWord.objects.bulk_create([
+                GeonamesPlaceWord(place_id=ids[p.geonames_id], name=name, word=word)
+                for p in places for name, word in place_words(p)])
+        return len(places)
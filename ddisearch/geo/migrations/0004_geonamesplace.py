@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geo', '0003_geocodecache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeonamesPlace',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('geonames_id', models.IntegerField(unique=True)),
+                ('name', models.CharField(max_length=200)),
+                ('name_key', models.CharField(max_length=200, db_index=True)),
+                ('ascii_key', models.CharField(max_length=200, db_index=True)),
+                ('alternate_names', models.TextField(blank=True)),
+                ('latitude', models.FloatField()),
+                ('longitude', models.FloatField()),
+                ('feature_class', models.CharField(max_length=1, db_index=True)),
+                ('feature_code', models.CharField(max_length=10, db_index=True)),
+                ('country_code', models.CharField(max_length=2, blank=True, db_index=True)),
+                ('admin_code1', models.CharField(max_length=20, blank=True, db_index=True)),
+                ('admin_name1', models.CharField(max_length=200, blank=True)),
+                ('population', models.BigIntegerField(default=0)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+# copies of the hierarchy helpers in ddisearch.geo.models as of this
+# migration, so that later changes don't affect it
+CONTINENT, COUNTRY, STATE, PLACE = range(4)
+
+
+def hierarchy_level(feature_code):
+    if feature_code == 'CONT':
+        return CONTINENT
+    if feature_code.startswith('PCL') or feature_code == 'TERR':
+        return COUNTRY
+    if feature_code in ['ADM1', 'RGN']:
+        return STATE
+    return PLACE
+
+
+def is_ancestor(ancestor, location):
+    ancestor_level = hierarchy_level(ancestor.feature_code)
+    if ancestor_level >= hierarchy_level(location.feature_code):
+        return False
+    if ancestor_level == CONTINENT:
+        return ancestor.continent_code is not None and \
+            ancestor.continent_code == location.continent_code
+    same_country = ancestor.country_code is not None and \
+        ancestor.country_code == location.country_code
+    if ancestor_level == COUNTRY:
+        return same_country
+    return same_country and ancestor.state_code is not None and \
+        ancestor.state_code == location.state_code
+
+
+def build_hierarchy(apps, schema_editor):
+    'Link existing locations to the locations that contain them.'
+    Location = apps.get_model('geo', 'Location')
+    LocationAncestor = apps.get_model('geo', 'LocationAncestor')
+
+    locations = list(Location.objects.all())
+    # only continents, countries and states can contain other locations
+    containers = [loc for loc in locations
+                  if hierarchy_level(loc.feature_code) < PLACE]
+    links = []
+    for loc in locations:
+        level = hierarchy_level(loc.feature_code)
+        links.append(LocationAncestor(location=loc, ancestor=loc, depth=0))
+        for other in containers:
+            if other.pk != loc.pk and is_ancestor(other, loc):
+                links.append(LocationAncestor(location=loc, ancestor=other,
+                    depth=level - hierarchy_level(other.feature_code)))
+    LocationAncestor.objects.bulk_create(links, batch_size=500)
+
+
+def remove_hierarchy(apps, schema_editor):
+    LocationAncestor = apps.get_model('geo', 'LocationAncestor')
+    LocationAncestor.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geo', '0004_geonamesplace'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LocationAncestor',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('depth', models.PositiveSmallIntegerField()),
+                ('ancestor', models.ForeignKey(related_name='descendant_links', on_delete=django.db.models.deletion.CASCADE, to='geo.Location')),
+                ('location', models.ForeignKey(related_name='ancestor_links', on_delete=django.db.models.deletion.CASCADE, to='geo.Location')),
+            ],
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='locationancestor',
+            unique_together=set([('location', 'ancestor')]),
+        ),
+        migrations.RunPython(build_hierarchy, reverse_code=remove_hierarchy),
+    ]
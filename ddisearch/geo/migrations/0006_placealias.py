@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import re
+import unicodedata
+
+from django.db import models, migrations
+
+
+# copy of ddisearch.geo.models.alias_key and the abbreviations it uses
+# as of this migration, so that later changes don't affect it
+abbreviations = {
+    'st': 'saint',
+    'ste': 'sainte',
+    'mt': 'mount',
+    'mtn': 'mountain',
+    'ft': 'fort',
+    'pt': 'point',
+    'is': 'island',
+    'isl': 'island',
+    'rep': 'republic',
+    'dem': 'democratic',
+    'fed': 'federated',
+    'sts': 'states',
+    'n': 'north',
+    's': 'south',
+    'e': 'east',
+    'w': 'west',
+}
+stopwords = set(['the', 'of', 'and'])
+
+
+def alias_key(name):
+    if isinstance(name, str):
+        name = name.decode('utf-8')
+    name = unicodedata.normalize('NFKD', name)
+    name = u''.join(c for c in name if not unicodedata.combining(c)).lower()
+    name = re.sub(u"[.'\u2019]", '', name)
+    words = re.sub(r'\W+', ' ', name, flags=re.UNICODE).split()
+    words = [abbreviations.get(word, word) for word in words]
+    return ' '.join(sorted(word for word in words if word not in stopwords))
+
+
+def learn_aliases(apps, schema_editor):
+    'Learn aliases from geocoding results that are already cached.'
+    GeocodeCache = apps.get_model('geo', 'GeocodeCache')
+    PlaceAlias = apps.get_model('geo', 'PlaceAlias')
+
+    aliases = {}
+    for cached in GeocodeCache.objects.filter(geonames_id__isnull=False):
+        key = alias_key(cached.name)
+        if key:
+            aliases[(key, cached.options)] = cached.geonames_id
+    PlaceAlias.objects.bulk_create([
+        PlaceAlias(key=key, options=options, geonames_id=geonames_id)
+        for (key, options), geonames_id in aliases.iteritems()], batch_size=500)
+
+
+def remove_aliases(apps, schema_editor):
+    PlaceAlias = apps.get_model('geo', 'PlaceAlias')
+    PlaceAlias.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geo', '0005_locationancestor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlaceAlias',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('key', models.CharField(max_length=255)),
+                ('options', models.CharField(max_length=255, blank=True)),
+                ('geonames_id', models.IntegerField()),
+            ],
+            options={
+                'verbose_name_plural': 'place aliases',
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='placealias',
+            unique_together=set([('key', 'options')]),
+        ),
+        migrations.RunPython(learn_aliases, reverse_code=remove_aliases),
+    ]
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+
+from django.db import models, migrations
+
+
+# copy of ddisearch.geo.models.place_words as of this migration,
+# so that later changes don't affect it
+def place_words(place):
+    names = [place.name_key, place.ascii_key] + place.alternate_names.split('|')
+    names = [name for name in OrderedDict.fromkeys(names) if name]
+    return [(i, word[:200]) for i, name in enumerate(names)
+            for word in OrderedDict.fromkeys(name.split())]
+
+
+def index_words(apps, schema_editor):
+    'Index the words in the names of places that are already imported.'
+    GeonamesPlace = apps.get_model('geo', 'GeonamesPlace')
+    GeonamesPlaceWord = apps.get_model('geo', 'GeonamesPlaceWord')
+
+    batch = []
+    for place in GeonamesPlace.objects.only('name_key', 'ascii_key',
+                                            'alternate_names').iterator():
+        batch.extend(GeonamesPlaceWord(place_id=place.id, name=name, word=word)
+                     for name, word in place_words(place))
+        if len(batch) >= 5000:
+            GeonamesPlaceWord.objects.bulk_create(batch)
+            batch = []
+    GeonamesPlaceWord.objects.bulk_create(batch)
+
+
+def remove_words(apps, schema_editor):
+    GeonamesPlaceWord = apps.get_model('geo', 'GeonamesPlaceWord')
+    GeonamesPlaceWord.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geo', '0006_placealias'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeonamesPlaceWord',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.PositiveSmallIntegerField()),
+                ('word', models.CharField(max_length=200)),
+                ('place', models.ForeignKey(related_name='name_words', to='geo.GeonamesPlace')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='geonamesplaceword',
+            index_together=set([('word', 'place', 'name')]),
+        ),
+        migrations.RunPython(index_words, reverse_code=remove_words),
+    ]
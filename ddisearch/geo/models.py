@@ -14,7 +14,59 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from collections import OrderedDict
+from datetime import timedelta
+import re
+import unicodedata
+import urllib
+
+from django.conf import settings
 from django.db import models
+from django.db.models import Q
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from ddisearch.geo.altnames import abbreviations
+
+
+def normalize_name(name):
+    'Normalize a place name for matching: lower-case, with whitespace collapsed.'
+    return ' '.join(name.split()).lower()
+
+
+def batches(values, size=500):
+    '''Split a list of values into batches, e.g. for ``__in`` filters,
+    since some databases limit the number of query parameters.'''
+    values = list(values)
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+
+def normalize_options(options):
+    'Normalize geocoding search options for matching, as a sorted query string.'
+    return urllib.urlencode(sorted(options.items()), doseq=True)
+
+
+# words ignored when matching variant forms of a name
+_alias_stopwords = set(['the', 'of', 'and'])
+
+
+def alias_key(name):
+    '''Normalize a place name for matching variant forms of the same name,
+    more loosely than :func:`normalize_name`: case and accents are
+    ignored, as are punctuation, word order (so that e.g. "Korea,
+    Republic of" matches "Republic of Korea"), and the words "the",
+    "of", and "and"; common abbreviations (see
+    :data:`ddisearch.geo.altnames.abbreviations`) are expanded.'''
+    if isinstance(name, str):
+        name = name.decode('utf-8')
+    name = unicodedata.normalize('NFKD', name)
+    name = u''.join(c for c in name if not unicodedata.combining(c)).lower()
+    # drop periods and apostrophes within words (U.S., Cote d'Ivoire)
+    name = re.sub(u"[.'\u2019]", '', name)
+    words = re.sub(r'\W+', ' ', name, flags=re.UNICODE).split()
+    words = [abbreviations.get(word, word) for word in words]
+    return ' '.join(sorted(word for word in words if word not in _alias_stopwords))
 
 
 class GeonamesCountry(models.Model):
@@ -72,6 +124,146 @@ class Location(models.Model):
     def __unicode__(self):
         return '%s (%s, %s)' % (self.name, self.country_code, self.continent_code)
 
+    @property
+    def level(self):
+        'Level of this location in the place hierarchy; see :func:`hierarchy_level`'
+        return hierarchy_level(self.feature_code)
+
+    def descendants(self, include_self=False):
+        '''Locations contained by this one, e.g. all of the states and
+        cities in a country.
+
+        :param include_self: include this location in the results
+        '''
+        return Location.objects.filter(ancestor_links__ancestor=self,
+            ancestor_links__depth__gte=0 if include_self else 1)
+
+
+#: levels of the place hierarchy used for browsing, from the top down
+CONTINENT, COUNTRY, STATE, PLACE = range(4)
+
+#: feature codes for state-level locations
+STATE_FEATURE_CODES = ['ADM1', 'RGN']
+
+
+def hierarchy_level(feature_code):
+    '''Level of a location in the place hierarchy used for browsing,
+    based on its GeoNames feature code: :data:`CONTINENT`, :data:`COUNTRY`
+    (including territories), :data:`STATE`, or :data:`PLACE` for anything
+    smaller.'''
+    if feature_code == 'CONT':
+        return CONTINENT
+    if feature_code.startswith('PCL') or feature_code == 'TERR':
+        return COUNTRY
+    if feature_code in STATE_FEATURE_CODES:
+        return STATE
+    return PLACE
+
+
+def is_ancestor(ancestor, location):
+    '''Check if one location contains another, based on hierarchy level
+    and continent, country and state codes.  Works with any objects with
+    the same fields as :class:`Location`.'''
+    ancestor_level = hierarchy_level(ancestor.feature_code)
+    if ancestor_level >= hierarchy_level(location.feature_code):
+        return False
+    if ancestor_level == CONTINENT:
+        return ancestor.continent_code is not None and \
+            ancestor.continent_code == location.continent_code
+    same_country = ancestor.country_code is not None and \
+        ancestor.country_code == location.country_code
+    if ancestor_level == COUNTRY:
+        return same_country
+    return same_country and ancestor.state_code is not None and \
+        ancestor.state_code == location.state_code
+
+
+class LocationAncestor(models.Model):
+    '''Closure table for the place hierarchy: links every
+    :class:`Location` to itself and to each location that contains it
+    (state, country, and continent), so that the ancestors or descendants
+    of a place can be found with a single indexed query.  Kept up to date
+    when locations are saved; see :func:`update_location_hierarchy`.'''
+    #: the contained location
+    location = models.ForeignKey(Location, related_name='ancestor_links')
+    #: the containing location (or the location itself)
+    ancestor = models.ForeignKey(Location, related_name='descendant_links')
+    #: difference in hierarchy level; 0 for the link to itself
+    depth = models.PositiveSmallIntegerField()
+
+    class Meta:
+        unique_together = ('location', 'ancestor')
+
+    def __unicode__(self):
+        return '%s < %s' % (self.location, self.ancestor)
+
+
+def link_hierarchy(locations):
+    '''Add :class:`LocationAncestor` links for locations that have just
+    been added to the database: to themselves, to the locations that
+    contain them, and from the locations they contain.  Uses the same
+    number of queries however many locations there are, so that locations
+    added in bulk can be linked in bulk.
+
+    :param locations: list of saved :class:`Location` objects
+    '''
+    if not locations:
+        return
+    pks = [loc.pk for loc in locations]
+    continents = set(loc.continent_code for loc in locations if loc.continent_code)
+    countries = set(loc.country_code for loc in locations if loc.country_code)
+    states = set(loc.state_code for loc in locations if loc.state_code)
+
+    # possible ancestors, by code
+    ancestors = Q(feature_code='CONT', continent_code__in=continents)
+    if countries:
+        ancestors |= Q(country_code__in=countries) & \
+            (Q(feature_code__startswith='PCL') | Q(feature_code='TERR') |
+             Q(feature_code__in=STATE_FEATURE_CODES, state_code__in=states))
+    candidates = list(Location.objects.filter(ancestors).exclude(pk__in=pks))
+    candidates.extend(locations)
+
+    # possible descendants, by code, for locations above the place level
+    descendants = Q()
+    containers = []
+    for loc in locations:
+        if loc.level == CONTINENT and loc.continent_code is not None:
+            descendants |= Q(continent_code=loc.continent_code)
+        elif loc.level in (COUNTRY, STATE) and loc.country_code is not None:
+            descendants |= Q(country_code=loc.country_code)
+        else:
+            continue
+        containers.append(loc)
+    below = []
+    if containers:
+        below = Location.objects.filter(descendants).exclude(pk__in=pks)
+
+    links = []
+    for loc in locations:
+        links.append(LocationAncestor(location=loc, ancestor=loc, depth=0))
+        for other in candidates:
+            if other.pk != loc.pk and is_ancestor(other, loc):
+                links.append(LocationAncestor(location=loc, ancestor=other,
+                                              depth=loc.level - other.level))
+    for other in below:
+        for loc in containers:
+            if is_ancestor(loc, other):
+                links.append(LocationAncestor(location=other, ancestor=loc,
+                                              depth=other.level - loc.level))
+    LocationAncestor.objects.bulk_create(links)
+
+
+@receiver(post_save, sender=Location)
+def update_location_hierarchy(sender, instance, created, **kwargs):
+    '''Link a location that has been saved to the locations that contain
+    it and the locations it contains, in :class:`LocationAncestor`.
+    Locations added with ``bulk_create`` should be linked with
+    :func:`link_hierarchy`.'''
+    if not created:
+        # codes may have changed; rebuild links to and from this location
+        LocationAncestor.objects.filter(Q(location=instance) | Q(ancestor=instance)).delete()
+    link_hierarchy([instance])
+
 
 class StateCode(models.Model):
     'U.S. State abbreviation and FIPS codes, for generating maps'
@@ -82,3 +274,150 @@ class StateCode(models.Model):
     #: numeric FIPS code
     fips = models.IntegerField()
 
+
+class GeonamesPlace(models.Model):
+    '''A place from a GeoNames data dump (e.g., allCountries.txt or
+    cities15000.txt from http://download.geonames.org/export/dump/),
+    imported with the ``import_geonames`` manage command so that locations
+    can be geocoded locally; see :class:`ddisearch.geo.gazetteer.LocalGeonamesClient`.'''
+    #: numeric geonames id
+    geonames_id = models.IntegerField(unique=True)
+    #: name of the place
+    name = models.CharField(max_length=200)
+    #: normalized name, for case-insensitive exact matching; see :func:`normalize_name`
+    name_key = models.CharField(max_length=200, db_index=True)
+    #: normalized plain ascii version of the name
+    ascii_key = models.CharField(max_length=200, db_index=True)
+    #: normalized alternate names, separated by ``|``
+    alternate_names = models.TextField(blank=True)
+    #: latitude
+    latitude = models.FloatField()
+    #: longitude
+    longitude = models.FloatField()
+    #: one-letter feature class; see http://www.geonames.org/export/codes.html
+    feature_class = models.CharField(max_length=1, db_index=True)
+    #: feature code; see http://www.geonames.org/export/codes.html
+    feature_code = models.CharField(max_length=10, db_index=True)
+    #: 2-character country code
+    country_code = models.CharField(max_length=2, blank=True, db_index=True)
+    #: first-level administrative code (e.g., U.S. state code)
+    admin_code1 = models.CharField(max_length=20, blank=True, db_index=True)
+    #: first-level administrative division name, if known
+    admin_name1 = models.CharField(max_length=200, blank=True)
+    #: population
+    population = models.BigIntegerField(default=0)
+
+    def __unicode__(self):
+        return '%s (%s, %s)' % (self.name, self.country_code, self.feature_code)
+
+
+def place_names(place):
+    '''Distinct normalized names of a :class:`GeonamesPlace`, in order:
+    the name, the ascii name, and then the alternate names.'''
+    names = [place.name_key, place.ascii_key] + place.alternate_names.split('|')
+    return [name for name in OrderedDict.fromkeys(names) if name]
+
+
+def place_words(place):
+    '''Words in the names of a :class:`GeonamesPlace`, for
+    :class:`GeonamesPlaceWord`, as a list of tuples of the position of the
+    name in :func:`place_names` and the word.'''
+    return [(i, word[:GeonamesPlaceWord.max_word_length])
+            for i, name in enumerate(place_names(place))
+            for word in OrderedDict.fromkeys(name.split())]
+
+
+class GeonamesPlaceWord(models.Model):
+    '''A word in one of the names of a :class:`GeonamesPlace`, so that
+    loose name searches in the local gazetteer can find the places with
+    every word of a search term in the same name with an index, rather
+    than scanning the names of every place.  Added by the
+    ``import_geonames`` manage command; see :func:`place_words`.'''
+    #: place the name belongs to
+    place = models.ForeignKey(GeonamesPlace, related_name='name_words')
+    #: position of the name in :func:`place_names`
+    name = models.PositiveSmallIntegerField()
+    #: normalized word
+    word = models.CharField(max_length=200)
+
+    #: words longer than this are truncated
+    max_word_length = 200
+
+    class Meta:
+        index_together = [('word', 'place', 'name')]
+
+    def __unicode__(self):
+        return '%s (%s)' % (self.word, self.place_id)
+
+
+class GeocodeCache(models.Model):
+    '''Cached result of geocoding a geographic coverage term with GeoNames,
+    so the same search is not repeated for every codebook that uses the
+    term.  Keyed on the normalized name and the search options used to
+    restrict the search (e.g., country, state).  A result with no geonames
+    id records that no match was found; these expire after the number of
+    days configured as **GEOCODE_CACHE_NEGATIVE_TTL** (default 30), in case
+    GeoNames is updated.'''
+    #: normalized location name; see :meth:`key`
+    name = models.CharField(max_length=255)
+    #: search options, as a normalized query string; see :meth:`key`
+    options = models.CharField(max_length=255, blank=True)
+    #: numeric geonames id, or None if no match was found
+    geonames_id = models.IntegerField(null=True, blank=True)
+    #: date and time the result was last looked up
+    updated = models.DateTimeField(auto_now=True)
+
+    #: default number of days before a negative result expires
+    default_negative_ttl = 30
+
+    class Meta:
+        unique_together = ('name', 'options')
+        verbose_name_plural = 'geocode cache'
+
+    def __unicode__(self):
+        return '%s %s' % (self.name, self.options)
+
+    @staticmethod
+    def key(name, options):
+        '''Cache key for a location name and search options, as a
+        dictionary of field values: the name is lower-cased with whitespace
+        normalized, and options are sorted.'''
+        return {
+            'name': normalize_name(name),
+            'options': normalize_options(options)
+        }
+
+    @staticmethod
+    def negative_expiration():
+        'Date and time before which negative results are expired'
+        days = getattr(settings, 'GEOCODE_CACHE_NEGATIVE_TTL',
+                       GeocodeCache.default_negative_ttl)
+        return timezone.now() - timedelta(days=days)
+
+    @property
+    def expired(self):
+        'Negative results expire; results with a geonames id do not.'
+        return self.geonames_id is None and \
+            self.updated < self.negative_expiration()
+
+
+class PlaceAlias(models.Model):
+    '''A variant form of a place name, learned from a successful geocoding
+    result, so that other names that differ only in ways ignored by
+    :func:`alias_key` (case, accents, word order, abbreviations) can be
+    coded without looking them up again.  Keyed on the alias key and the
+    search options used, since the same name can refer to different
+    places in different contexts (e.g., Georgia).'''
+    #: name, normalized with :func:`alias_key`
+    key = models.CharField(max_length=255)
+    #: search options, normalized with :func:`normalize_options`
+    options = models.CharField(max_length=255, blank=True)
+    #: numeric geonames id
+    geonames_id = models.IntegerField()
+
+    class Meta:
+        unique_together = ('key', 'options')
+        verbose_name_plural = 'place aliases'
+
+    def __unicode__(self):
+        return '%s %s' % (self.key, self.options)
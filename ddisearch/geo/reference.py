@@ -0,0 +1,121 @@
+# file ddisearch/geo/reference.py
+#
+# Copyright 2014 Emory University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# in-memory copy of the small, static geographic code tables (loaded by
+# migration 0002_load_geo_codes), so that geocoding and displaying records
+# doesn't query them over and over
+
+from collections import defaultdict
+import threading
+
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from ddisearch.geo.models import GeonamesCountry, GeonamesContinent, \
+    StateCode
+
+
+class ReferenceData(object):
+    '''Read-only indexes of :class:`~ddisearch.geo.models.GeonamesCountry`,
+    :class:`~ddisearch.geo.models.GeonamesContinent`, and
+    :class:`~ddisearch.geo.models.StateCode`, loaded from the database
+    once.  Use :func:`reference_data` to get the shared instance, rather
+    than creating a new one.  Where more than one record has the same
+    name or code, the first one (by database id) is indexed, which is
+    what ``.filter(...).first()`` would return.
+    '''
+
+    def __init__(self):
+        # index in database order, so the first record wins
+        countries = list(GeonamesCountry.objects.order_by('id'))
+        continents = list(GeonamesContinent.objects.order_by('id'))
+        states = list(StateCode.objects.order_by('id'))
+
+        #: list of all countries, by name
+        self.countries = sorted(countries, key=lambda c: c.name)
+        #: countries by name
+        self.country_by_name = index(countries, 'name')
+        #: countries by two-letter ISO code
+        self.country_by_code = index(countries, 'code')
+        #: countries by ISO-numeric code
+        self.country_by_numeric_code = index(countries, 'numeric_code')
+        #: countries by geonames id
+        self.country_by_geonames_id = index(countries, 'geonames_id')
+        #: lists of countries, by name, keyed on two-letter continent code
+        self.countries_by_continent = defaultdict(list)
+        for country in self.countries:
+            self.countries_by_continent[country.continent].append(country)
+        self.countries_by_continent = dict(self.countries_by_continent)
+
+        #: list of all continents, by name
+        self.continents = sorted(continents, key=lambda c: c.name)
+        #: continents by name
+        self.continent_by_name = index(continents, 'name')
+        #: continents by two-letter code
+        self.continent_by_code = index(continents, 'code')
+        #: continents by geonames id
+        self.continent_by_geonames_id = index(continents, 'geonames_id')
+
+        #: list of all U.S. states, by FIPS code
+        self.states = sorted(states, key=lambda s: s.fips)
+        #: states by name
+        self.state_by_name = index(states, 'name')
+        #: states by two-letter abbreviation
+        self.state_by_code = index(states, 'code')
+        #: states by numeric FIPS code
+        self.state_by_fips = index(states, 'fips')
+
+
+def index(items, attr):
+    # dictionary of items keyed on an attribute; first item wins
+    result = {}
+    for item in items:
+        result.setdefault(getattr(item, attr), item)
+    return result
+
+
+_reference_data = None
+_reference_data_lock = threading.Lock()
+
+
+def reference_data():
+    '''Process-wide :class:`ReferenceData`, loaded from the database the
+    first time it is needed.'''
+    global _reference_data
+    with _reference_data_lock:
+        if _reference_data is None:
+            _reference_data = ReferenceData()
+        return _reference_data
+
+
+def clear_reference_data():
+    '''Discard the loaded :class:`ReferenceData`, so that it is loaded
+    again the next time it is needed.  Called automatically when the
+    tables are changed in this process (e.g., via the admin site); other
+    processes keep their copy until they are restarted.'''
+    global _reference_data
+    with _reference_data_lock:
+        _reference_data = None
+
+
+@receiver(post_save, sender=GeonamesCountry)
+@receiver(post_save, sender=GeonamesContinent)
+@receiver(post_save, sender=StateCode)
+@receiver(post_delete, sender=GeonamesCountry)
+@receiver(post_delete, sender=GeonamesContinent)
+@receiver(post_delete, sender=StateCode)
+def reference_data_changed(sender, **kwargs):
+    clear_reference_data()
@@ -0,0 +1,271 @@
+# file ddisearch/geo/stats.py
+#
+# Copyright 2014 Emory University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# counters and timers for GeoNames requests and geocoding, so that the
+# cost of geocoding (in requests and credits) can be measured and the
+# most expensive names found
+
+from collections import Counter
+from contextlib import contextmanager
+import threading
+
+
+#: upper bounds of latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+#: upper bounds of histogram buckets for GeoNames calls per codebook
+CALL_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64)
+
+
+class Histogram(object):
+    '''Counts of values in fixed buckets, along with count, total and
+    maximum.  Not thread-safe on its own; callers should lock.
+
+    :param bounds: sorted upper bounds (inclusive) of the buckets; larger
+        values are counted in a final overflow bucket
+    '''
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = None
+
+    def add(self, value):
+        'Add a single value.'
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def summary(self):
+        '''Summary as a dictionary suitable for serializing as JSON: count,
+        total, mean, max, and the bucket counts as a list of upper bound
+        (or None, for the overflow bucket) and count.'''
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': float(self.total) / self.count if self.count else None,
+            'max': self.max,
+            'buckets': [[bound, count] for bound, count
+                        in zip(list(self.bounds) + [None], self.counts)],
+        }
+
+
+class GeonamesStats(object):
+    '''Request counts, credits used, errors and latency for a GeoNames
+    client, by endpoint.  Safe to update from parallel threads.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        'Clear all counts.'
+        with self._lock:
+            #: requests sent, by endpoint
+            self.requests = Counter()
+            #: responses used from the response cache instead, by endpoint
+            self.cached = Counter()
+            #: failed requests, by endpoint
+            self.errors = Counter()
+            #: GeoNames credits used
+            self.credits = 0
+            #: latency :class:`Histogram` for each endpoint
+            self.latency = {}
+
+    def request(self, endpoint, elapsed, credits=1, error=False):
+        '''Record a request.
+
+        :param endpoint: API endpoint, e.g. ``searchJSON``
+        :param elapsed: time for the request, in seconds
+        :param credits: GeoNames credits used by the request
+        :param error: whether the request failed
+        '''
+        with self._lock:
+            self.requests[endpoint] += 1
+            self.credits += credits
+            if error:
+                self.errors[endpoint] += 1
+            if endpoint not in self.latency:
+                self.latency[endpoint] = Histogram(LATENCY_BUCKETS)
+            self.latency[endpoint].add(elapsed)
+
+    def cache_hit(self, endpoint):
+        'Record a response used from the cache instead of a request.'
+        with self._lock:
+            self.cached[endpoint] += 1
+
+    def summary(self):
+        'Summary of the counts, as a dictionary suitable for serializing as JSON.'
+        with self._lock:
+            return {
+                'requests': dict(self.requests),
+                'cached': dict(self.cached),
+                'errors': dict(self.errors),
+                'credits': self.credits,
+                'latency': dict((endpoint, hist.summary())
+                                for endpoint, hist in self.latency.iteritems()),
+            }
+
+
+class GeocodeStats(object):
+    '''Counts for geocoding codebooks with
+    :class:`~ddisearch.geo.utils.CodebookGeocoder`: how terms were resolved
+    (without GeoNames, from the geocode cache, or with GeoNames), GeoNames
+    calls by purpose (including each fallback tier of name searches), calls
+    per codebook, and the names that were not found or were the most
+    expensive to look up.  Safe to update from parallel threads.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        'Clear all counts.'
+        with self._lock:
+            #: number of codebooks geocoded
+            self.codebooks = 0
+            #: terms resolved, by source (``country``, ``alias``, ``cache``,
+            #: ``cache_not_found``, ``geonames``, ``geonames_not_found``)
+            self.sources = Counter()
+            #: GeoNames calls, by purpose: name search tier (see
+            #: :attr:`~ddisearch.geo.utils.CodebookGeocoder.lookup_tiers`),
+            #: ``state``, ``continent`` or ``by_id``
+            self.calls = Counter()
+            #: names found, by name search tier
+            self.found = Counter()
+            #: names not found, with the number of times they were used
+            self.unresolved = Counter()
+            #: names, with the number of GeoNames calls used to look them up
+            self.expensive = Counter()
+            #: :class:`Histogram` of GeoNames calls per codebook
+            self.per_codebook = Histogram(CALL_BUCKETS)
+            #: :class:`Histogram` of time to look up a name with GeoNames
+            self.lookup_time = Histogram(LATENCY_BUCKETS)
+
+    def resolved(self, source):
+        'Record how a term was resolved.'
+        with self._lock:
+            self.sources[source] += 1
+
+    def call(self, purpose, name=None):
+        '''Record a GeoNames call, and add it to the tally for the current
+        thread, if any (see :meth:`tally`).
+
+        :param purpose: reason for the call, e.g. a search tier
+        :param name: name the call was made for, if any
+        '''
+        tally = getattr(self._local, 'tally', None)
+        with self._lock:
+            self.calls[purpose] += 1
+            if name is not None:
+                self.expensive[name] += 1
+            if tally is not None:
+                tally[purpose] += 1
+
+    @contextmanager
+    def tally(self, counter):
+        '''Context manager to also count GeoNames calls made in the
+        current thread in the specified counter, e.g. to count the calls
+        for a single codebook when its terms are looked up in parallel.'''
+        self._local.tally = counter
+        try:
+            yield counter
+        finally:
+            self._local.tally = None
+
+    def name_found(self, tier, elapsed):
+        '''Record a GeoNames name lookup.
+
+        :param tier: search tier the name was found with, or None
+        :param elapsed: time for the lookup, including all tiers tried
+        '''
+        with self._lock:
+            if tier is not None:
+                self.found[tier] += 1
+            self.lookup_time.add(elapsed)
+
+    def not_found(self, name):
+        'Record a term that could not be geocoded.'
+        with self._lock:
+            self.unresolved[name] += 1
+
+    def codebook(self, calls):
+        'Record a geocoded codebook and the number of GeoNames calls for it.'
+        with self._lock:
+            self.codebooks += 1
+            self.per_codebook.add(calls)
+
+    def summary(self, top=10):
+        '''Summary of the counts, as a dictionary suitable for serializing
+        as JSON.
+
+        :param top: number of unresolved and most expensive names to include
+        '''
+        with self._lock:
+            return {
+                'codebooks': self.codebooks,
+                'terms': dict(self.sources),
+                'calls': dict(self.calls),
+                'found': dict(self.found),
+                'calls_per_codebook': self.per_codebook.summary(),
+                'lookup_time': self.lookup_time.summary(),
+                'unresolved': self.unresolved.most_common(top),
+                'expensive': self.expensive.most_common(top),
+            }
+
+
+def counts(counter):
+    # counts as a readable list, largest first, e.g. "searchJSON 12, getJSON 3"
+    return ', '.join('%s %d' % (key, count) for key, count
+                     in sorted(counter.iteritems(), key=lambda item: -item[1])) \
+        or 'none'
+
+
+def report(summary, verbose=False):
+    '''Readable report of geocoding statistics, as returned by
+    :meth:`~ddisearch.geo.utils.CodebookGeocoder.statistics`.
+
+    :param verbose: include unresolved and most expensive names
+    :returns: list of lines
+    '''
+    geonames = summary['geonames']
+    lines = [
+        'Geocoded terms: %s' % counts(summary['terms']),
+        'GeoNames requests: %s; %d credits, %d cached, %d errors' % \
+            (counts(geonames['requests']), geonames['credits'],
+             sum(geonames['cached'].values()), sum(geonames['errors'].values())),
+        'GeoNames calls by purpose: %s' % counts(summary['calls']),
+    ]
+    per_codebook = summary['calls_per_codebook']
+    if per_codebook['count']:
+        lines.append('GeoNames calls per codebook: %.1f average, %d max' % \
+                     (per_codebook['mean'], per_codebook['max']))
+    if verbose:
+        if summary['expensive']:
+            lines.append('Most expensive names: %s' % ', '.join(
+                '%s (%d calls)' % item for item in summary['expensive']))
+        if summary['unresolved']:
+            lines.append('Names not found: %s' % ', '.join(
+                '%s (%d)' % item for item in summary['unresolved']))
+    return lines
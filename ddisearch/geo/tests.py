@@ -14,25 +14,53 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
+import importlib
+import json
+import logging
 import os
+import shutil
+from StringIO import StringIO
+import tempfile
+import time
+import zipfile
 from mock import patch, Mock
+import requests
 
+from django.apps import apps
 from django.conf import settings
+from django.db import connection
+from django.core.management.base import CommandError
+from django.test.utils import override_settings, CaptureQueriesContext
 from django.core.urlresolvers import reverse
+from django.http import HttpResponse
 from django.test import TestCase
 
-from eulxml.xmlmap import load_xmlobject_from_file
+from eulxml.xmlmap import load_xmlobject_from_file, load_xmlobject_from_string
 from eulexistdb import testutil as eulexistdb_testutil
 
 
 from ddisearch.ddi.models import CodeBook, GeographicCoverage
 from ddisearch.ddi.tests import FIXTURE_DIR
-from ddisearch.geo.models import Location, GeonamesContinent, GeonamesCountry
-from ddisearch.geo.geonames import GeonamesClient
+from ddisearch.geo.models import Location, GeonamesContinent, GeonamesCountry, \
+    GeocodeCache, GeonamesPlace, GeonamesPlaceWord, LocationAncestor, \
+    PlaceAlias, alias_key
+from ddisearch.geo.management.commands import clear_geocode_cache, \
+    import_geonames
+from ddisearch.geo.gazetteer import LocalGeonamesClient
+from ddisearch.geo.geonames import GeonamesClient, GeonamesException, \
+    RateLimiter
+from ddisearch.geo.reference import ReferenceData, reference_data, \
+    clear_reference_data
 from ddisearch.geo.utils import CodebookGeocoder
+from ddisearch.geo.aliases import AliasIndex
 from ddisearch.geo.templatetags import geo_tags
+from ddisearch.geo.testserver import GeonamesTestServer, load_places
+from ddisearch.geo.stats import Histogram, report as geocode_report
 
 
+logger = logging.getLogger(__name__)
+
 class CodebookGeocoderTest(TestCase):
 
     fixture_filename = '02988.xml'
@@ -40,8 +68,10 @@ class CodebookGeocoderTest(TestCase):
     mockgeonames = Mock(GeonamesClient)
 
     def setUp(self):
+        # look up terms serially, since worker threads don't share the
+        # test database transaction
         with patch('ddisearch.geo.utils.GeonamesClient', new=self.mockgeonames):
-            self.cbgeocoder = CodebookGeocoder()
+            self.cbgeocoder = CodebookGeocoder(workers=1)
 
         self.cb = load_xmlobject_from_file(os.path.join(FIXTURE_DIR,
                                                         self.fixture_filename),
@@ -80,10 +110,15 @@ class CodebookGeocoderTest(TestCase):
         self.assertEqual(None, self.cb.geo_coverage[1].id,
             'global geoCover should not get an id assigned')
 
+        # recoding with the same result should not report changes
+        self.assertFalse(self.cbgeocoder.code_locations(self.cb),
+            'code_locations should return False when ids are unchanged')
+
         # delete the id and recode; should *not* do a geocoder call
         del self.cb.geo_coverage[0].id
         self.mockgeonames.return_value.geocode.reset_mock()
-        self.cbgeocoder.code_locations(self.cb)
+        self.assertTrue(self.cbgeocoder.code_locations(self.cb),
+            'code_locations should return True when ids are added')
         self.assertEqual('geonames:%s' % mocklocation.raw['geonameId'],
             self.cb.geo_coverage[0].id,
             'first geoCover (Israel) should have geonames id based on db lookup')
@@ -111,8 +146,12 @@ class CodebookGeocoderTest(TestCase):
         self.cb.geo_coverage.append(GeographicCoverage(val='Puerto Rico'))
         self.mockgeonames.return_value.geocode.reset_mock()
 
-        with patch('ddisearch.geo.utils.Location') as mockdbloc:
+        with patch('ddisearch.geo.utils.Location') as mockdbloc, \
+          patch('ddisearch.geo.utils.GeocodeCache') as mockcache, \
+          patch.object(self.cbgeocoder.aliases, 'learn_many'):
             mockdbloc.objects.filter.return_value.count.return_value = 0
+            # nothing cached, so every name is geocoded
+            mockcache.objects.filter.return_value.first.return_value = None
             self.cbgeocoder.code_locations(self.cb)
 
             self.mockgeonames.return_value.geocode.assert_any_call(name_equals=self.cb.geo_coverage[0].val,
@@ -151,3 +190,734 @@ class CodebookGeocoderTest(TestCase):
         print self.mockgeonames.return_value.geocode.call_args_list
         self.mockgeonames.return_value.geocode.assert_any_call(name_equals='Hiroshima',
             feature_class='A')
+
+    def test_rate_limiter(self):
+        # 2 credits per second; the first two are available immediately
+        limiter = RateLimiter([(2, 1), (100, 3600)])
+        with patch('ddisearch.geo.geonames.time') as mocktime:
+            mocktime.time.return_value = 1000.0
+            limiter.last = 1000.0
+            self.assertEqual(0, limiter.acquire())
+            self.assertEqual(0, limiter.acquire())
+            self.assertEqual(0, mocktime.sleep.call_count)
+
+            # next credit requires waiting half a second for a refill
+            def sleep(seconds):
+                mocktime.time.return_value += seconds
+            mocktime.sleep.side_effect = sleep
+            self.assertEqual(0.5, limiter.acquire())
+            mocktime.sleep.assert_called_once_with(0.5)
+
+            # hourly limit applies too
+            self.assertAlmostEqual(97.0, limiter.buckets[1][1], places=1)
+
+        client = GeonamesClient('user', rate_limiter=Mock(RateLimiter))
+        client._local.session = Mock()
+        client.session.get.return_value.status_code = 200
+        client.session.get.return_value.json.return_value = {'totalResultsCount': 0}
+        client.geocode(name='Nowhere')
+        client.rate_limiter.acquire.assert_called_once_with()
+
+    def _resolve(self, name, geo_options=()):
+        # resolve a single term and save the result, as code_locations does
+        term = (name, False, geo_options)
+        result = self.cbgeocoder.resolve_term(term)
+        self.cbgeocoder.save_results([(term, result)])
+        return result[0]
+
+    def test_get_locations(self):
+        mocklocation = self._mocklocation()
+        locations = self.cbgeocoder.get_locations({294640: mocklocation})
+        dbloc = locations[294640]
+        self.assertEqual(mocklocation.raw['geonameId'], dbloc.geonames_id)
+        self.assertEqual('IL', dbloc.country_code)
+        self.assertEqual('AS', dbloc.continent_code)
+        self.assertEqual(None, dbloc.state_code,
+            'adminCode1 of 00 should not be stored as a state code')
+
+        # same geonames id again should return the existing record
+        self.assertEqual(dbloc, self.cbgeocoder.get_locations({294640: mocklocation})[294640])
+        self.assertEqual(1, Location.objects.filter(geonames_id=dbloc.geonames_id).count(),
+            'location should only be created once per geonames id')
+
+    def test_geocode_cache(self):
+        geocode = self.mockgeonames.return_value.geocode
+        geocode.reset_mock()
+        geocode.side_effect = None
+        geocode.return_value = self._mocklocation()
+
+        # aliases are not learned, so that only the cache is tested
+        with patch.object(self.cbgeocoder.aliases, 'learn_many'):
+            # miss: geocoded and cached
+            self.assertEqual(294640, self._resolve('Israel'))
+            self.assertEqual(1, geocode.call_count)
+            self.assertEqual(294640,
+                GeocodeCache.objects.get(name='israel', options='').geonames_id)
+
+            # hit: name is normalized; no geocoding
+            geocode.reset_mock()
+            self.assertEqual(294640, self._resolve(' ISRAEL '))
+            self.assertEqual(0, geocode.call_count)
+
+            # different search options are cached separately
+            geocode.return_value = None
+            self.assertEqual(None, self._resolve('Israel', (('country', 'US'),)))
+            self.assert_(geocode.call_count,
+                'geocode should be called for different search options')
+            cached = GeocodeCache.objects.get(name='israel', options='country=US')
+            self.assertEqual(None, cached.geonames_id)
+
+            # negative result is cached until it expires
+            geocode.reset_mock()
+            self.assertEqual(None, self._resolve('Israel', (('country', 'US'),)))
+            self.assertEqual(0, geocode.call_count)
+            GeocodeCache.objects.filter(pk=cached.pk).update(
+                updated=cached.updated - datetime.timedelta(days=2))
+            with override_settings(GEOCODE_CACHE_NEGATIVE_TTL=1):
+                self._resolve('Israel', (('country', 'US'),))
+            self.assert_(geocode.call_count,
+                'geocode should be called when negative result has expired')
+
+        self.assertEqual({'cache': 1, 'cache_not_found': 1, 'geonames': 1,
+                          'geonames_not_found': 2},
+                         dict(self.cbgeocoder.stats.sources))
+
+    def test_code_locations_cache(self):
+        geocode = self.mockgeonames.return_value.geocode
+        geocode.reset_mock()
+        geocode.side_effect = None
+        geocode.return_value = self._mocklocation()
+        while self.cb.geo_coverage:
+            del self.cb.geo_coverage[0]
+        self.cb.geo_coverage.append(GeographicCoverage(val='Galilee'))
+
+        self.cbgeocoder.code_locations(self.cb)
+        self.assertEqual(1, geocode.call_count)
+        self.assertEqual(294640,
+            GeocodeCache.objects.get(name='galilee', options='').geonames_id)
+
+        # cached result is used for later codebooks
+        geocode.reset_mock()
+        self.cbgeocoder.aliases.learned.clear()
+        del self.cb.geo_coverage[0].id
+        self.cbgeocoder.code_locations(self.cb)
+        self.assertEqual(0, geocode.call_count)
+        self.assertEqual('geonames:294640', self.cb.geo_coverage[0].id)
+        self.assertEqual(1, self.cbgeocoder.stats.sources['cache'])
+
+    def test_lookup_alias(self):
+        geocode = self.mockgeonames.return_value.geocode
+        geocode.reset_mock()
+        geocode.side_effect = None
+        geocode.return_value = self._mocklocation()
+
+        # successful geocoding result is learned as an alias
+        self.assertEqual(294640, self._resolve('State of Israel'))
+        self.assertEqual(1, PlaceAlias.objects.filter(key='israel state',
+                                                      geonames_id=294640).count())
+
+        # variant forms of the name are found without geocoding
+        geocode.reset_mock()
+        self.assertEqual(294640, self._resolve('Israel, State of'))
+        self.assertEqual(294640, self._resolve('STATE OF ISRAEL'))
+        self.assertEqual(0, geocode.call_count)
+        self.assertEqual(2, self.cbgeocoder.stats.sources['alias'])
+        # aliases are specific to search options
+        geocode.return_value = None
+        self.assertEqual(None, self._resolve('Israel, State of', (('country', 'US'),)))
+        self.assert_(geocode.call_count)
+
+    def test_code_locations_aliases(self):
+        geocode = self.mockgeonames.return_value.geocode
+        geocode.reset_mock()
+        geocode.side_effect = None
+        geocode.return_value = self._mocklocation()
+        while self.cb.geo_coverage:
+            del self.cb.geo_coverage[0]
+        for name in ['State of Israel', 'Israel, State of']:
+            self.cb.geo_coverage.append(GeographicCoverage(val=name))
+
+        # variants in the same codebook are each looked up, since
+        # aliases are only learned once all of the terms are resolved
+        # (otherwise the result would depend on the order of parallel lookups)
+        self.cbgeocoder.code_locations(self.cb)
+        self.assertEqual(2, geocode.call_count)
+        self.assertEqual(0, self.cbgeocoder.stats.sources['alias'])
+        self.assertEqual(['geonames:294640', 'geonames:294640'],
+                         [geog.id for geog in self.cb.geo_coverage])
+
+        # learned aliases are used for later codebooks
+        geocode.reset_mock()
+        self.cb.geo_coverage[0].val = 'STATE OF ISRAEL'
+        self.cbgeocoder.code_locations(self.cb)
+        self.assertEqual(0, geocode.call_count)
+        self.assertEqual(2, self.cbgeocoder.stats.sources['alias'])
+
+    def test_code_locations_parallel(self):
+        places = dict((name, Location.objects.create(name=name, geonames_id=i,
+                                                     latitude=0, longitude=0,
+                                                     feature_code='PPL'))
+                      for i, name in enumerate(['California', 'Alaska', 'Georgia',
+                                                'Puerto Rico', 'Portland'], 1))
+        lookups = []
+
+        def resolve_term(term, cache=None):
+            lookups.append(term)
+            # finish lookups out of order
+            time.sleep(0.01 * (5 - places[term[0]].geonames_id))
+            return places[term[0]].geonames_id, None
+
+        self.cb.geo_coverage[0].val = 'California'
+        self.cb.geo_coverage[1].val = 'Alaska'
+        for name in ['Georgia', 'Puerto Rico', 'Portland (Maine)', 'Alaska']:
+            self.cb.geo_coverage.append(GeographicCoverage(val=name))
+
+        results = []
+        for workers in [1, 4]:
+            cb = load_xmlobject_from_string(self.cb.serialize(), CodeBook)
+            with patch('ddisearch.geo.utils.GeonamesClient', new=self.mockgeonames):
+                cbgeocoder = CodebookGeocoder(workers=workers)
+            del lookups[:]
+            with patch.object(cbgeocoder, 'resolve_term', new=resolve_term):
+                self.assertTrue(cbgeocoder.code_locations(cb))
+            self.assertEqual(5, len(lookups),
+                'each distinct term should only be looked up once')
+            results.append([geog.id for geog in cb.geo_coverage])
+
+        self.assertEqual(['geonames:1', 'geonames:2', 'geonames:3', 'geonames:4',
+                          'geonames:5', 'geonames:2'], results[0])
+        self.assertEqual(results[0], results[1],
+            'parallel lookups should give the same results as serial')
+
+    def test_code_locations_queries(self):
+        # benchmark: count the queries needed to geocode a codebook; they
+        # should not grow with the number of terms
+        def geocode(name_equals=None, **kwargs):
+            number = int(name_equals.split()[-1])
+            loc = self._mocklocation()
+            loc.raw = dict(loc.raw, name=name_equals, geonameId=1000 + number,
+                           fcode='PPL', countryCode='US', adminCode1='GA')
+            return loc
+        self.mockgeonames.return_value.geocode.side_effect = geocode
+
+        counts = {}
+        try:
+            for size in [2, 10, 40]:
+                cb = load_xmlobject_from_string(self.cb.serialize(), CodeBook)
+                while cb.geo_coverage:
+                    del cb.geo_coverage[0]
+                for i in range(size):
+                    cb.geo_coverage.append(GeographicCoverage(val='Place %d' % (size + i)))
+
+                # new places; then known places (found by learned aliases);
+                # then cached names
+                with CaptureQueriesContext(connection) as new:
+                    self.cbgeocoder.code_locations(cb)
+                self.assertEqual(size, Location.objects.filter(
+                    name__in=[geog.val for geog in cb.geo_coverage]).count())
+                self.assertEqual(size, GeocodeCache.objects.filter(
+                    name__in=[geog.val.lower() for geog in cb.geo_coverage]).count())
+                with CaptureQueriesContext(connection) as known:
+                    self.cbgeocoder.code_locations(cb)
+                self.cbgeocoder.aliases.learned.clear()
+                with CaptureQueriesContext(connection) as cached:
+                    self.cbgeocoder.code_locations(cb)
+                counts[size] = (len(new), len(known), len(cached))
+                logger.info('%d terms: %d queries for new places, %d for known '
+                            'places, %d for cached names', size, *counts[size])
+        finally:
+            self.mockgeonames.return_value.geocode.side_effect = None
+
+        self.assertEqual(counts[2], counts[10])
+        self.assertEqual(counts[2], counts[40])
+        self.assertEqual((2, 2), counts[2][1:],
+            'known places should need one cache query and one location query')
+        self.assertEqual(0, self.cbgeocoder.stats.sources['geonames_not_found'])
+        self.assertEqual(2 + 10 + 40, self.cbgeocoder.stats.sources['cache'])
+
+    def test_clear_geocode_cache(self):
+        GeocodeCache.objects.create(name='israel', options='', geonames_id=294640)
+        GeocodeCache.objects.create(name='atlantis', options='')
+        old = GeocodeCache.objects.create(name='lemuria', options='')
+        GeocodeCache.objects.filter(pk=old.pk).update(
+            updated=old.updated - datetime.timedelta(days=60))
+
+        cmd = clear_geocode_cache.Command()
+        cmd.stdout = StringIO()
+        cmd.handle(expired=True)
+        self.assertEqual(['atlantis', 'israel'],
+            sorted(GeocodeCache.objects.values_list('name', flat=True)))
+        cmd.handle(not_found=True)
+        self.assertEqual(['israel'], list(GeocodeCache.objects.values_list('name', flat=True)))
+        PlaceAlias.objects.create(key='israel', options='', geonames_id=294640)
+        PlaceAlias.objects.create(key='atlantis', options='', geonames_id=1)
+        cmd.handle('Israel')
+        self.assertEqual(0, GeocodeCache.objects.count())
+        self.assertEqual(['atlantis'], list(PlaceAlias.objects.values_list('key', flat=True)))
+        self.assertEqual('1 cached geocode result removed' * 3 + '1 learned alias removed',
+                         cmd.stdout.getvalue())
+
+
+# sample GeoNames dump content, in the standard geoname table format
+GEONAMES_DUMP = '''6252001\tUnited States\tUnited States\tUSA,United States of America\t39.76\t-98.5\tA\tPCLI\tUS\t\t00\t\t\t\t310232863\t\t543\t\t2012-01-18
+5332921\tCalifornia\tCalifornia\tCA\t37.25022\t-119.75126\tA\tADM1\tUS\t\tCA\t\t\t\t37691912\t\t115\tAmerica/Los_Angeles\t2012-01-18
+4197000\tGeorgia\tGeorgia\tGA\t32.75042\t-83.50018\tA\tADM1\tUS\t\tGA\t\t\t\t9919945\t\t180\tAmerica/New_York\t2012-01-18
+614540\tGeorgia\tGeorgia\tSakartvelo\t42.0\t43.5\tA\tPCLI\tGE\t\t00\t\t\t\t4630000\t\t859\tAsia/Tbilisi\t2012-01-18
+5746545\tPortland\tPortland\t\t45.52345\t-122.67621\tP\tPPLA2\tUS\t\tOR\t051\t\t\t632309\t15\t25\tAmerica/Los_Angeles\t2012-01-18
+4975802\tPortland\tPortland\t\t43.66147\t-70.25533\tP\tPPLA2\tUS\t\tME\t005\t\t\t66881\t9\t14\tAmerica/New_York\t2012-01-18
+'''
+
+ADMIN1_CODES = '''US.CA\tCalifornia\tCalifornia\t5332921
+US.GA\tGeorgia\tGeorgia\t4197000
+US.OR\tOregon\tOregon\t5744337
+US.ME\tMaine\tMaine\t4971068
+'''
+
+
+class GeonamesClientTest(TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.client = GeonamesClient('user', rate_limiter=Mock(RateLimiter),
+                                     cache_dir=self.cache_dir, cache_ttl=60)
+        self.client._local.session = Mock()
+        self.response = self.client.session.get.return_value
+        self.response.status_code = 200
+        self.response.json.return_value = {'totalResultsCount': 1, 'geonames': [
+            {'geonameId': 294640, 'name': 'Israel', 'lat': '31.5', 'lng': '34.75'}]}
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_session(self):
+        client = GeonamesClient('user')
+        self.assert_(client.session is client.session,
+            'session should be reused within a thread')
+        adapter = client.session.get_adapter('http://api.geonames.org')
+        self.assertEqual(3, adapter.max_retries.total)
+
+    def test_cache(self):
+        loc = self.client.geocode(name_equals='Israel')
+        self.assertEqual(294640, loc.raw['geonameId'])
+        self.client.session.get.assert_called_once_with(
+            'http://api.geonames.org/searchJSON', timeout=10,
+            params={'username': 'user', 'orderBy': 'relevance', 'maxRows': 1,
+                    'name_equals': 'Israel'})
+
+        # cached: no request and no credits used
+        self.assertEqual(294640, self.client.geocode(name_equals='Israel').raw['geonameId'])
+        self.assertEqual(1, self.client.session.get.call_count)
+        self.assertEqual(1, self.client.rate_limiter.acquire.call_count)
+        self.assertEqual({'searchJSON': 1}, self.client.stats.requests)
+        self.assertEqual({'searchJSON': 1}, self.client.stats.cached)
+        self.assertEqual(1, self.client.stats.credits)
+
+        # cache key ignores username and parameter order
+        self.assertEqual(
+            self.client.cache_key('searchJSON', {'a': 1, 'b': 2, 'username': 'x'}),
+            self.client.cache_key('searchJSON', {'b': 2, 'a': 1}))
+        # non-ascii names are not conflated
+        self.assertNotEqual(
+            self.client.cache_key('searchJSON', {'name': u'Z\xfcrich'}),
+            self.client.cache_key('searchJSON', {'name': u'Z\xe4rich'}))
+        self.assertEqual('searchJSON?name=Z%C3%BCrich',
+            self.client.cache_key('searchJSON', {'name': u'Z\xfcrich'}))
+
+        # expired cache is not used
+        self.client.cache_ttl = 0
+        self.client.geocode(name_equals='Israel')
+        self.assertEqual(2, self.client.session.get.call_count)
+
+    def test_errors(self):
+        # error status is raised and not cached
+        self.response.json.return_value = {'status': {'value': 19,
+            'message': 'the hourly limit of 1000 credits has been exceeded'}}
+        self.assertRaises(GeonamesException, self.client.geocode, name='Israel')
+        self.assertEqual([], os.listdir(self.cache_dir))
+        self.assertEqual({'searchJSON': 1}, self.client.stats.errors)
+        self.assertEqual(0, self.client.stats.credits)
+
+        self.response.status_code = 503
+        self.assertRaises(GeonamesException, self.client.get_by_id, 294640)
+
+        self.client.session.get.side_effect = requests.exceptions.Timeout('timed out')
+        self.assertRaises(GeonamesException, self.client.geocode, name='Israel')
+
+
+class LocalGeonamesTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dumpfile = os.path.join(self.tmpdir, 'sample.txt')
+        with open(self.dumpfile, 'w') as dump:
+            dump.write(GEONAMES_DUMP)
+        self.admin1file = os.path.join(self.tmpdir, 'admin1CodesASCII.txt')
+        with open(self.admin1file, 'w') as admin1:
+            admin1.write(ADMIN1_CODES)
+
+        self.cmd = import_geonames.Command()
+        self.cmd.stdout = StringIO()
+        self.cmd.handle(self.dumpfile, admin1=self.admin1file)
+        self.geonames = LocalGeonamesClient()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_import(self):
+        self.assertEqual('6 places imported', self.cmd.stdout.getvalue())
+        place = GeonamesPlace.objects.get(geonames_id=4975802)
+        self.assertEqual('Portland', place.name)
+        self.assertEqual('portland', place.name_key)
+        self.assertEqual('Maine', place.admin_name1)
+        self.assertEqual(66881, place.population)
+        self.assertEqual('usa|united states of america',
+            GeonamesPlace.objects.get(geonames_id=6252001).alternate_names)
+
+        # importing again (from a zip file) replaces existing places
+        zipname = os.path.join(self.tmpdir, 'sample.zip')
+        with zipfile.ZipFile(zipname, 'w') as archive:
+            archive.write(self.dumpfile, 'sample.txt')
+        self.cmd.handle(zipname)
+        self.assertEqual(6, GeonamesPlace.objects.count())
+        self.assertEqual('', GeonamesPlace.objects.get(geonames_id=4975802).admin_name1)
+
+        self.assertRaises(CommandError, self.cmd.handle)
+        self.assertRaises(CommandError, self.cmd.handle,
+                          os.path.join(self.tmpdir, 'missing.txt'))
+
+    def test_geocode(self):
+        # exact name, ignoring case; country ranked before state
+        loc = self.geonames.geocode(name_equals='georgia', feature_class='A')
+        self.assertEqual(614540, loc.raw['geonameId'])
+        self.assertEqual('GE', loc.raw['countryCode'])
+        loc = self.geonames.geocode(name_equals='Georgia', feature_class='A',
+                                    country='US', admin_code1='GA')
+        self.assertEqual(4197000, loc.raw['geonameId'])
+        self.assertEqual('Georgia', loc.raw['adminName1'])
+
+        # feature class list; larger population first
+        loc = self.geonames.geocode(name_equals='Portland', feature_class=['A', 'P'])
+        self.assertEqual(5746545, loc.raw['geonameId'])
+        self.assertEqual(45.52345, float(loc.latitude))
+        loc = self.geonames.geocode(name_equals='Portland', feature_class=['A', 'P'],
+                                    country='US', admin_code1='ME')
+        self.assertEqual(4975802, loc.raw['geonameId'])
+        self.assertEqual(None, self.geonames.geocode(name_equals='Portland',
+                                                     feature_class='A'))
+
+        # exact name doesn't match alternate names; looser search does
+        self.assertEqual(None, self.geonames.geocode(name_equals='USA'))
+        loc = self.geonames.geocode(name='america', feature_class='A')
+        self.assertEqual(6252001, loc.raw['geonameId'])
+        self.assertEqual(None, self.geonames.geocode(name='ameri'),
+            'loose name search should match whole words only')
+
+        # no name; feature code and admin code only
+        loc = self.geonames.geocode(country='US', feature_code='ADM1', admin_code1='CA')
+        self.assertEqual(5332921, loc.raw['geonameId'])
+
+        results = self.geonames.geocode(name='portland', exactly_one=False)
+        self.assertEqual([5746545, 4975802], [r.raw['geonameId'] for r in results])
+
+    def test_geocode_words(self):
+        # words in the distinct place names are indexed
+        self.assertEqual(set([(0, 'united'), (0, 'states'), (1, 'usa'), (2, 'united'),
+                              (2, 'states'), (2, 'of'), (2, 'america')]),
+            set(GeonamesPlaceWord.objects.filter(place__geonames_id=6252001) \
+                .values_list('name', 'word')))
+
+        # every word must be in the same name
+        loc = self.geonames.geocode(name='america states')
+        self.assertEqual(6252001, loc.raw['geonameId'])
+        self.assertEqual(None, self.geonames.geocode(name='usa america'))
+
+        # whole-word matches are found even when larger places have names
+        # containing the same text
+        with open(self.dumpfile, 'w') as dump:
+            dump.write('1\tAmericana\tAmericana\t\t-22.7\t-47.3\tP\tPPL\tBR\t\t27\t\t\t\t999999999\t\t\t\t2012-01-18\n')
+        self.cmd.handle(self.dumpfile)
+        with patch('ddisearch.geo.gazetteer.MAX_CANDIDATES', 1):
+            loc = self.geonames.geocode(name='america')
+        self.assertEqual(6252001, loc.raw['geonameId'])
+
+        # results are limited to the most relevant places, not the most
+        # populous: exact name matches and feature rank come first
+        with open(self.dumpfile, 'w') as dump:
+            dump.write('2\tPortland Heights\tPortland Heights\t\t45.5\t-122.7\tP\tPPL\tUS\t\tOR\t\t\t\t999999999\t\t\t\t2012-01-18\n')
+            dump.write('3\tPortland County\tPortland County\t\t45.4\t-122.6\tA\tADM2\tUS\t\tOR\t\t\t\t9999\t\t\t\t2012-01-18\n')
+        self.cmd.handle(self.dumpfile)
+        with patch('ddisearch.geo.gazetteer.MAX_CANDIDATES', 1):
+            loc = self.geonames.geocode(name='portland')
+            self.assertEqual(5746545, loc.raw['geonameId'])
+            # without an exact match, ADM2 is ranked before a more populous PPL
+            loc = self.geonames.geocode(name='portland', feature_code=['ADM2', 'PPL'])
+            self.assertEqual(3, loc.raw['geonameId'])
+
+    def test_get_by_id(self):
+        self.assertEqual('California', self.geonames.get_by_id(5332921).raw['name'])
+        self.assertRaises(GeonamesException, self.geonames.get_by_id, 1)
+
+    def test_codebook_geocoder(self):
+        with override_settings(GEONAMES_LOCAL=True):
+            self.assert_(isinstance(CodebookGeocoder().geonames, LocalGeonamesClient))
+
+
+class GeonamesTestServerTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dumpfile = os.path.join(self.tmpdir, 'sample.txt')
+        with open(self.dumpfile, 'w') as dump:
+            dump.write(GEONAMES_DUMP)
+        self.server = GeonamesTestServer(load_places([self.dumpfile])).start()
+        self.client = GeonamesClient('user', base_url=self.server.url, retries=0)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_search(self):
+        loc = self.client.geocode(name_equals='Georgia', feature_class='A')
+        self.assertEqual(614540, loc.raw['geonameId'])
+        loc = self.client.geocode(name_equals='Georgia', feature_class=['A', 'P'],
+                                  country='US')
+        self.assertEqual(4197000, loc.raw['geonameId'])
+        self.assertEqual('GA', loc.raw['adminCode1'])
+        self.assertEqual(2, len(self.client.geocode(name='portland', exactly_one=False)))
+        self.assertEqual(None, self.client.geocode(name_equals='Atlantis'))
+        self.assertEqual(4, self.server.requests['searchJSON'])
+
+        loc = self.client.get_by_id(5332921)
+        self.assertEqual('California', loc.raw['name'])
+        self.assertRaises(GeonamesException, self.client.get_by_id, 1)
+
+        # json fixture with places in the web service format
+        fixture = os.path.join(self.tmpdir, 'places.json')
+        with open(fixture, 'w') as places:
+            json.dump([loc.raw], places)
+        self.assertEqual(['California'], [p.name for p in load_places([fixture])])
+
+    def test_latency_and_errors(self):
+        self.server.latency = 0.05
+        start = time.time()
+        self.client.get_by_id(5332921)
+        self.assert_(time.time() - start >= 0.05)
+
+        self.server.latency = 0
+        self.server.error_rate = 1
+        self.assertRaises(GeonamesException, self.client.get_by_id, 5332921)
+        self.server.error = 'credits'
+        self.assertRaises(GeonamesException, self.client.geocode, name='Georgia')
+
+    def test_codebook_geocoder(self):
+        cb = load_xmlobject_from_file(os.path.join(FIXTURE_DIR, '02988.xml'), CodeBook)
+        cb.geo_coverage[0].val = 'California'
+        with override_settings(GEONAMES_URL=self.server.url, GEONAMES_LOCAL=False,
+                               GEONAMES_CACHE_DIR=None):
+            cbgeocoder = CodebookGeocoder(workers=1)
+        cbgeocoder.code_locations(cb)
+        self.assertEqual('geonames:5332921', cb.geo_coverage[0].id)
+        self.assert_(Location.objects.filter(geonames_id=5332921).exists())
+
+    def test_statistics(self):
+        cb = load_xmlobject_from_file(os.path.join(FIXTURE_DIR, '02988.xml'), CodeBook)
+        cb.geo_coverage[0].val = 'California'
+        cb.geo_coverage[1].val = 'Atlantis'
+        cb.geo_coverage.append(GeographicCoverage(val='Georgia'))
+        with override_settings(GEONAMES_URL=self.server.url, GEONAMES_LOCAL=False,
+                               GEONAMES_CACHE_DIR=None):
+            cbgeocoder = CodebookGeocoder(workers=1)
+        cbgeocoder.code_locations(cb)
+
+        stats = cbgeocoder.statistics()
+        self.assertEqual(1, stats['codebooks'])
+        self.assertEqual({'country': 1, 'geonames': 1, 'geonames_not_found': 1},
+                         stats['terms'])
+        # California is found by the first search; Atlantis uses every tier;
+        # Georgia is a known country, fetched by id
+        self.assertEqual({'exact': 2, 'exact_populated': 1, 'name': 1,
+                          'name_populated': 1, 'by_id': 1}, stats['calls'])
+        self.assertEqual({'exact': 1}, stats['found'])
+        self.assertEqual([('Atlantis', 1)], stats['unresolved'])
+        self.assertEqual(('Atlantis', 4), stats['expensive'][0])
+        self.assertEqual(6, stats['calls_per_codebook']['total'])
+        self.assertEqual(2, stats['lookup_time']['count'])
+        self.assertEqual({'searchJSON': 5, 'getJSON': 1}, stats['geonames']['requests'])
+        self.assertEqual(6, stats['geonames']['credits'])
+        self.assertEqual(6, sum(self.server.requests.values()))
+        self.assertEqual(5, stats['geonames']['latency']['searchJSON']['count'])
+        json.dumps(stats)
+
+        lines = geocode_report(stats, verbose=True)
+        self.assert_('GeoNames requests: searchJSON 5, getJSON 1; 6 credits, 0 cached, 0 errors'
+                     in lines)
+        self.assert_('Names not found: Atlantis (1)' in lines)
+
+        cbgeocoder.stats.reset()
+        self.assertEqual(0, cbgeocoder.statistics()['codebooks'])
+
+    def test_histogram(self):
+        hist = Histogram((1, 5))
+        for value in [0.5, 1, 3, 10]:
+            hist.add(value)
+        summary = hist.summary()
+        self.assertEqual([[1, 2], [5, 1], [None, 1]], summary['buckets'])
+        self.assertEqual(4, summary['count'])
+        self.assertEqual(10, summary['max'])
+        self.assertEqual(3.625, summary['mean'])
+
+
+class ReferenceDataTest(TestCase):
+    fixtures = ['test_locations.json']
+
+    def setUp(self):
+        clear_reference_data()
+
+    def tearDown(self):
+        clear_reference_data()
+
+    def test_indexes(self):
+        refdata = ReferenceData()
+        self.assertEqual('Israel', refdata.country_by_code['IL'].name)
+        self.assertEqual('IL', refdata.country_by_name['Israel'].code)
+        self.assertEqual('IL', refdata.country_by_numeric_code[376].code)
+        self.assertEqual('IL', refdata.country_by_geonames_id[294640].code)
+        self.assert_(refdata.country_by_code['IL'] in refdata.countries_by_continent['AS'])
+        self.assertEqual('AF', refdata.continent_by_name['Africa'].code)
+        self.assertEqual('Africa', refdata.continent_by_geonames_id[6255146].name)
+        self.assertEqual(13, refdata.state_by_code['GA'].fips)
+        self.assertEqual('GA', refdata.state_by_fips[13].code)
+        names = [c.name for c in refdata.continents]
+        self.assertEqual(sorted(names), names)
+
+    def test_reference_data(self):
+        refdata = reference_data()
+        with self.assertNumQueries(0):
+            self.assert_(reference_data() is refdata,
+                'reference data should only be loaded once')
+
+        # changes to the tables are picked up
+        africa = GeonamesContinent.objects.get(code='AF')
+        africa.name = 'Afrika'
+        africa.save()
+        self.assertEqual('Afrika', reference_data().continent_by_code['AF'].name)
+
+    def test_codebook_ids(self):
+        cb = load_xmlobject_from_string('''<codeBook><stdyDscr><stdyInfo><sumDscr>
+            <geogCover id="geonames:294640">Israel</geogCover>
+            <geogCover id="geonames:6255149">North America</geogCover>
+            <geogCover id="geonames:4990729">Detroit</geogCover>
+            </sumDscr></stdyInfo></stdyDscr></codeBook>''', CodeBook)
+        reference_data()
+        # only the locations for the record are queried
+        with self.assertNumQueries(1):
+            self.assertEqual([26], cb.us_state_ids)
+        with self.assertNumQueries(2):
+            country_ids = cb.country_ids
+        self.assert_(376 in country_ids)
+        self.assert_(124 in country_ids and 840 in country_ids,
+            'countries in a referenced continent should be included')
+        self.assertEqual(sorted(set(country_ids)), country_ids)
+
+
+class LocationHierarchyTest(TestCase):
+    fixtures = ['test_locations.json']
+
+    def links(self):
+        return set(LocationAncestor.objects.values_list('location__name',
+                                                        'ancestor__name', 'depth'))
+
+    def ancestors(self, name):
+        return set(ancestor for location, ancestor, depth in self.links()
+                   if location == name and depth > 0)
+
+    def test_hierarchy(self):
+        detroit = Location.objects.get(name='Detroit')
+        michigan = Location.objects.get(name='Michigan')
+        self.assertEqual(set(['North America', 'Michigan']), self.ancestors('Detroit'))
+        self.assertEqual([detroit], list(michigan.descendants()))
+        self.assertEqual(set([michigan, detroit]),
+                         set(michigan.descendants(include_self=True)))
+        self.assertEqual(set(), self.ancestors('Israel'))
+
+        # adding a location links it to existing locations above and below
+        usa = Location.objects.create(name='United States', geonames_id=6252001,
+            latitude=39.76, longitude=-98.5, country_code='US',
+            feature_code='PCLI', continent_code='NA')
+        self.assertEqual(set(['North America', 'United States', 'Michigan']),
+                         self.ancestors('Detroit'))
+        self.assertEqual(set([michigan, detroit]), set(usa.descendants()))
+        self.assertEqual(2, LocationAncestor.objects.get(location=detroit,
+                                                         ancestor=usa).depth)
+
+        # changed codes are picked up
+        detroit.state_code = 'OH'
+        detroit.save()
+        self.assertEqual(set(['North America', 'United States']), self.ancestors('Detroit'))
+        self.assertEqual([], list(michigan.descendants()))
+
+    @patch('ddisearch.geo.views.resources_by_location')
+    @patch('ddisearch.geo.views.render')
+    def test_browse_state(self, mockrender, mockresources):
+        # regions with the same state code are listed with places in the state
+        region = Location.objects.create(name='Upper Peninsula', geonames_id=5013767,
+            latitude=46.5, longitude=-87.0, country_code='US', state_code='MI',
+            feature_code='RGN', continent_code='NA')
+        # as are places in the same state
+        Location.objects.create(name='Ann Arbor', geonames_id=4984247,
+            latitude=42.28, longitude=-83.74, country_code='US', state_code='MI',
+            feature_code='PPL', continent_code='NA')
+        # but not places with the same state code in another country
+        Location.objects.create(name='Mitte', geonames_id=2870912,
+            latitude=52.5, longitude=13.4, country_code='DE', state_code='MI',
+            feature_code='PPL', continent_code='EU')
+        mockrender.return_value = HttpResponse()
+        self.client.get(reverse('geo:state', kwargs={'continent': 'NA',
+                                                     'country': 'US', 'state': 'MI'}))
+        places = mockrender.call_args[0][2]['places']
+        self.assertEqual(set(['Detroit', 'Ann Arbor', 'Upper Peninsula']),
+                         set(p.name for p in places))
+
+        # region page lists places in the state too, but not the region itself
+        Location.objects.filter(name='Michigan').delete()
+        self.client.get(reverse('geo:state', kwargs={'continent': 'NA',
+                                                     'country': 'US', 'state': 'MI'}))
+        places = mockrender.call_args[0][2]['places']
+        self.assertEqual(region, mockrender.call_args[0][2]['current_place'])
+        self.assertEqual(set(['Detroit', 'Ann Arbor']), set(p.name for p in places))
+
+    def test_migration(self):
+        # links built for existing locations match those kept up to date
+        migration = importlib.import_module('ddisearch.geo.migrations.0005_locationancestor')
+        links = self.links()
+        LocationAncestor.objects.all().delete()
+        migration.build_hierarchy(apps, None)
+        self.assertEqual(links, self.links())
+        self.assert_(('Detroit', 'Michigan', 1) in links)
+        self.assert_(('Detroit', 'North America', 3) in links)
+
+
+class AliasIndexTest(TestCase):
+
+    def test_alias_key(self):
+        self.assertEqual(alias_key('Republic of Korea'), alias_key('Korea, Republic of'))
+        self.assertEqual(alias_key(u'C\xf4te d\u2019Ivoire'), alias_key("Cote D'Ivoire"))
+        self.assertEqual(alias_key('Saint Lucia'), alias_key('St. Lucia'))
+        self.assertEqual(alias_key('West Bank and Gaza'), alias_key('WEST BANK AND GAZA'))
+        self.assertEqual(alias_key('Virgin Islands (U.S.)'), alias_key('US Virgin Islands'))
+        self.assertNotEqual(alias_key('Korea'), alias_key('Republic of Korea'))
+
+    def test_index(self):
+        aliases = AliasIndex()
+        self.assertEqual('Palestinian Territory', aliases.alternate_name('West bank & Gaza'))
+        self.assertEqual('Saint Kitts and Nevis', aliases.alternate_name('ST KITTS & NEVIS'))
+        self.assertEqual(None, aliases.alternate_name('Israel'))
+        self.assertEqual('IL', aliases.country('israel').code)
+        self.assertEqual(None, aliases.country('Atlantis'))
+
+        self.assertEqual(None, aliases.geonames_id('Atlantis', {}))
+        aliases.learn('Atlantis', {'country': 'GR'}, 1)
+        self.assertEqual(1, aliases.geonames_id('ATLANTIS', {'country': 'GR'}))
+        self.assertEqual(None, aliases.geonames_id('Atlantis', {}))
+        # learned aliases are saved for later
+        self.assertEqual(1, AliasIndex().geonames_id('Atlantis', {'country': 'GR'}))
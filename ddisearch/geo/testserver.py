@@ -0,0 +1,268 @@
+# file ddisearch/geo/testserver.py
+#
+# Copyright 2014 Emory University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# local stand-in for the GeoNames web service, serving searchJSON and
+# getJSON from a GeoNames dump or JSON fixture, so that geocoding can be
+# tested and benchmarked end to end without calling api.geonames.org
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import Counter
+import json
+import logging
+import random
+from SocketServer import ThreadingMixIn
+import threading
+import time
+import urlparse
+
+from ddisearch.geo.gazetteer import LocalGeonamesClient, MAX_CANDIDATES, \
+    as_list, matches_words, place_result, read_places
+from ddisearch.geo.geonames import GeonamesException
+from ddisearch.geo.models import GeonamesPlace, normalize_name
+
+logger = logging.getLogger(__name__)
+
+
+def read_json_places(path):
+    '''Generator of :class:`~ddisearch.geo.models.GeonamesPlace` (not
+    saved) from a JSON fixture: a list of places in the format returned
+    by the GeoNames web service (e.g., the ``geonames`` list from a
+    searchJSON response).'''
+    with open(path) as fixture:
+        data = json.load(fixture)
+    for place in data:
+        yield GeonamesPlace(
+            geonames_id=int(place['geonameId']),
+            name=place['name'],
+            name_key=normalize_name(place['name']),
+            ascii_key=normalize_name(place.get('toponymName', place['name'])),
+            alternate_names='',
+            latitude=float(place['lat']),
+            longitude=float(place['lng']),
+            feature_class=place.get('fcl', ''),
+            feature_code=place.get('fcode', ''),
+            country_code=place.get('countryCode', None) or '',
+            admin_code1=place.get('adminCode1', None) or '',
+            admin_name1=place.get('adminName1', None) or '',
+            population=int(place.get('population', None) or 0))
+
+
+def load_places(files, admin1_names=None):
+    '''Load places from GeoNames dump files (as for the import_geonames
+    manage command) and JSON fixtures (files ending in ``.json``; see
+    :func:`read_json_places`).
+
+    :returns: list of :class:`~ddisearch.geo.models.GeonamesPlace`
+    '''
+    places = []
+    for path in files:
+        if path.lower().endswith('.json'):
+            places.extend(read_json_places(path))
+        else:
+            places.extend(read_places(path, admin1_names))
+    return places
+
+
+class MemoryGazetteer(LocalGeonamesClient):
+    '''Version of :class:`~ddisearch.geo.gazetteer.LocalGeonamesClient`
+    that searches a list of places in memory instead of the database,
+    with the same search semantics, so that it can be used from server
+    threads.'''
+
+    def __init__(self, places):
+        super(MemoryGazetteer, self).__init__()
+        self.places = list(places)
+        self.by_id = dict((p.geonames_id, p) for p in self.places)
+
+    def search(self, query=None, name=None, name_equals=None,
+               country_bias=None, country=None, feature_code=None,
+               feature_class=None, admin_code1=None):
+        '''Search for places; returns the full list of matching
+        :class:`~ddisearch.geo.models.GeonamesPlace`, most relevant first.'''
+        term = name_equals or name or query
+        key = normalize_name(term) if term else None
+        words = key.split() if key else []
+
+        places = self.places
+        if name_equals:
+            places = [p for p in places if key in (p.name_key, p.ascii_key)]
+        elif words:
+            places = [p for p in places if matches_words(p, words)]
+        if country:
+            places = [p for p in places if p.country_code == country]
+        if admin_code1:
+            places = [p for p in places if p.admin_code1 == admin_code1]
+        if feature_code:
+            codes = as_list(feature_code)
+            places = [p for p in places if p.feature_code in codes]
+        if feature_class:
+            classes = as_list(feature_class)
+            places = [p for p in places if p.feature_class in classes]
+
+        places = sorted(places, key=lambda p: self.relevance(p, key, country_bias))
+        return places[:MAX_CANDIDATES]
+
+    def geocode(self, exactly_one=True, **kwargs):
+        places = self.search(**kwargs)
+        if not places:
+            return None
+        if exactly_one:
+            return place_result(places[0])
+        return [place_result(p) for p in places]
+
+    def get_by_id(self, geonames_id):
+        place = self.by_id.get(int(geonames_id))
+        if place is None:
+            raise GeonamesException('Error retrieving GeoNames %s: not found' \
+                                    % geonames_id)
+        return place_result(place)
+
+
+class GeonamesRequestHandler(BaseHTTPRequestHandler):
+    'Request handler for :class:`GeonamesTestServer`'
+
+    # GeoNames search parameters and the corresponding search options
+    search_params = {
+        'q': 'query', 'query': 'query', 'name': 'name', 'name_equals': 'name_equals',
+        'country': 'country', 'countryBias': 'country_bias',
+        'adminCode1': 'admin_code1',
+    }
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        endpoint = url.path.strip('/')
+        params = urlparse.parse_qs(url.query)
+        self.server.record(endpoint)
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        error = self.server.injected_error()
+        if error == 'http':
+            return self.respond(503, {'status': {'value': 13,
+                                'message': 'database timeout'}})
+        elif error == 'credits':
+            return self.respond(200, {'status': {'value': 19,
+                'message': 'the hourly limit of 1000 credits has been exceeded'}})
+
+        if endpoint == 'searchJSON':
+            self.respond(200, self.search(params))
+        elif endpoint == 'getJSON':
+            self.respond(200, self.get(params))
+        else:
+            self.respond(404, {'status': {'value': 11,
+                               'message': 'unknown endpoint %s' % endpoint}})
+
+    def search(self, params):
+        options = dict((option, params[param][0])
+                       for param, option in self.search_params.iteritems()
+                       if param in params)
+        if 'featureCode' in params:
+            options['feature_code'] = params['featureCode']
+        if 'featureClass' in params:
+            options['feature_class'] = params['featureClass']
+        max_rows = int(params.get('maxRows', ['100'])[0])
+
+        places = self.server.gazetteer.search(**options)
+        return {'totalResultsCount': len(places),
+                'geonames': [place_result(p).raw for p in places[:max_rows]]}
+
+    def get(self, params):
+        try:
+            return self.server.gazetteer.get_by_id(params['geonameId'][0]).raw
+        except (KeyError, ValueError, GeonamesException):
+            # geonames returns 200 for not found, with a status
+            return {'status': {'value': 15, 'message': 'the geoname feature does not exist.'}}
+
+    def respond(self, status, data):
+        content = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json;charset=UTF-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class GeonamesTestServer(ThreadingMixIn, HTTPServer):
+    '''Lightweight local HTTP server implementing the GeoNames
+    ``searchJSON`` and ``getJSON`` web service endpoints, searching a
+    fixed list of places in memory (see :class:`MemoryGazetteer`).
+    Point :class:`~ddisearch.geo.geonames.GeonamesClient` at it with
+    the **GEONAMES_URL** setting (see :attr:`url`).
+
+    :param places: list of :class:`~ddisearch.geo.models.GeonamesPlace`,
+        e.g. as returned by :func:`load_places`
+    :param host: host name to listen on
+    :param port: port to listen on; 0 picks a free port
+    :param latency: seconds to wait before responding to each request
+    :param error_rate: fraction of requests (0 to 1) to fail
+    :param error: how injected errors fail: ``http`` for a 503 response,
+        or ``credits`` for a GeoNames credit limit status
+    :param seed: random seed for choosing which requests fail, so that
+        runs are reproducible
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, places, host='localhost', port=0, latency=0,
+                 error_rate=0, error='http', seed=None):
+        HTTPServer.__init__(self, (host, port), GeonamesRequestHandler)
+        self.gazetteer = MemoryGazetteer(places)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error = error
+        self.random = random.Random(seed)
+        #: number of requests received, by endpoint
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        'Base url for the server, for the **GEONAMES_URL** setting'
+        return 'http://%s:%d' % self.server_address[:2]
+
+    def record(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] += 1
+
+    def injected_error(self):
+        '''Kind of error to return for the current request, if any,
+        based on :attr:`error_rate`'''
+        if self.error_rate:
+            with self.lock:
+                if self.random.random() < self.error_rate:
+                    return self.error
+
+    def start(self):
+        'Start serving requests in a background thread.'
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       kwargs={'poll_interval': 0.1})
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        'Stop serving requests and close the socket.'
+        self.shutdown()
+        self.server_close()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
@@ -14,16 +14,54 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from collections import Counter, OrderedDict
 import logging
+from multiprocessing.pool import ThreadPool
 import re
+import threading
+import time
 from django.conf import settings
-from ddisearch.geo.models import Location, GeonamesCountry, GeonamesContinent
-from ddisearch.geo.geonames import GeonamesClient, GeonamesException
-from ddisearch.geo.altnames import alternate_names
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from ddisearch.geo.models import Location, GeocodeCache, batches, \
+    link_hierarchy
+from ddisearch.geo.geonames import GeonamesClient, GeonamesException, \
+    RateLimiter
+from ddisearch.geo.gazetteer import LocalGeonamesClient
+from ddisearch.geo.aliases import AliasIndex
+from ddisearch.geo.reference import reference_data
+from ddisearch.geo.stats import GeocodeStats
 
 
 logger = logging.getLogger(__name__)
 
+#: lock held while checking for and creating new
+#: :class:`~ddisearch.geo.models.Location` records, so that codebooks
+#: geocoded in parallel never create the same location twice;
+#: re-entrant because adding a location may add its parent state
+location_lock = threading.RLock()
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+def geonames_rate_limiter():
+    '''Process-wide :class:`~ddisearch.geo.geonames.RateLimiter` for
+    GeoNames web service requests, shared by all geocoders so that a
+    whole load stays within the account limits.  Limits are configured
+    with **GEONAMES_CREDITS_PER_HOUR** (default 1000) and
+    **GEONAMES_CREDITS_PER_DAY** (default 20000); set either to None to
+    disable it.  Returns None if there are no limits.'''
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            limits = [(getattr(settings, 'GEONAMES_CREDITS_PER_HOUR', 1000), 3600),
+                      (getattr(settings, 'GEONAMES_CREDITS_PER_DAY', 20000), 86400)]
+            limits = [(credits, period) for credits, period in limits if credits]
+            if limits:
+                _rate_limiter = RateLimiter(limits)
+        return _rate_limiter
+
 
 class CodebookGeocoder(object):
     '''Utility class to geocode the geographical coverage terms in
@@ -36,28 +74,147 @@ class CodebookGeocoder(object):
 
     name_paren_re = re.compile('^(?P<name>[A-Z][a-zA-Z ]+) \((?P<restriction>[A-Za-z ]+)\)$')
 
-    def __init__(self):
-        # initialize the geocoder for reuse
-        self.geonames = GeonamesClient(username=settings.GEONAMES_USERNAME)
+    #: GeoNames searches tried by :meth:`lookup_name`, in order, until a
+    #: place is found: tier name, name search parameter, and feature classes
+    lookup_tiers = [
+        # exact match, with feature class of A (country, state, region)
+        ('exact', 'name_equals', 'A'),
+        # exact name and broader feature class (P = city, village)
+        ('exact_populated', 'name_equals', ['A', 'P']),
+        # looser name match but smaller feature class
+        ('name', 'name', 'A'),
+        # looser name match and broader feature class
+        ('name_populated', 'name', ['A', 'P']),
+    ]
+
+    def __init__(self, workers=None):
+        # initialize the geocoder for reuse; use the local gazetteer
+        # instead of the GeoNames web service if configured
+        if getattr(settings, 'GEONAMES_LOCAL', False):
+            self.geonames = LocalGeonamesClient()
+        else:
+            self.geonames = GeonamesClient(username=settings.GEONAMES_USERNAME,
+                rate_limiter=geonames_rate_limiter(),
+                timeout=getattr(settings, 'GEONAMES_TIMEOUT', 10),
+                retries=getattr(settings, 'GEONAMES_RETRIES', 3),
+                cache_dir=getattr(settings, 'GEONAMES_CACHE_DIR', None),
+                cache_ttl=getattr(settings, 'GEONAMES_CACHE_TTL', 30) * 86400,
+                base_url=getattr(settings, 'GEONAMES_URL', None))
+
+        #: number of terms in a single codebook to look up in parallel;
+        #: defaults to **GEOCODE_WORKERS** (4)
+        self.workers = workers or getattr(settings, 'GEOCODE_WORKERS', 4)
+        self._pool = None
+        self._pool_lock = threading.Lock()
 
         # save the continents for easy lookup
-        continents = GeonamesContinent.objects.all()
+        continents = reference_data().continents
         self.continents = dict([(c.name, c.geonames_id) for c in continents])
 
+        #: known place names and variants; see :class:`~ddisearch.geo.aliases.AliasIndex`
+        self.aliases = AliasIndex()
+
+        #: GeoNames calls and how terms were resolved, including geocode
+        #: cache hits and misses; see :class:`~ddisearch.geo.stats.GeocodeStats`
+        #: and :meth:`statistics`
+        self.stats = GeocodeStats()
+
     def code_locations(self, cb):
-        '''Code the geographic coverage locations in a codebook'''
+        '''Code the geographic coverage locations in a codebook.
+        Returns True if any geonames ids were added or changed.'''
 
         # in theory this could give us some help, but is often not set
         if cb.geo_unit:
             logger.debug('geogUnit = %s', '; '.join(cb.geo_unit))
 
+        changed = False
+        continents = {}
+        for geog in cb.geo_coverage:
+            # special case: first check if we have a continent
+            # (geonames not looking these up so well; for some reason
+            # 'Europe' is geocoded as 'Minsk' and 'Africa' as 'Camayenne')
+            if geog.val in self.continents:
+                logger.info('geogCover %s', geog.val)
+                continents[self.continents[geog.val]] = geog.val
+                geonames_id = 'geonames:%d' % self.continents[geog.val]
+                if geog.id != geonames_id:
+                    geog.id = geonames_id
+                    changed = True
+
+        # work out how to look up the remaining terms; lookups are done
+        # afterwards, so that distinct terms can be looked up in parallel
+        geo_coverage = cb.geo_coverage
+        lookups = [(geo_coverage[i], term) for i, term in
+                   self.plan_lookups([geog.val for geog in geo_coverage])]
+
+        # look up each distinct term once; results are applied in document
+        # order, so the outcome is the same as looking them up one by one
+        terms = []
+        for geog, term in lookups:
+            if term not in terms:
+                terms.append(term)
+
+        # get any cached results for all of the terms at once, so that
+        # the lookups themselves don't query the database
+        cache = self.cached_results(terms)
+
+        # count the GeoNames calls for this codebook, in all threads
+        calls = Counter()
+        def resolve(term):
+            with self.stats.tally(calls):
+                return self.resolve_term(term, cache)
+        results = self.map(resolve, terms)
+        self.save_results(zip(terms, results))
+        resolved = dict(zip(terms, results))
+
+        # get or add the locations for the whole codebook at once,
+        # including continents, so they are present in the database
+        results = dict((geonames_id, None) for geonames_id in continents)
+        results.update(resolved.itervalues())
+        results.pop(None, None)
+        with self.stats.tally(calls):
+            locations = self.get_locations(results, continents)
+        self.stats.codebook(sum(calls.values()))
+
+        for geog, term in lookups:
+            dbloc = locations.get(resolved[term][0])
+            # if no location was found, warn and skip
+            if dbloc is None:
+                logger.warn('No geonames result found for %s', term[0])
+                self.stats.not_found(term[0])
+                continue
+
+            # set geonames id in the xml
+            geonames_id = 'geonames:%d' % dbloc.geonames_id
+            if geog.id != geonames_id:
+                geog.id = geonames_id
+                changed = True
+            logger.info('setting geonames id to %s (%s, %s, %s)',
+                        geog.id, dbloc.name, dbloc.country_code,
+                         dbloc.continent_code)
+
+        return changed
+
+    def plan_lookups(self, names):
+        '''Work out how to look up the geographic coverage terms for a
+        single codebook, without looking anything up.  Terms depend on the
+        other coverage terms in the same codebook (e.g., whether to assume
+        U.S. locations), so the whole list is needed.  Global coverage and
+        continents are skipped, since they are coded without a lookup.
+
+        :param names: list of geographic coverage values, in document order
+        :returns: list of tuples of position in the list (starting at 0)
+            and the term to pass to :meth:`resolve_term`: a tuple of name,
+            whether to check the list of known countries first, and search
+            options as a tuple of pairs
+        '''
         # check if geographic coverage includes "global" (indicates not US-only)
-        is_global = any([geog.val.lower() == 'global' for geog in cb.geo_coverage])
-        includes_us = any([geog.val == 'United States' for geog in cb.geo_coverage])
+        is_global = any([name.lower() == 'global' for name in names])
+        includes_us = any([name == 'United States' for name in names])
 
         # check if there are at least three US states in this record,
         # to help determine if we should assume US
-        current_us_states = [geog.val for geog in cb.geo_coverage if geog.val in us_states]
+        current_us_states = [name for name in names if name in us_states]
 
         # If not global and includes U.S. and at least one state
         # OR if not global and includes more than three states,
@@ -70,33 +227,20 @@ class CodebookGeocoder(object):
         else:
             doc_assume_US = False
 
-        # loop through geographical coverage terms and look them up,
-        # setting geonames id on the geogCover element
-        for geog in cb.geo_coverage:
+        lookups = []
+        for i, name in enumerate(names):
 
             # reset assume US flag to whatever the document assumption about US is,
             # since it could potentially change for individual locations with
             # U.S. states mentioned
             assume_US = doc_assume_US
 
-            # skip coverage of global - nothing to code
-            if geog.val == 'Global':
+            # skip coverage of global - nothing to code; continents
+            # are coded directly by code_locations
+            if name == 'Global' or name in self.continents:
                 continue
 
-            logger.info('geogCover %s', geog.val)
-
-            # special case: first check if we have a continent
-            # (geonames not looking these up so well; for some reason
-            # 'Europe' is geocoded as 'Minsk' and 'Africa' as 'Camayenne')
-            if geog.val in self.continents:
-                geog.id = 'geonames:%d' % self.continents[geog.val]
-
-                # make sure continent is present in Locations db table
-                if Location.objects.filter(name=geog.val, feature_code='CONT').count() == 0:
-                    loc = self.geonames.geocode(name_equals=geog.val, feature_code='CONT')
-                    dbloc = self.location_from_geoname(loc)
-
-                continue
+            logger.info('geogCover %s', name)
 
             geo_options = {}
 
@@ -105,7 +249,7 @@ class CodebookGeocoder(object):
             #   Hiroshima (prefecture)
             #   New York (state)
             # if (###) is a state, use it to filter; otherwise ignore
-            match = self.name_paren_re.match(geog.val)
+            match = self.name_paren_re.match(name)
             if match:
                 matchinfo = match.groupdict()
                 geogname = matchinfo['name']
@@ -120,155 +264,367 @@ class CodebookGeocoder(object):
                     # NOTE: this is the feature code for states in U.S.
                     # may need to generalize more to handle other countries
             else:
-                geogname = geog.val
+                geogname = name
                 restriction = None
 
             # if this place name is in our list of items with known alternate names,
-            # lookup as if it were the other name
-            if geogname in alternate_names:
-                geogname = alternate_names[geogname]
-            elif geog.val in alternate_names:
-                geogname = alternate_names[geog.val]
-
-            # first check if the name is in the country list
-            # (except for assume US, to avoid coding Georgia, US as Republic of Georgia)
-            dbloc = None
-            if not assume_US:
-                dbloc = self.lookup_country(geogname)
-
-            # next check in the db, in case we've already looked this place up
-            # NOTE: skipping this even though it will require more geocoding,
-            # because adding duplicate logic here to restrict by location,
-            # admin code, etc. seems problematic
-
-            # if we still don't have a location, use the geocoder
-            if dbloc is None:
-                # use US-biased geocoder if we have hit a threshold where
-                # we want to assume US (with certain exceptions)
-                # NOTE: there may well be other locations like Puerto Rico!
-
-                if assume_US and geogname != 'Puerto Rico':
-                    geo_options['country'] = 'US'
-
-                if assume_US and geogname in us_states and not restriction == 'state':
-                    # FIXME: what is this doing?
-                    geo_options['admin_code1'] = us_states[geogname]
-                elif restriction is not None and restriction in us_states:
-                    # if we have a restriction that matches a U.S. state
-                    # (e.g. "Portland (Maine"), pass that along to the geocoder
-                    geo_options['admin_code1'] = us_states[restriction]
-
-                # special case: if record includes U.S. and only one state,
-                # and current place is neither of those, look within the state first
-                elif includes_us and len(current_us_states) == 1 and \
-                  geogname != 'United States' and geogname not in current_us_states:
-                    geo_options['admin_code1'] = us_states[current_us_states[0]]
-
-                loc = self.lookup_name(geogname, geo_options)
-                # if no location was found, warn and skip
-                if not loc:
-                    logger.warn('No geonames result found for %s', geogname)
-                    continue
-
-                logger.debug('geonames result: %s', unicode(loc))
-                logger.debug(loc.raw)
-
-                # check if geonames id is already in the db
-                db_locations = Location.objects.filter(geonames_id=loc.raw['geonameId'])
-                if db_locations.count():
-                    dbloc = db_locations[0]
-                else:
-                    # if not, create new db location from geonames lookup
-                    dbloc = self.location_from_geoname(loc)
-
-            # set geonames id in the xml
-            geog.id = 'geonames:%d' % dbloc.geonames_id
-            logger.info('setting geonames id to %s (%s, %s, %s)',
-                        geog.id, dbloc.name, dbloc.country_code,
-                         dbloc.continent_code)
+            # lookup as if it were the other name (matching variant forms)
+            alternate = self.aliases.alternate_name(geogname) or \
+                self.aliases.alternate_name(name)
+            if alternate:
+                geogname = alternate
+
+            # use US-biased geocoder if we have hit a threshold where
+            # we want to assume US (with certain exceptions)
+            # NOTE: there may well be other locations like Puerto Rico!
+
+            if assume_US and geogname != 'Puerto Rico':
+                geo_options['country'] = 'US'
+
+            if assume_US and geogname in us_states and not restriction == 'state':
+                # FIXME: what is this doing?
+                geo_options['admin_code1'] = us_states[geogname]
+            elif restriction is not None and restriction in us_states:
+                # if we have a restriction that matches a U.S. state
+                # (e.g. "Portland (Maine"), pass that along to the geocoder
+                geo_options['admin_code1'] = us_states[restriction]
+
+            # special case: if record includes U.S. and only one state,
+            # and current place is neither of those, look within the state first
+            elif includes_us and len(current_us_states) == 1 and \
+              geogname != 'United States' and geogname not in current_us_states:
+                geo_options['admin_code1'] = us_states[current_us_states[0]]
+
+            # check the country list first, except for assume US, to avoid
+            # coding Georgia, US as Republic of Georgia
+            lookups.append((i, (geogname, not assume_US,
+                                   tuple(sorted(geo_options.items())))))
+        return lookups
+
+    def resolve_term(self, term, cache=None):
+        '''Find the GeoNames id for a single geographic coverage term, as
+        determined by :meth:`plan_lookups`, without adding anything to the
+        database, so that the locations for all of the terms in a
+        codebook can be added at once with :meth:`get_locations`.  Safe to
+        run in parallel.  The result is not cached and aliases are not
+        learned from it until :meth:`save_results` is called, so that the
+        result of resolving one term never depends on other terms resolved
+        at the same time.
+
+        :param term: term as returned by :meth:`plan_lookups`
+        :param cache: geocode cache entries for the term, as returned by
+            :meth:`cached_results`; if not specified, the cache is queried
+        :returns: tuple of geonames id and
+            :class:`~ddisearch.geo.geonames.GeonamesResult` (only when the
+            place was looked up with GeoNames); (None, None) if not found
+        '''
+        geogname, check_country, geo_options = term
+        geo_options = dict(geo_options)
+
+        # first check if the name is in the country list
+        if check_country:
+            geonames_id = self.lookup_country(geogname)
+            if geonames_id is not None:
+                self.stats.resolved('country')
+                return geonames_id, None
+
+        # next check in the db, in case we've already looked this place up
+        # NOTE: skipping this even though it will require more geocoding,
+        # because adding duplicate logic here to restrict by location,
+        # admin code, etc. seems problematic
+
+        # next check for a variant of a name that has been geocoded before
+        geonames_id = self.lookup_alias(geogname, geo_options)
+        if geonames_id is not None:
+            self.stats.resolved('alias')
+            return geonames_id, None
+
+        # if we still don't have a location, use the geocoder
+        return self.cached_resolve(geogname, geo_options, cache)
+
+    def cached_results(self, terms):
+        '''Get the geocode cache entries for a list of terms, with a
+        single query (per 500 names), to pass to :meth:`resolve_term`.
+
+        :param terms: list of terms, as for :meth:`resolve_term`
+        :returns: dictionary of :class:`~ddisearch.geo.models.GeocodeCache`
+            keyed on normalized name and options
+        '''
+        names = set(GeocodeCache.key(geogname, dict(geo_options))['name']
+                    for geogname, check_country, geo_options in terms)
+        cache = {}
+        for batch in batches(names):
+            cache.update(((cached.name, cached.options), cached) for cached
+                         in GeocodeCache.objects.filter(name__in=batch))
+        return cache
+
+    def save_results(self, resolved):
+        '''Save the results of resolving terms with :meth:`resolve_term`
+        once all of the terms being resolved together are done: terms that
+        were looked up with GeoNames are added to the geocode cache
+        (including when nothing was found), and aliases are learned (see
+        :class:`~ddisearch.geo.aliases.AliasIndex`) from the ones that
+        were found.  Saved in bulk, in the order given, so that the number
+        of queries does not grow with the number of terms, and results are
+        the same whether terms are resolved one at a time or in parallel.
+
+        :param resolved: list of tuples of term (as for :meth:`resolve_term`)
+            and the result of :meth:`resolve_term` for it
+        '''
+        results = OrderedDict()
+        found = []
+        for (geogname, check_country, geo_options), (geonames_id, loc) in resolved:
+            options = dict(geo_options)
+            # results without a GeoNames result are known countries,
+            # aliases, or cache hits, unless nothing was found
+            if loc is not None or geonames_id is None:
+                key = GeocodeCache.key(geogname, options)
+                results[(key['name'], key['options'])] = geonames_id
+            if loc is not None:
+                found.append((geogname, options, geonames_id))
+        self.update_cache(results)
+        self.aliases.learn_many(found)
+
+    def update_cache(self, results):
+        '''Add or update geocode cache entries in bulk.  Negative results
+        that are already cached and have not expired are left as is.
+
+        :param results: dictionary of geonames id or None, keyed on
+            normalized name and options
+        '''
+        if not results:
+            return
+        existing = {}
+        for batch in batches(set(name for name, options in results)):
+            existing.update(((cached.name, cached.options), cached) for cached
+                            in GeocodeCache.objects.filter(name__in=batch)
+                            if (cached.name, cached.options) in results)
+        changed = {}
+        for key, cached in existing.iteritems():
+            geonames_id = results[key]
+            if geonames_id is None and cached.geonames_id is None and not cached.expired:
+                continue
+            changed.setdefault(geonames_id, []).append(cached.pk)
+
+        try:
+            with transaction.atomic():
+                GeocodeCache.objects.bulk_create([
+                    GeocodeCache(name=name, options=options, geonames_id=geonames_id)
+                    for (name, options), geonames_id in results.iteritems()
+                    if (name, options) not in existing])
+                for geonames_id, pks in changed.iteritems():
+                    GeocodeCache.objects.filter(pk__in=pks) \
+                        .update(geonames_id=geonames_id, updated=timezone.now())
+        except IntegrityError:
+            # some of the same names were cached by another process since
+            # they were checked; save them one at a time instead
+            for (name, options), geonames_id in results.iteritems():
+                try:
+                    with transaction.atomic():
+                        GeocodeCache.objects.update_or_create(name=name,
+                            options=options, defaults={'geonames_id': geonames_id})
+                except IntegrityError:
+                    # cached at the same time; either is fine
+                    pass
+
+    def map(self, func, items):
+        '''Apply a function to a list of items, in parallel threads if
+        more than one worker is configured, and return the results in
+        the same order.'''
+        if self.workers <= 1 or len(items) <= 1:
+            return map(func, items)
+        with self._pool_lock:
+            # pool is created once and reused, since it may be used for
+            # thousands of codebooks
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+        return self._pool.map(func, items)
 
     def lookup_country(self, geogname):
-        # lookup a name to see if matches one of our known countries
-        country = GeonamesCountry.objects.filter(name=geogname).first()
+        # lookup a name to see if matches one of our known countries;
+        # returns the geonames id
+        country = reference_data().country_by_name.get(geogname) or \
+            self.aliases.country(geogname)
         if country:
-            try:
-                loc = self.geonames.get_by_id(country.geonames_id)
-                logger.debug('Found a country match for %s, using geonames %s',
-                             geogname, country.geonames_id)
-                dbloc = self.location_from_geoname(loc)
-                return dbloc
-            except GeonamesException as err:
-                # it's possible to get an error if geonames id no
-                # longer exists
-                logger.warn('Failed to load Geonames %s id %s: %s',
-                            geogname, country.geonames_id, err)
-
-    def lookup_location(self, geogname, assume_US=False):
-        # lookup a name to see if it matches a location in the database
-        country_filter = {}
-        # if conditions are met where we want to assume US, restrict to
-        # country code US except for Puerto Rico
-        if assume_US and geogname != 'Puerto Rico':
-            country_filter['country_code'] = 'US'
-        db_locations = Location.objects.filter(name=geogname, **country_filter)
-        # if we *don't* have reason to assume US and we get Georgia,
-        # look for non-US match
-        # NOTE: possibly redundant with new lookup_country logic?
-        if not assume_US and geogname == 'Georgia':
-            # NOTE: we could use similar logic to give a country bias to geocoder
-            db_locations = db_locations.exclude(country_code='US')
-
-        # NOTE: historic German and Italian states are handled
-        # via alternate names list, and coded at country level
-
-        # If there is one and only one match, use it; otherwise defer to geocoder
-        # to determine which place to use
-        if db_locations.count() == 1:
-            # store db location so we can put geonames id into the xml
-            dbloc = db_locations[0]
-
-            logger.debug('Found a location match for %s, using %s',
-                geogname, dbloc)
-
-            return dbloc
-
+            logger.debug('Found a country match for %s, using geonames %s',
+                         geogname, country.geonames_id)
+            return country.geonames_id
+
+    def lookup_alias(self, geogname, geo_options):
+        '''Find the geonames id for a geographic name using aliases learned
+        from past geocoding results (see :class:`~ddisearch.geo.aliases.AliasIndex`),
+        without calling GeoNames.
+
+        :returns: geonames id or None
+        '''
+        geonames_id = self.aliases.geonames_id(geogname, geo_options)
+        if geonames_id is not None:
+            logger.debug('Found alias match for %s, using geonames %s',
+                         geogname, geonames_id)
+        return geonames_id
+
+    def cached_resolve(self, geogname, geo_options, cache=None):
+        '''Find the geonames id for a geographic name, checking the
+        geocode cache before geocoding with :meth:`lookup_name`.  The
+        result (including when nothing is found) is cached by
+        :meth:`save_results`.
+
+        :param cache: cached results, as for :meth:`resolve_term`
+        :returns: tuple as for :meth:`resolve_term`
+        '''
+        key = GeocodeCache.key(geogname, geo_options)
+        if cache is None:
+            cached = GeocodeCache.objects.filter(**key).first()
+        else:
+            cached = cache.get((key['name'], key['options']))
+        if cached is not None:
+            if cached.geonames_id is None and not cached.expired:
+                self.stats.resolved('cache_not_found')
+                return None, None
+            elif cached.geonames_id is not None:
+                # if the location has been removed, it is added again
+                # from GeoNames by id
+                self.stats.resolved('cache')
+                logger.debug('Found cached result for %s, using geonames %s',
+                             geogname, cached.geonames_id)
+                return cached.geonames_id, None
+
+        geonames_id = None
+        loc = self.lookup_name(geogname, geo_options)
+        if loc:
+            logger.debug('geonames result: %s', unicode(loc))
+            logger.debug(loc.raw)
+            geonames_id = int(loc.raw['geonameId'])
+            self.stats.resolved('geonames')
+        else:
+            loc = None
+            self.stats.resolved('geonames_not_found')
+        return geonames_id, loc
+
+    def statistics(self, top=10):
+        '''Geocoding statistics since this geocoder was created, as a
+        dictionary suitable for serializing as JSON: the summary from
+        :class:`~ddisearch.geo.stats.GeocodeStats`, with GeoNames request
+        counts, credits and latency (``geonames``) added.
+
+        :param top: number of unresolved and most expensive names to include
+        '''
+        summary = self.stats.summary(top)
+        summary['geonames'] = self.geonames.stats.summary()
+        return summary
 
     def lookup_name(self, geogname, geo_options):
-        # attempt to geocode the geographic name
-
-        # first try for exact match, with feature class of A (country, state, region)
-        loc = self.geonames.geocode(name_equals=geogname, feature_class='A',
-                                    **geo_options)
-
-        # if that doesn't work, try with exact name and broader feature class (P = city, village)
-        if not loc:
-            loc = self.geonames.geocode(name_equals=geogname, feature_class=['A', 'P'],
-                                        **geo_options)
-
-        # if that doesn't work, try with looser name match but smaller feature class
-        if not loc:
-            loc = self.geonames.geocode(name=geogname, feature_class='A',
-                                        **geo_options)
-
-        # if that still fails, try a looser name match
-        if not loc:
-            loc = self.geonames.geocode(name=geogname, feature_class=['A', 'P'],
-                                        **geo_options)
-
+        # attempt to geocode the geographic name, trying each of the
+        # lookup tiers in turn until a place is found
+        start = time.time()
+        loc = tier = None
+        for tier, name_param, feature_class in self.lookup_tiers:
+            self.stats.call(tier, geogname)
+            options = dict(geo_options)
+            options[name_param] = geogname
+            loc = self.geonames.geocode(feature_class=feature_class, **options)
+            if loc:
+                break
+
+        self.stats.name_found(tier if loc else None, time.time() - start)
         # could return none if no match
         return loc
 
+    def get_locations(self, results, continents=None):
+        '''Get the :class:`~ddisearch.geo.models.Location` records for a
+        set of geonames ids with a single query, adding any that are not in
+        the database yet with :meth:`add_locations`.
+
+        :param results: dictionary of geonames id and the corresponding
+            :class:`~ddisearch.geo.geonames.GeonamesResult`, or None; ids
+            without a result that are not in the database are looked up
+            with GeoNames
+        :param continents: optional dictionary of geonames id and name for
+            continents, which are looked up by name instead
+        :returns: dictionary of geonames id and location; ids that could
+            not be found are left out
+        '''
+        if not results:
+            return {}
+        continents = continents or {}
+        locations = dict((dbloc.geonames_id, dbloc) for dbloc in
+                         Location.objects.filter(geonames_id__in=list(results)))
+
+        new = []
+        for geonames_id, loc in results.iteritems():
+            if geonames_id in locations:
+                continue
+            if loc is None and geonames_id in continents:
+                self.stats.call('continent')
+                loc = self.geonames.geocode(name_equals=continents[geonames_id],
+                                            feature_code='CONT')
+            elif loc is None:
+                self.stats.call('by_id')
+                try:
+                    loc = self.geonames.get_by_id(geonames_id)
+                except GeonamesException as err:
+                    # it's possible to get an error if geonames id no
+                    # longer exists
+                    logger.warn('Failed to load Geonames id %s: %s',
+                                geonames_id, err)
+            if loc:
+                new.append(loc)
+
+        if new:
+            locations.update(self.add_locations(new))
+        return locations
+
+    def add_locations(self, geonames):
+        '''Add locations to the database from GeoNames results, along
+        with the states of any cities, etc. whose state is not in the
+        database yet (so that the browse page will not 404), in bulk and
+        in a single transaction.
+
+        :param geonames: list of :class:`~ddisearch.geo.geonames.GeonamesResult`
+        :returns: dictionary of geonames id and
+            :class:`~ddisearch.geo.models.Location`, for the results
+            and any states that were added
+        '''
+        with location_lock:
+            # check which are already in the db; they may have been added
+            # for another codebook since they were looked up
+            ids = set(int(loc.raw['geonameId']) for loc in geonames)
+            locations = dict((dbloc.geonames_id, dbloc) for dbloc in
+                             Location.objects.filter(geonames_id__in=list(ids)))
+
+            new = OrderedDict()
+            for loc in geonames:
+                fields = self.location_fields(loc)
+                if fields['geonames_id'] not in locations:
+                    new.setdefault(fields['geonames_id'], fields)
+            for loc in self.missing_states(new.values()):
+                fields = self.location_fields(loc)
+                new.setdefault(fields['geonames_id'], fields)
+            if not new:
+                return locations
 
-    def location_from_geoname(self, loc):
-        '''Create and return a :class:`ddisearch.geo.models.Location`
-        based on a location as returned by
-        :class:`geopy.geocoders.GeoNames`'''
-
-        # check if requested location is already in the db by geoname id
-        # if already present, do nothing
-        dbloc = Location.objects.filter(geonames_id=loc.raw['geonameId'])
-        if dbloc:
-            return dbloc[0]
+            try:
+                with transaction.atomic():
+                    Location.objects.bulk_create([Location(**fields)
+                                                  for fields in new.itervalues()])
+                    # get the new records back, with database ids
+                    added = list(Location.objects.filter(geonames_id__in=list(new)))
+                    link_hierarchy(added)
+            except IntegrityError:
+                # another load process added some of the same locations
+                # since the check above; add them one at a time instead
+                added = []
+                for fields in new.itervalues():
+                    geonames_id = fields.pop('geonames_id')
+                    added.append(Location.objects.get_or_create(
+                        geonames_id=geonames_id, defaults=fields)[0])
+
+            locations.update((dbloc.geonames_id, dbloc) for dbloc in added)
+            return locations
+
+    def location_fields(self, loc):
+        # field values for a new location, based on a geonames result
+        refdata = reference_data()
 
         # determine continent code based on country
         country_code = loc.raw.get('countryCode', None)
@@ -280,23 +636,19 @@ class CodebookGeocoder(object):
         geonames_id = int(loc.raw['geonameId'])
         # USSR, Yugoslavia, Serbia and Montenegro
         if geonames_id in [8354411, 8505035, 8505033]:
-            country = GeonamesCountry.objects.get(geonames_id=geonames_id)
+            country = refdata.country_by_geonames_id[geonames_id]
             country_code = country.code
 
         continent_code = None
         if country_code is not None:
-            try:
-                c = GeonamesCountry.objects.get(code=country_code)
+            c = refdata.country_by_code.get(country_code)
+            if c is not None:
                 continent_code = c.continent
-            except:
-                pass
         # special case for continents
         elif loc.raw['fcode'] == 'CONT':
-            try:
-                c = GeonamesContinent.objects.get(geonames_id=loc.raw['geonameId'])
+            c = refdata.continent_by_geonames_id.get(geonames_id)
+            if c is not None:
                 continent_code = c.code
-            except:
-                pass
 
         # get state code if there is one
         state_code = None
@@ -304,34 +656,51 @@ class CodebookGeocoder(object):
         if admin_code and admin_code != '00':
             state_code = admin_code
 
-        dbloc = Location(name=loc.raw['name'],
-                         geonames_id=loc.raw['geonameId'],
-                         latitude=loc.latitude,
-                         longitude=loc.longitude,
-                         country_code=country_code,
-                         feature_code=loc.raw['fcode'],
-                         continent_code=continent_code,
-                         state_code=state_code)
-        dbloc.save()
-
+        return {'geonames_id': geonames_id,
+                'name': loc.raw['name'],
+                'latitude': loc.latitude,
+                'longitude': loc.longitude,
+                'country_code': country_code,
+                'feature_code': loc.raw['fcode'],
+                'continent_code': continent_code,
+                'state_code': state_code}
+
+    def missing_states(self, new_locations):
+        '''Find the states for new cities, etc. that are not in the
+        database or in the list of new locations, and look them up with
+        GeoNames.
+
+        :param new_locations: list of field values for new locations, as
+            returned by :meth:`location_fields`
+        :returns: list of :class:`~ddisearch.geo.geonames.GeonamesResult`
+        '''
         # for cities with state code, make sure the state location is in db
         # so that browse page will not 404
         # TODO: other codes that belong here?
         # FIXME: do we really want ISL ? or probably not?
         # - perhaps restrict via allowed feature codes on initial geocode request
-        if dbloc.feature_code in ['PPLA', 'PPLA2', 'ISL', 'ADM2'] and dbloc.state_code:
-            if not Location.objects.filter(country_code=dbloc.country_code,
-                                       state_code=dbloc.state_code,
-                                       feature_code='ADM1').count():
-                state = self.geonames.geocode(country=dbloc.country_code,
-                                              feature_code='ADM1',
-                                              admin_code1=dbloc.state_code)
-
-                if state:
-                    self.location_from_geoname(state)
-
-        return dbloc
-
+        needed = set((fields['country_code'], fields['state_code'])
+                     for fields in new_locations
+                     if fields['feature_code'] in ['PPLA', 'PPLA2', 'ISL', 'ADM2']
+                     and fields['state_code'])
+        needed -= set((fields['country_code'], fields['state_code'])
+                      for fields in new_locations if fields['feature_code'] == 'ADM1')
+        if not needed:
+            return []
+
+        existing = set(Location.objects.filter(feature_code='ADM1',
+                country_code__in=[country for country, state in needed],
+                state_code__in=[state for country, state in needed]) \
+            .values_list('country_code', 'state_code'))
+        states = []
+        for country_code, state_code in sorted(needed - existing):
+            self.stats.call('state')
+            state = self.geonames.geocode(country=country_code,
+                                          feature_code='ADM1',
+                                          admin_code1=state_code)
+            if state:
+                states.append(state)
+        return states
 
 us_states = {
     'Alabama': 'AL',
@@ -16,13 +16,16 @@
 
 from urllib import urlencode
 
+from django.db.models import Q
+from django.http import Http404
 from django.shortcuts import render, get_object_or_404
 from django.core.paginator import Paginator, EmptyPage, InvalidPage
 
 from ddisearch.ddi.models import CodeBook
 from ddisearch.ddi.forms import SearchOptions
 from ddisearch.ddi.views import _sort_results
-from ddisearch.geo.models import Location, GeonamesContinent, GeonamesCountry
+from ddisearch.geo.models import Location
+from ddisearch.geo.reference import reference_data
 
 
 def resources_by_location(request, geonames_ids=None, geo_coverage=None,
@@ -82,19 +85,22 @@ def browse(request, continent=None, country=None, state=None,
     places = None
     hierarchy = []
     alternate_names = []
+    refdata = reference_data()
 
     # if continent is not set, display top-level geography browse page;
     # list of continents, global resources
     if continent is None:
-        codes = Location.objects.order_by('continent_code') \
-                                .values_list('continent_code', flat=True) \
-                                .distinct()
-        places = GeonamesContinent.objects.filter(code__in=codes).order_by('name')
+        codes = set(Location.objects.order_by('continent_code') \
+                                    .values_list('continent_code', flat=True) \
+                                    .distinct())
+        places = [c for c in refdata.continents if c.code in codes]
 
     # find continent if set
     if continent is not None:
         # get continent object so we can display name, etc
-        cont = get_object_or_404(GeonamesContinent, code=continent)
+        cont = refdata.continent_by_code.get(continent)
+        if cont is None:
+            raise Http404
         # TODO: possibly find list of country codes in the data and then
         # get country list from GeonamesCountry to ensure we don't miss things?
         # set as current place
@@ -112,13 +118,14 @@ def browse(request, continent=None, country=None, state=None,
             # find places in this continent
             codes = [loc['country_code'] for loc in country_codes
                      if loc['country_code'] is not None]
-            places = GeonamesCountry.objects.filter(code__in=codes).order_by('name')
+            places = [c for c in refdata.countries if c.code in codes]
 
     # find country if set
     if country is not None:
         # NOTE: could be multiple countries for one country code (i.e. historic)
-        country = get_object_or_404(GeonamesCountry, code=country,
-            continent=continent)
+        country = refdata.country_by_code.get(country)
+        if country is None or country.continent != continent:
+            raise Http404
 
         # - ids for document lookup
         current_place_ids = Location.objects.filter(country_code=country.code,
@@ -141,8 +148,13 @@ def browse(request, continent=None, country=None, state=None,
 
     # find state if set
     if state is not None:
-        state = get_object_or_404(Location, state_code=state, feature_code__in=['ADM1', 'RGN'],
-            continent_code=continent, country_code=country.code)
+        # a region may share the state code of the state it is in;
+        # prefer the state itself (ADM1 sorts before RGN)
+        state = Location.objects.filter(state_code=state, feature_code__in=['ADM1', 'RGN'],
+            continent_code=continent, country_code=country.code) \
+            .order_by('feature_code').first()
+        if state is None:
+            raise Http404
 
         hierarchy.append(state)
         current_place = state
@@ -150,8 +162,14 @@ def browse(request, continent=None, country=None, state=None,
 
         # if no sub-state location is specified, browse the state
         if geonames_id is None:
-            places = Location.objects.filter(state_code=state.state_code) \
-                                     .exclude(feature_code='ADM1')
+            # places within the state (see Location.descendants), and any
+            # regions with the same state code, which are at the same level
+            # in the hierarchy but have always been listed here
+            places = Location.objects.filter(
+                Q(ancestor_links__ancestor=state, ancestor_links__depth__gt=0) |
+                Q(feature_code='RGN', state_code=state.state_code,
+                  country_code=country.code)) \
+                .exclude(pk=state.pk).distinct()
 
     # if geonames id is specified, browse by sub-state city or region
     if geonames_id is not None:
@@ -106,6 +106,24 @@ STATICFILES_DIRS = (
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 
 
+# cache for rendered single-document pages, keyed on document checksum
+# (see DDI_PAGE_CACHE); in production, use a cache shared by all processes
+# (e.g., memcached), so that outdated pages are removed when documents
+# are reloaded
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'pages': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'ddisearch-pages',
+        'TIMEOUT': 7 * 86400,
+        'OPTIONS': {'MAX_ENTRIES': 500},
+    },
+}
+# name of the cache to use for rendered pages; set to None to disable
+DDI_PAGE_CACHE = 'pages'
+
 EXISTDB_INDEX_CONFIGFILE = os.path.join(BASE_DIR, 'ddisearch', 'exist_index.xconf')
 EXISTDB_FULLTEXT_OPTIONS = {'default-operator': 'and'}
 # connection timeout for requests to eXist in seconds